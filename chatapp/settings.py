@@ -90,6 +90,31 @@ DATABASES = {
     }
 }
 
+# SQLite mode, chosen per deployment:
+#   dev        - Django's defaults (rollback journal, fsync on every commit)
+#   production - WAL, so readers never wait for a writer and the writer
+#                never waits for readers; synchronous=NORMAL (fsync at
+#                checkpoints: a power cut can lose the last commits but not
+#                corrupt the file); a busy timeout and IMMEDIATE
+#                transactions, so writers from other threads and processes
+#                queue for the lock instead of failing with "database is
+#                locked"; memory-mapped reads and a larger page cache.
+# Switching to WAL is persistent; it stays on for the file afterwards.
+CHAT_SQLITE_MODE = os.environ.get('CHAT_SQLITE_MODE', 'dev')
+
+if CHAT_SQLITE_MODE == 'production':
+    DATABASES['default']['OPTIONS'] = {
+        'timeout': 20,
+        'transaction_mode': 'IMMEDIATE',
+        'init_command': (
+            'PRAGMA journal_mode=WAL;'
+            'PRAGMA synchronous=NORMAL;'
+            'PRAGMA mmap_size=268435456;'
+            'PRAGMA cache_size=-65536;'
+            'PRAGMA temp_store=MEMORY'
+        ),
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -131,11 +156,101 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
 ASGI_APPLICATION = 'chatapp.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+# Channel layer backend, chosen per deployment:
+#   memory - in-process only, a single Daphne worker (default)
+#   redis  - channels_redis pub/sub layer, for several workers/nodes
+#   local  - core.broker, a pure-Python stand-in for Redis
+#            (start it with `python manage.py run_broker`)
+CHAT_CHANNEL_LAYER = os.environ.get('CHAT_CHANNEL_LAYER', 'memory')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')
+CHAT_BROKER_ADDRESS = os.environ.get('CHAT_BROKER_ADDRESS', '127.0.0.1:6390')
+
+if CHAT_CHANNEL_LAYER == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+            'CONFIG': {'hosts': [REDIS_URL]},
+        }
     }
+elif CHAT_CHANNEL_LAYER == 'local':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'core.broker.BrokerChannelLayer',
+            'CONFIG': {'address': CHAT_BROKER_ADDRESS},
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        }
+    }
+
+# Write-behind persistence of chat messages (core/persistence.py)
+CHAT_PERSIST_BATCH_SIZE = 100     # rows per bulk_create
+CHAT_PERSIST_MAX_DELAY = 0.25     # seconds a message may wait before being flushed
+CHAT_PERSIST_MAX_PENDING = 5000   # queue length at which senders are slowed down
+CHAT_PERSIST_RETRIES = 5          # retries of a batch that hit a transient DB error (e.g. locked)
+CHAT_PERSIST_RETRY_DELAY = 0.1    # seconds before the first retry; doubles each time
+
+# Typing indicator coalescing (core/typing_indicator.py)
+CHAT_TYPING_DEBOUNCE = 2.0   # min seconds between repeated "typing" broadcasts per user
+CHAT_TYPING_EXPIRY = 5.0     # seconds of silence before an automatic stop_typing
+
+# Websocket flood protection (core/ratelimit.py). Per message type: frames
+# per second and burst per connection, optionally per user across all of
+# their sockets on a worker, and what happens to frames over the limit:
+# 'drop', 'delay' (up to CHAT_RATE_MAX_DELAY seconds, then drop) or
+# 'disconnect'. Frames that are not valid JSON count as 'default'.
+CHAT_RATE_LIMITS = {
+    'chat': {'rate': 5, 'burst': 10, 'user_rate': 10, 'user_burst': 20, 'policy': 'delay'},
+    'typing': {'rate': 5, 'burst': 10, 'policy': 'drop'},
+    'stop_typing': {'rate': 5, 'burst': 10, 'policy': 'drop'},
+    'history': {'rate': 2, 'burst': 5, 'user_rate': 5, 'user_burst': 10, 'policy': 'delay'},
+    'read': {'rate': 5, 'burst': 10, 'policy': 'drop'},
+    'heartbeat': {'rate': 1, 'burst': 5, 'policy': 'drop'},
+    'default': {'rate': 2, 'burst': 5, 'policy': 'disconnect'},
 }
+CHAT_RATE_MAX_DELAY = 2.0          # longest a frame is held back under the 'delay' policy
+CHAT_MAX_FRAME_SIZE = 16 * 1024    # bytes; larger frames close the socket
+
+# Database access from the consumers (core/db.py)
+CHAT_DB_CONCURRENCY = 8            # DB calls in flight per worker; the rest wait
+CHAT_DB_TIMEOUT = 5.0              # seconds to wait for a slot before shedding the request
+
+# Message sequence numbers (core/sequences.py)
+CHAT_SEQ_BLOCK_SIZE = 100          # numbers leased per DB round trip; only with CHAT_CHANNEL_LAYER 'memory'
+
+# Recent-message cache for reconnect replay and latest history pages (core/recent.py)
+CHAT_RECENT_MESSAGES = 200         # frames kept per conversation
+CHAT_RECENT_MAX_ROOMS = 1000       # conversations cached before LRU eviction
+CHAT_RECENT_MAX_BYTES = 64 * 1024 * 1024  # total frame memory before LRU eviction
+
+# Read receipts (core/receipts.py)
+CHAT_READ_FLUSH_INTERVAL = 2.0     # seconds between batched read-state writes and receipt pushes
+
+# Presence (core/presence.py)
+CHAT_PRESENCE_TTL = 60             # seconds without a heartbeat before a socket is dropped
+CHAT_PRESENCE_FLUSH_INTERVAL = 2.0 # seconds between batched is_online writes
+CHAT_PRESENCE_REFRESH = 30         # seconds between re-asserting local online users
+CHAT_PRESENCE_TICK = 1.0           # seconds between batched presence pushes to clients
+
+# Message search backend (core/search.py). Defaults to the SQLite FTS5 index
+# on SQLite and to a plain substring scan elsewhere.
+# CHAT_SEARCH_BACKEND = 'core.search.SQLiteFTSBackend'
+CHAT_SEARCH_MAX_CANDIDATES = 2000   # newest matches ranked per query by the FTS5 backend
+
+# User search typeahead (core/typeahead.py)
+CHAT_TYPEAHEAD_MAX_AGE = 300       # seconds before the in-memory prefix index is rebuilt
+
+# History export (core/export.py)
+CHAT_EXPORT_CHUNK_SIZE = 2000      # messages read and encoded per batch
+
+# Avatar thumbnails (core/thumbnails.py)
+CHAT_AVATAR_SIZES = (40, 80, 160)  # square pixel sizes rendered per upload; 2x the CSS size shown
+CHAT_THUMBNAIL_WORKERS = 2         # background threads rendering thumbnails per worker
+CHAT_THUMBNAIL_RECHECK = 60        # seconds before a missing thumbnail is looked up in storage again
+CHAT_MEDIA_GC_GRACE = 60           # seconds a just-reused upload is safe from deletion (core/media.py)
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
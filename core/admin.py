@@ -1,10 +1,11 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import Room, Message, PrivateRoom, PrivateChatMessage, UserProfile
+from .models import Room, PrivateRoom, Conversation, ChatMessage, ReadState, UserProfile
 
 admin.site.register(Room)
-admin.site.register(Message)
 admin.site.register(PrivateRoom)
-admin.site.register(PrivateChatMessage)
-admin.site.register(UserProfile)
\ No newline at end of file
+admin.site.register(Conversation)
+admin.site.register(ChatMessage)
+admin.site.register(ReadState)
+admin.site.register(UserProfile)
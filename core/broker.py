@@ -0,0 +1,246 @@
+# core/broker.py
+# A small pure-Python message broker plus a channel layer that talks to it.
+# It behaves like channels_redis' pub/sub layer (messages for channels
+# nobody listens on are dropped, no persistence) and lets several Daphne or
+# test worker processes share groups without running Redis.
+#
+#   python manage.py run_broker 127.0.0.1:6390
+#   CHAT_CHANNEL_LAYER=local daphne chatapp.asgi:application
+#
+# Wire format is newline-delimited JSON; bytes values are base64 wrapped.
+#
+# Besides messaging it keeps named counters, Redis INCR style, which
+# core/sequences.py numbers chat messages with when workers share a layer.
+import asyncio
+import base64
+import itertools
+import json
+import uuid
+
+from channels.layers import BaseChannelLayer
+
+LINE_LIMIT = 4 * 1024 * 1024
+# A client whose socket buffer grows past this is too slow to keep up;
+# further deliveries to it are dropped until it drains.
+MAX_CLIENT_BUFFER = 8 * 1024 * 1024
+
+
+def _default(obj):
+    if isinstance(obj, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(obj).decode('ascii')}
+    raise TypeError(f"Cannot send {type(obj).__name__} through the broker")
+
+
+def _object_hook(obj):
+    if len(obj) == 1 and '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+def encode(op):
+    return json.dumps(op, default=_default, separators=(',', ':')).encode() + b'\n'
+
+
+def decode(line):
+    return json.loads(line, object_hook=_object_hook)
+
+
+class Broker:
+    def __init__(self):
+        self.listeners = {}  # channel -> client writer
+        self.groups = {}     # group -> set of channels
+        self.counters = {}   # key -> last value handed out
+        self.dropped = 0
+
+    async def handle_client(self, reader, writer):
+        owned = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                op = decode(line)
+                kind = op['op']
+                if kind == 'listen':
+                    self.listeners[op['channel']] = writer
+                    owned.add(op['channel'])
+                elif kind == 'unlisten':
+                    self._forget(op['channel'])
+                    owned.discard(op['channel'])
+                elif kind == 'send':
+                    self._deliver([op['channel']], op['message'])
+                elif kind == 'group_add':
+                    self.groups.setdefault(op['group'], set()).add(op['channel'])
+                elif kind == 'group_discard':
+                    self._discard(op['group'], op['channel'])
+                elif kind == 'group_send':
+                    self._deliver(self.groups.get(op['group'], ()), op['message'])
+                elif kind == 'incr':
+                    value = self.counters[op['key']] = max(self.counters.get(op['key'], 0), op['floor']) + 1
+                    writer.write(encode({'op': 'reply', 'id': op['id'], 'value': value}))
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Client went away, or the server is shutting down.
+            pass
+        finally:
+            for channel in owned:
+                self._forget(channel)
+            writer.close()
+
+    def _discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.groups[group]
+
+    def _forget(self, channel):
+        self.listeners.pop(channel, None)
+        for group in [g for g, members in self.groups.items() if channel in members]:
+            self._discard(group, channel)
+
+    def _deliver(self, channels, message):
+        # Encode once per client connection, not once per channel: a worker
+        # holding 500 members of a group gets a single frame naming all 500.
+        by_client = {}
+        for channel in channels:
+            writer = self.listeners.get(channel)
+            if writer is not None:
+                by_client.setdefault(writer, []).append(channel)
+        for writer, targets in by_client.items():
+            if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                self.dropped += len(targets)
+                continue
+            writer.write(encode({'op': 'message', 'channels': targets, 'message': message}))
+
+
+async def serve(host='127.0.0.1', port=6390):
+    """Start a broker; pass port=0 to bind an ephemeral port (tests)."""
+    broker = Broker()
+    server = await asyncio.start_server(broker.handle_client, host, port, limit=LINE_LIMIT)
+    server.broker = broker
+    return server
+
+
+class BrokerChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, address='127.0.0.1:6390', expiry=60, capacity=100, channel_capacity=None):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        host, port = address.rsplit(':', 1)
+        self.host = host
+        self.port = int(port)
+        self.client_prefix = uuid.uuid4().hex
+        self.queues = {}
+        self._loop = None
+        self._lock = None
+        self._writer = None
+        self._reader_task = None
+        self._replies = {}   # request id -> future
+        self._requests = itertools.count(1)
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._writer = None
+            self._replies = {}
+        async with self._lock:
+            if self._writer is None or self._writer.is_closing():
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=LINE_LIMIT)
+                # Re-register listeners after a reconnect.
+                for channel in self.queues:
+                    writer.write(encode({'op': 'listen', 'channel': channel}))
+                self._writer = writer
+                self._reader_task = loop.create_task(self._read_loop(reader))
+        return self._writer
+
+    async def _read_loop(self, reader):
+        try:
+            await self._read(reader)
+        finally:
+            replies, self._replies = self._replies, {}
+            for future in replies.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost the connection to the broker"))
+
+    async def _read(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            op = decode(line)
+            if op['op'] == 'reply':
+                future = self._replies.pop(op['id'], None)
+                if future is not None and not future.done():
+                    future.set_result(op['value'])
+                continue
+            for channel in op['channels']:
+                queue = self.queues.get(channel)
+                if queue is not None and queue.qsize() < self.get_capacity(channel):
+                    queue.put_nowait(op['message'])
+
+    async def _send_op(self, op):
+        writer = await self._connection()
+        writer.write(encode(op))
+
+    async def new_channel(self, prefix='specific'):
+        channel = f'{prefix}.{self.client_prefix}!{uuid.uuid4().hex}'
+        self.queues[channel] = asyncio.Queue()
+        await self._send_op({'op': 'listen', 'channel': channel})
+        return channel
+
+    async def receive(self, channel):
+        assert self.require_valid_channel_name(channel)
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = asyncio.Queue()
+            await self._send_op({'op': 'listen', 'channel': channel})
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # The consumer is shutting down; stop routing its messages here.
+            if self.queues.pop(channel, None) is not None and self._writer is not None:
+                self._writer.write(encode({'op': 'unlisten', 'channel': channel}))
+            raise
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.require_valid_channel_name(channel)
+        await self._send_op({'op': 'send', 'channel': channel, 'message': message})
+
+    async def group_add(self, group, channel):
+        assert self.require_valid_group_name(group)
+        assert self.require_valid_channel_name(channel)
+        await self._send_op({'op': 'group_add', 'group': group, 'channel': channel})
+
+    async def group_discard(self, group, channel):
+        assert self.require_valid_group_name(group)
+        assert self.require_valid_channel_name(channel)
+        await self._send_op({'op': 'group_discard', 'group': group, 'channel': channel})
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.require_valid_group_name(group)
+        await self._send_op({'op': 'group_send', 'group': group, 'message': message})
+
+    async def incr(self, key, floor=0):
+        """Bump the counter `key` to at least floor + 1; returns the new value."""
+        writer = await self._connection()
+        request = next(self._requests)
+        future = self._replies[request] = self._loop.create_future()
+        writer.write(encode({'op': 'incr', 'key': key, 'floor': floor, 'id': request}))
+        return await future
+
+    async def flush(self):
+        self.queues.clear()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+    async def close(self):
+        await self.flush()
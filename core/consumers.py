@@ -1,238 +1,397 @@
-import json
+import asyncio
+from collections import deque
+from urllib.parse import parse_qs
+
+from channels.consumer import get_handler_name
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.text import slugify
-from django.contrib.auth.models import User
-from .models import UserProfile, ChatMessage, Room, Message
-
+from . import history, metrics
+from .db import DatabaseBusy, database
+from .frames import TextCodec, dumps, frame_event, negotiate
+from .models import ChatMessage, Conversation
+from .persistence import writer
+from .presence import presence, GROUP as PRESENCE_GROUP
+from .ratelimit import DISCONNECT, DROP, RateLimiter
+from .receipts import receipts
+from .recent import recent
+from .sequences import sequences
+from .typing_indicator import TypingIndicator
+
+
+# Close code for sockets cut off by flood protection (4000-4999 are ours).
+CLOSE_RATE_LIMITED = 4008
+# "Try again later": the database is too busy to serve this socket.
+CLOSE_BUSY = 1013
+# Frame types the chat consumers handle; anything else is a chat message.
+FRAME_TYPES = {'heartbeat', 'typing', 'stop_typing', 'history', 'read'}
+
+
+class RateLimitedConsumer(AsyncWebsocketConsumer):
+    """
+    Speaks the wire format the client negotiated (core/frames.py) and
+    checks every incoming frame against the socket's RateLimiter before
+    handing it to handle_frame(). Frames held back by the 'delay' policy
+    wait in one queue drained by a single task, so they keep their order,
+    later frames wait behind them, and closing the socket cancels them all.
+    """
+    codec = TextCodec()
+    limiter = None
+    _delayed = None   # (deadline, data, msg_type) of frames held back, in order
+    _drainer = None   # task handling _delayed
+
+    async def dispatch(self, message):
+        # Channels closes stale DB connections before every handler, which
+        # is a hop to the database thread per frame and per group event:
+        # every delivery in the worker queued behind whatever query or
+        # flush was running. DB access here goes through core.db instead,
+        # which recycles stale connections before each query.
+        handler = getattr(self, get_handler_name(message), None)
+        if handler is None:
+            raise ValueError("No handler for message type %s" % message["type"])
+        await handler(message)
+
+    async def accept(self, subprotocol=None, headers=None):
+        self.codec = negotiate(self.scope.get('subprotocols') or [])
+        await super().accept(subprotocol=self.codec.subprotocol, headers=headers)
+
+    async def send_frame(self, text):
+        await self.send(**self.codec.encode(text))
+
+    def start_limiting(self, user_id):
+        self.limiter = RateLimiter(user_id)
+
+    def stop_limiting(self):
+        if self.limiter is not None:
+            self.limiter.close()
+            self.limiter = None
+        if self._drainer is not None:
+            self._drainer.cancel()
+            self._drainer = None
+        self._delayed = None
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.limiter is None:
+            return
+        raw = text_data if text_data is not None else bytes_data
+        if raw is None or len(raw) > getattr(settings, 'CHAT_MAX_FRAME_SIZE', 16 * 1024):
+            metrics.incr('ratelimit.oversized')
+            await self.close(code=CLOSE_RATE_LIMITED)
+            return
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+            msg_type = data.get('type', 'chat')
+        except (ValueError, AttributeError):
+            data, msg_type = None, 'default'
+        else:
+            if not isinstance(msg_type, str) or msg_type not in FRAME_TYPES:
+                msg_type = 'chat'
+
+        verdict, delay = self.limiter.check(msg_type)
+        if verdict == DISCONNECT:
+            await self.close(code=CLOSE_RATE_LIMITED)
+            return
+        if verdict == DROP:
+            if msg_type == 'chat':
+                await self.send_frame(dumps({'type': 'error', 'error': 'rate_limited'}))
+            return
+        if data is None:
+            return
+        draining = self._drainer is not None and not self._drainer.done()
+        if delay or draining:
+            if self._delayed is None:
+                self._delayed = deque()
+            self._delayed.append((asyncio.get_running_loop().time() + delay, data, msg_type))
+            if not draining:
+                self._drainer = asyncio.ensure_future(self._drain())
+            return
+        await self.handle_frame(data, msg_type)
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while self._delayed:
+            deadline, data, msg_type = self._delayed[0]
+            await asyncio.sleep(deadline - loop.time())
+            self._delayed.popleft()
+            await self.handle_frame(data, msg_type)
+
+    async def handle_frame(self, data, msg_type):
+        raise NotImplementedError
+
+
+class BaseChatConsumer(RateLimitedConsumer):
+    conversation_id = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.typing = TypingIndicator(self.broadcast)
+
+    async def broadcast(self, payload):
+        # Encode once here; every member's chat_frame just forwards the text.
+        event = frame_event(payload)
+        if 'seq' in payload:
+            event['seq'] = payload['seq']
+        await self.channel_layer.group_send(self.room_group_name, event)
+
+    async def chat_frame(self, event):
+        if 'seq' in event:
+            recent.add(self.conversation_id, event['seq'], event['text'])
+        await self.send_frame(event['text'])
+
+    async def join_group(self):
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        recent.subscribe(self.conversation_id)
+
+    async def leave_group(self):
+        recent.unsubscribe(self.conversation_id)
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+    async def send_replay(self):
+        # A reconnecting client passes the last seq it rendered as ?since=
+        # and gets everything after it in one frame. The socket is in the
+        # group already, so nothing sent from here on can fall in between;
+        # the client drops duplicates by seq.
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            since = int(query['since'][0])
+        except (KeyError, ValueError):
+            return
+        frames = recent.after(self.conversation_id, since)
+        complete = True
+        if frames is not None:
+            metrics.incr('replay.buffer')
+        else:
+            metrics.incr('replay.db')
+            # Messages this process broadcast but has not written yet.
+            await writer.flush()
+            try:
+                async with database.slot():
+                    missed = await history.aafter(self.conversation_id, since)
+            except DatabaseBusy:
+                await self.close(code=CLOSE_BUSY)
+                return
+            frames = [dumps(message) for message in missed['messages']]
+            complete = missed['complete']
+        metrics.incr('replay.messages', len(frames))
+        await self.send_frame('{"type":"replay","complete":%s,"messages":[%s]}' % (
+            'true' if complete else 'false', ','.join(frames)))
+
+    async def send_history(self, data):
+        # Earlier messages are paged to this socket only (infinite scroll),
+        # instead of being rendered into the page.
+        try:
+            limit = int(data.get('limit') or history.PAGE_SIZE)
+            before = data.get('before')
+            page = history.from_cache(self.conversation_id, before, limit)
+            if page is None:
+                async with database.slot():
+                    page = await history.aload_page(self.conversation_id, before, limit)
+        except (TypeError, ValueError) as e:
+            await self.send_frame(dumps({'type': 'error', 'error': str(e)}))
+            return
+        except DatabaseBusy:
+            await self.send_frame(dumps({'type': 'error', 'error': 'busy'}))
+            return
+        await self.send_frame(history.encode_page(page, type='history'))
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        if self.scope["user"].is_authenticated:
-            await self.set_user_online(self.scope["user"])
+    def ack_read(self, data):
+        # Cumulative: "I have read everything up to seq".
+        try:
+            seq = int(data.get('seq'))
+        except (TypeError, ValueError):
+            return
+        if seq > 0:
+            receipts.ack(self.user_id, self.scope["user"].username, self.conversation_id, seq,
+                         self.room_group_name)
 
-        self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
-        safe_room_name = slugify(self.room_name)
-        self.room_group_name = f'chat_{safe_room_name}'
+    async def handle_frame(self, data, msg_type):
+        presence.heartbeat(self.channel_name, self.user_id, self.scope["user"].username)
 
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        if msg_type == 'heartbeat':
+            return
 
-        await self.accept()
+        elif msg_type == 'typing':
+            await self.typing.started(self.scope["user"])
+            return
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': f'{self.scope["user"].first_name} joined the chat.',
-                'username': 'System',
-                'name': 'System'
-            }
-        )
+        elif msg_type == 'stop_typing':
+            await self.typing.stopped()
+            return
 
-    async def disconnect(self, close_code):
-        if self.scope["user"].is_authenticated:
-            await self.set_user_offline(self.scope["user"])
-
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
-
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': f'{self.scope["user"].first_name} left the chat.',
-                'username': 'System',
-                'name': 'System'
-            }
-        )
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        msg_type = data.get('type', 'chat')
-
-        if msg_type == 'typing':
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'show_typing',
-                    'username': data['username'],
-                    'name': data['name'],
-                    # 'message': data['message']
-                }
-            )
+        elif msg_type == 'history':
+            await self.send_history(data)
             return
 
-        elif msg_type == 'stop_typing':
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'hide_typing',
-                    'username': data['username']
-                }
-            )
+        elif msg_type == 'read':
+            self.ack_read(data)
             return
 
         message = data.get('message')
-        username = data.get('username')
-        name = data.get('name', '')
-
-        if not message or not message.strip():
+        if not isinstance(message, str) or not message.strip():
             return
 
-        await self.save_message(username, self.room_name, message)
+        await self.send_chat_message(message)
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'username': username,
-                'name': data['name']
-            }
-        )
+    async def send_chat_message(self, message):
+        # Numbered before the broadcast so every member sees the seq the
+        # message will be stored under.
+        sender = self.scope["user"]
+        self.typing.reset()
+        try:
+            seq = await sequences.next(self.conversation_id)
+        except DatabaseBusy:
+            await self.send_frame(dumps({'type': 'error', 'error': 'busy'}))
+            return
 
-    async def show_typing(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'username': event['username'],
-            'name': event['name']
-        }))
+        await self.broadcast({
+            'message': message,
+            'username': sender.username,
+            'name': sender.first_name or sender.username,
+            'seq': seq,
+            'timestamp': timezone.now().isoformat(),
+        })
 
-    async def hide_typing(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'stop_typing',
-            'username': event['username']
-        }))
+        await writer.put(ChatMessage, conversation_id=self.conversation_id, seq=seq,
+                         sender_id=self.user_id, content=message)
 
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'message': event['message'],
-            'username': event['username'],
-            'name': event['name']
-        }))
 
-    @database_sync_to_async
-    def set_user_online(self, user):
-        profile, _ = UserProfile.objects.get_or_create(user=user)
-        profile.is_online = True
-        profile.save()
-
-    @database_sync_to_async
-    def set_user_offline(self, user):
-        profile, _ = UserProfile.objects.get_or_create(user=user)
-        profile.is_online = False
-        profile.save()
-
-    @database_sync_to_async
-    def save_message(self, username, room_slug, message):
-        user = User.objects.get(username=username)
-        room = Room.objects.get(slug=room_slug)
-        Message.objects.create(user=user, room=room, content=message)
-
-class PrivateChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(BaseChatConsumer):
     async def connect(self):
-        self.room_slug = self.scope['url_route']['kwargs']['room_slug']
-        self.room_group_name = f"private_chat_{self.room_slug}"
+        self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
+        safe_room_name = slugify(self.room_name)
+        self.room_group_name = f'chat_{safe_room_name}'
+
+        # Sender and room are fixed for the life of the socket, so resolve
+        # them once here and write messages by id afterwards.
+        user = self.scope["user"]
+        if not user.is_authenticated:
+            await self.close()
+            return
+        try:
+            self.conversation_id = await self.get_conversation_id(self.room_name)
+        except DatabaseBusy:
+            await self.close(code=CLOSE_BUSY)
+            return
+        if self.conversation_id is None:
+            await self.close()
+            return
+        self.user_id = user.id
+        self.start_limiting(self.user_id)
 
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        presence.connect(self.user_id, self.channel_name, user.username)
+
+        await self.join_group()
 
         await self.accept()
 
+        await self.send_replay()
+
+        await self.broadcast({
+            'message': f'{self.scope["user"].first_name} joined the chat.',
+            'username': 'System',
+            'name': 'System'
+        })
+
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        msg_type = data.get('type', 'chat')
-
-        if msg_type == 'typing':
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'show_typing',
-                    'username': data['username'],
-                    'name': data['name']
-                }
-            )
+        if self.conversation_id is None:
             return
 
-        elif msg_type == 'stop_typing':
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'hide_typing',
-                    'username': data['username']
-                }
-            )
-            return
+        self.stop_limiting()
+        await self.typing.close()
+        presence.disconnect(self.channel_name)
 
-        message = data.get('message')
-        username = data.get('username')
-        name = data.get('name', '')
-        if not message or not message.strip():
+        await self.leave_group()
+
+        await self.broadcast({
+            'message': f'{self.scope["user"].first_name} left the chat.',
+            'username': 'System',
+            'name': 'System'
+        })
+
+    async def get_conversation_id(self, slug):
+        async with database.slot():
+            return await Conversation.objects.filter(room__slug=slug).values_list('id', flat=True).afirst()
+
+
+class PrivateChatConsumer(BaseChatConsumer):
+    async def connect(self):
+        self.room_slug = self.scope['url_route']['kwargs']['room_slug']
+        self.room_group_name = f"private_chat_{self.room_slug}"
+
+        user = self.scope["user"]
+        if not user.is_authenticated:
+            await self.close()
+            return
+        try:
+            self.conversation_id = await self.get_conversation_id(self.room_slug, user)
+        except DatabaseBusy:
+            await self.close(code=CLOSE_BUSY)
             return
+        if self.conversation_id is None:
+            await self.close()
+            return
+        self.user_id = user.id
+        self.start_limiting(self.user_id)
 
-        sender = self.scope["user"]
+        presence.connect(self.user_id, self.channel_name, user.username)
 
-        await self.save_message(sender.username, self.room_slug, message)
-
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "message": message,
-                "username": sender.username,
-                "name": sender.first_name or sender.username,
-            }
-        )
-
-    async def show_typing(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'username': event['username'],
-            'name': event['name']
-        }))
+        await self.join_group()
 
-    async def hide_typing(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'stop_typing',
-            'username': event['username']
-        }))
+        await self.accept()
 
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            "message": event["message"],
-            "username": event["username"],
-            "name": event["name"],
-        }))
+        await self.send_replay()
+
+    async def disconnect(self, close_code):
+        if self.conversation_id is None:
+            return
+
+        self.stop_limiting()
+        await self.typing.close()
+        presence.disconnect(self.channel_name)
+
+        await self.leave_group()
 
     async def send_system_message(self, message):
-        await self.send(text_data=json.dumps({
+        await self.send_frame(dumps({
             "message": message,
             "username": "System",
             "name": "System",
         }))
 
-    @database_sync_to_async
-    def save_message(self, sender_username, room_slug, message):
-        from django.contrib.auth import get_user_model
-        from .models import PrivateChatMessage, PrivateRoom
+    async def get_conversation_id(self, slug, user):
+        # Only the two participants may join a private room.
+        async with database.slot():
+            return await Conversation.objects.filter(
+                Q(private_room__user1=user) | Q(private_room__user2=user), private_room__room_slug=slug
+            ).values_list('id', flat=True).afirst()
 
-        User = get_user_model()
-        try:
-            sender = User.objects.get(username=sender_username)
-            room = PrivateRoom.objects.get(room_slug=room_slug)
-            PrivateChatMessage.objects.create(sender=sender, room=room, content=message)
-        except Exception as e:
-            print("Error saving private message:", e)
\ No newline at end of file
+
+class PresenceConsumer(RateLimitedConsumer):
+    """Pushes batched online/offline deltas; the socket itself counts as presence."""
+
+    async def connect(self):
+        user = self.scope["user"]
+        if not user.is_authenticated:
+            await self.close()
+            return
+        self.connected = True
+        self.start_limiting(user.id)
+        presence.connect(user.id, self.channel_name, user.username)
+        await self.channel_layer.group_add(PRESENCE_GROUP, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if not getattr(self, 'connected', False):
+            return
+        self.stop_limiting()
+        presence.disconnect(self.channel_name)
+        await self.channel_layer.group_discard(PRESENCE_GROUP, self.channel_name)
+
+    async def handle_frame(self, data, msg_type):
+        user = self.scope["user"]
+        presence.heartbeat(self.channel_name, user.id, user.username)
+
+    async def chat_frame(self, event):
+        await self.send_frame(event['text'])
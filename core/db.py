@@ -0,0 +1,111 @@
+# core/db.py
+# Database access from async code. Django's async ORM methods (afirst,
+# acreate, async iteration, ...) and database_sync_to_async both hand the
+# query to asgiref's thread-sensitive executor, so a worker runs one query
+# at a time on one thread however many sockets are waiting on it. That
+# thread is also where the write-behind flushes run, so anything queued
+# for it waits behind them; the consumers therefore only go there for
+# real queries (see RateLimitedConsumer.dispatch). Channels' dispatch
+# would close stale connections before every handler; slot() does it
+# before every query instead, on the same thread.
+#
+# At most CHAT_DB_CONCURRENCY coroutines hold a slot at once and the rest
+# wait in FIFO order. A caller that waits longer than CHAT_DB_TIMEOUT
+# seconds gets DatabaseBusy, so a burst of connects is shed (close code
+# 1013, "try again later") rather than piling up behind a slow database.
+#
+# Async ORM calls keep the thread's connection between queries, where
+# database_sync_to_async closes it around every call unless CONN_MAX_AGE
+# is set. Reads written as plain synchronous ORM code go through run(),
+# which is database_sync_to_async under the same limit: the shared-layer
+# sequence allocator reads its floor that way (core/sequences.py).
+#
+# Writes from async code (message flushes, sequence leases, read state,
+# presence) go through write() instead: one dedicated thread with its own
+# connection runs them one at a time, in order. They no longer hold up
+# reads queued on the shared thread, and a worker never has two of its
+# own connections competing for SQLite's write lock.
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from channels.db import aclose_old_connections, database_sync_to_async
+from django.conf import settings
+from django.db import connection
+
+from . import metrics
+
+
+class DatabaseBusy(Exception):
+    pass
+
+
+class DatabaseLimiter:
+    def __init__(self, concurrency=8, timeout=5.0):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.in_flight = 0
+        self._loop = None
+        self._semaphore = None
+        self._writer = None
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self.in_flight = 0
+        return self._semaphore
+
+    @asynccontextmanager
+    async def slot(self):
+        semaphore = self._bind_loop()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            metrics.incr('db.busy')
+            raise DatabaseBusy()
+        metrics.observe('db.wait', time.perf_counter() - started)
+        self.in_flight += 1
+        metrics.set_gauge('db.in_flight', self.in_flight)
+        try:
+            # Past CONN_MAX_AGE or broken by an earlier error.
+            await aclose_old_connections()
+            yield
+        finally:
+            self.in_flight -= 1
+            semaphore.release()
+
+    async def run(self, fn, *args, **kwargs):
+        async with self.slot():
+            return await database_sync_to_async(fn)(*args, **kwargs)
+
+    async def write(self, fn, *args, **kwargs):
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._writer, functools.partial(_write, fn, *args, **kwargs),
+            )
+        finally:
+            metrics.observe('db.write', time.perf_counter() - started)
+
+
+def _write(fn, *args, **kwargs):
+    # The writer thread keeps its connection open, except after a failure
+    # that may have left it unusable.
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        connection.close()
+        raise
+
+
+database = DatabaseLimiter(
+    concurrency=getattr(settings, 'CHAT_DB_CONCURRENCY', 8),
+    timeout=getattr(settings, 'CHAT_DB_TIMEOUT', 5.0),
+)
@@ -0,0 +1,97 @@
+# core/export.py
+# Streaming export of a conversation's history as JSON Lines or CSV.
+# Messages are read oldest first in batches of CHAT_EXPORT_CHUNK_SIZE,
+# each batch encoded and handed on before the next is read, so memory
+# stays flat however long the history is.
+#
+# The batches are keyset queries along the (conversation, seq) index, like
+# history pages, rather than one .iterator() cursor: on SQLite an open
+# cursor holds the read lock for the whole download, and with the rollback
+# journal that stalls the message writer until the client has finished.
+#
+# Django buffers a StreamingHttpResponse whose iterator does not match
+# the server (sync under WSGI, async under ASGI), so there is one of each.
+import csv
+import io
+
+from django.conf import settings
+
+from .db import database
+from .frames import dumps
+from .history import serialize
+from .models import ChatMessage
+
+CHUNK_SIZE = getattr(settings, 'CHAT_EXPORT_CHUNK_SIZE', 2000)
+CSV_HEADER = ('seq', 'timestamp', 'username', 'name', 'message')
+
+
+def _batch_query(conversation_id, after, size):
+    return ChatMessage.objects.filter(conversation_id=conversation_id, seq__gt=after).order_by('seq').values(
+        'id', 'seq', 'content', 'timestamp', 'sender__username', 'sender__first_name',
+    )[:size]
+
+
+def batches(conversation_id, size=CHUNK_SIZE):
+    after = 0
+    while True:
+        rows = list(_batch_query(conversation_id, after, size))
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        after = rows[-1]['seq']
+
+
+async def abatches(conversation_id, size=CHUNK_SIZE):
+    after = 0
+    while True:
+        async with database.slot():
+            rows = [row async for row in _batch_query(conversation_id, after, size)]
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        after = rows[-1]['seq']
+
+
+def encode_jsonl(rows):
+    return ''.join(dumps(serialize(row)) + '\n' for row in rows)
+
+
+def encode_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        (row['seq'], row['timestamp'].isoformat(), row['sender__username'],
+         row['sender__first_name'] or row['sender__username'], row['content'])
+        for row in rows
+    )
+    return buffer.getvalue()
+
+
+def _csv_header():
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(CSV_HEADER)
+    return buffer.getvalue()
+
+
+# format -> (content type, header, batch encoder)
+FORMATS = {
+    'jsonl': ('application/x-ndjson', '', encode_jsonl),
+    'csv': ('text/csv; charset=utf-8', _csv_header(), encode_csv),
+}
+
+
+def stream(conversation_id, fmt, size=CHUNK_SIZE):
+    _, header, encode = FORMATS[fmt]
+    if header:
+        yield header
+    for rows in batches(conversation_id, size):
+        yield encode(rows)
+
+
+async def astream(conversation_id, fmt, size=CHUNK_SIZE):
+    _, header, encode = FORMATS[fmt]
+    if header:
+        yield header
+    async for rows in abatches(conversation_id, size):
+        yield encode(rows)
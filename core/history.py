@@ -0,0 +1,125 @@
+# core/history.py
+# Keyset ("cursor") pagination over chat history. Pages are read newest
+# first along the unique (conversation, seq) index, so fetching any page
+# costs O(page size) no matter how deep into the history it is. The cursor
+# is the sequence number of the oldest message already shown.
+from .frames import dumps
+from .models import ChatMessage
+from .persistence import writer
+from .recent import recent
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def decode_cursor(cursor):
+    try:
+        seq = int(cursor)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid history cursor')
+    if seq < 1:
+        raise ValueError('Invalid history cursor')
+    return seq
+
+
+def _page_query(conversation_id, before, limit):
+    queryset = ChatMessage.objects.filter(conversation_id=conversation_id)
+    if before:
+        queryset = queryset.filter(seq__lt=decode_cursor(before))
+    return queryset.order_by('-seq').values(
+        'id', 'seq', 'content', 'timestamp', 'sender__username', 'sender__first_name',
+    )[:limit + 1]
+
+
+def _page_result(rows, limit):
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        # Oldest first, the order the chat box renders in.
+        'messages': [serialize(row) for row in reversed(rows)],
+        'next': str(rows[-1]['seq']) if has_more else None,
+    }
+
+
+def page(conversation_id, before=None, limit=PAGE_SIZE):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return _page_result(list(_page_query(conversation_id, before, limit)), limit)
+
+
+async def apage(conversation_id, before=None, limit=PAGE_SIZE):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return _page_result([row async for row in _page_query(conversation_id, before, limit)], limit)
+
+
+def cached_page(conversation_id, before=None, limit=PAGE_SIZE):
+    """
+    page() served from the recent-message buffers when they hold the
+    requested messages. Returns the messages as encoded frames, for
+    encode_page().
+    """
+    return from_cache(conversation_id, before, limit) or load_page(conversation_id, before, limit)
+
+
+def from_cache(conversation_id, before=None, limit=PAGE_SIZE):
+    # Needs no DB, so the consumers call it on the event loop directly.
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return recent.page(conversation_id, decode_cursor(before) if before else None, limit)
+
+
+def load_page(conversation_id, before=None, limit=PAGE_SIZE):
+    return _cache_page(conversation_id, before, page(conversation_id, before, limit))
+
+
+async def aload_page(conversation_id, before=None, limit=PAGE_SIZE):
+    return _cache_page(conversation_id, before, await apage(conversation_id, before, limit))
+
+
+def _cache_page(conversation_id, before, result):
+    # A miss on the latest page fills the buffer, unless messages for the
+    # conversation are still waiting to be written.
+    items = [(message['seq'], dumps(message)) for message in result['messages']]
+    if not before and items and not writer.has_pending(conversation_id):
+        recent.fill(conversation_id, items, 0 if result['next'] is None else items[0][0] - 1)
+    return {'frames': [text for _, text in items], 'next': result['next']}
+
+
+def encode_page(page, **fields):
+    """A cached_page() as JSON text, with extra top-level fields first."""
+    head = ''.join(f'{dumps(key)}:{dumps(value)},' for key, value in fields.items())
+    return '{%s"messages":[%s],"next":%s}' % (head, ','.join(page['frames']), dumps(page['next']))
+
+
+def after(conversation_id, seq, limit=MAX_PAGE_SIZE):
+    """
+    Messages after seq for a resuming socket, oldest first. If more than
+    `limit` were missed only the newest are returned and complete is False.
+    """
+    return _after_result(list(_after_query(conversation_id, seq, limit)), limit)
+
+
+async def aafter(conversation_id, seq, limit=MAX_PAGE_SIZE):
+    return _after_result([row async for row in _after_query(conversation_id, seq, limit)], limit)
+
+
+def _after_query(conversation_id, seq, limit):
+    return ChatMessage.objects.filter(conversation_id=conversation_id, seq__gt=seq).order_by('-seq').values(
+        'id', 'seq', 'content', 'timestamp', 'sender__username', 'sender__first_name',
+    )[:limit + 1]
+
+
+def _after_result(rows, limit):
+    return {
+        'messages': [serialize(row) for row in reversed(rows[:limit])],
+        'complete': len(rows) <= limit,
+    }
+
+
+def serialize(row):
+    return {
+        'id': row['id'],
+        'seq': row['seq'],
+        'message': row['content'],
+        'username': row['sender__username'],
+        'name': row['sender__first_name'] or row['sender__username'],
+        'timestamp': row['timestamp'].isoformat(),
+    }
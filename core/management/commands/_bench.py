@@ -0,0 +1,44 @@
+# Shared helpers for the bench_* management commands.
+import json
+import os
+
+# CHAT_RATE_LIMITS for benchmarks: nothing is dropped or delayed.
+UNLIMITED = {kind: {'rate': 1e9, 'burst': 1e9, 'policy': 'drop'}
+             for kind in ('chat', 'typing', 'stop_typing', 'history', 'read', 'heartbeat', 'default')}
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def latency_summary(seconds):
+    """p50/p95/p99/max in milliseconds for a list of latencies in seconds."""
+    ms = [s * 1000 for s in seconds]
+    return {
+        'count': len(ms),
+        'p50_ms': percentile(ms, 50),
+        'p95_ms': percentile(ms, 95),
+        'p99_ms': percentile(ms, 99),
+        'max_ms': max(ms) if ms else None,
+    }
+
+
+def write_report(command, report, json_path=None):
+    if json_path:
+        with open(json_path, 'w') as fh:
+            json.dump(report, fh, indent=2)
+        command.stdout.write(f"Wrote {json_path}")
+    command.stdout.write(json.dumps(report, indent=2))
+
+
+def rss_bytes(pid='self'):
+    """Resident memory of a process, from /proc; None where there is no /proc."""
+    try:
+        with open(f'/proc/{pid}/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
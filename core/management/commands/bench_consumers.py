@@ -0,0 +1,106 @@
+"""
+Consumer throughput in one worker process.
+
+Opens --clients private chat sockets at once (a connect burst: each one
+looks up its conversation and replays history with ?since=0), then has
+every socket send --messages chat messages and waits until each has
+received its own messages back. Reports connect latency, connects per
+second and delivered messages per second, after one warm-up message per
+socket. Rate limits are lifted for the run:
+
+    python manage.py bench_consumers --clients 200 --messages 50
+"""
+import asyncio
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from core.consumers import PrivateChatConsumer
+from core.models import PrivateRoom
+from core.persistence import writer
+
+from ._bench import UNLIMITED, latency_summary, write_report
+
+PREFIX = 'bc'
+
+
+class Command(BaseCommand):
+    help = "Benchmark connects and messages per second through the chat consumers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=200)
+        parser.add_argument('--messages', type=int, default=50)
+        parser.add_argument('--timeout', type=float, default=60.0)
+        parser.add_argument('--json', dest='json_path')
+
+    def handle(self, *args, **options):
+        rooms = self.prepare(options['clients'])
+        with override_settings(CHAT_RATE_LIMITS=UNLIMITED):
+            report = asyncio.run(self.run(rooms, options['messages'], options['timeout']))
+        write_report(self, report, options['json_path'])
+
+    def prepare(self, count):
+        partner, _ = User.objects.get_or_create(username=f'{PREFIX}_partner')
+        rooms = []
+        for i in range(count):
+            user, _ = User.objects.get_or_create(username=f'{PREFIX}_{i}', defaults={'first_name': f'Bench {i}'})
+            room = PrivateRoom.objects.filter(user1=user, user2=partner).first()
+            if room is None:
+                room = PrivateRoom.objects.create(user1=user, user2=partner)
+            rooms.append((user, room.room_slug))
+        return rooms
+
+    async def run(self, rooms, messages, timeout):
+        application = PrivateChatConsumer.as_asgi()
+        communicators = []
+        for user, slug in rooms:
+            communicator = WebsocketCommunicator(application, f'/ws/private/{slug}/?since=0')
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'room_slug': slug}}
+            communicators.append(communicator)
+
+        async def connect(communicator):
+            started = time.perf_counter()
+            connected, _ = await communicator.connect(timeout=timeout)
+            await communicator.receive_from(timeout=timeout)   # the replay frame
+            return connected, time.perf_counter() - started
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(connect(c) for c in communicators))
+        connect_seconds = time.perf_counter() - started
+
+        async def chat(communicator, messages):
+            for i in range(messages):
+                await communicator.send_json_to({'message': f'message {i}'})
+            received = 0
+            while received < messages:
+                await communicator.receive_from(timeout=timeout)
+                received += 1
+            return received
+
+        # One message each first, so every conversation has leased its
+        # sequence numbers before the timed run.
+        await asyncio.gather(*(chat(c, 1) for c in communicators))
+        await writer.flush()
+
+        started = time.perf_counter()
+        delivered = sum(await asyncio.gather(*(chat(c, messages) for c in communicators)))
+        message_seconds = time.perf_counter() - started
+
+        await writer.flush()
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        return {
+            'clients': len(rooms),
+            'connected': sum(1 for ok, _ in results if ok),
+            'connect_seconds': round(connect_seconds, 3),
+            'connects_per_second': round(len(rooms) / connect_seconds, 1),
+            'connect_latency': latency_summary([seconds for _, seconds in results]),
+            'messages_delivered': delivered,
+            'message_seconds': round(message_seconds, 3),
+            'messages_per_second': round(delivered / message_seconds, 1),
+        }
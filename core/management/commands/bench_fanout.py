@@ -0,0 +1,152 @@
+"""
+Multi-process group fan-out benchmark for the local broker channel layer.
+
+Starts a core.broker instance, spawns --workers processes that each connect
+--clients websocket consumers to one group, then group_sends --messages
+frames from this process and measures send-to-delivery latency in every
+worker:
+
+    python manage.py bench_fanout --workers 4 --clients 50 --messages 200 --rate 20
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.broker import BrokerChannelLayer, serve
+
+from ._bench import latency_summary, write_report
+
+GROUP = 'bench_fanout'
+
+
+def _start_broker():
+    ready = threading.Event()
+    state = {}
+
+    def run():
+        async def main():
+            server = await serve('127.0.0.1', 0)
+            state['port'] = server.sockets[0].getsockname()[1]
+            state['server'] = server
+            ready.set()
+            await server.serve_forever()
+        try:
+            asyncio.run(main())
+        except asyncio.CancelledError:
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return f"127.0.0.1:{state['port']}", state['server']
+
+
+def _worker(address, clients, expected, timeout, ready, results):
+    os.environ['CHAT_CHANNEL_LAYER'] = 'local'
+    os.environ['CHAT_BROKER_ADDRESS'] = address
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatapp.settings')
+    import django
+    django.setup()
+    results.put(asyncio.run(_run_worker(clients, expected, timeout, ready)))
+
+
+async def _run_worker(clients, expected, timeout, ready):
+    from channels.generic.websocket import AsyncWebsocketConsumer
+    from channels.testing import WebsocketCommunicator
+
+    class FanoutProbe(AsyncWebsocketConsumer):
+        groups = [GROUP]
+
+        async def bench_message(self, event):
+            await self.send(text_data=event['text'])
+
+    application = FanoutProbe.as_asgi()
+    communicators = []
+    for _ in range(clients):
+        communicator = WebsocketCommunicator(application, '/bench/')
+        await communicator.connect()
+        communicators.append(communicator)
+    ready.put(os.getpid())
+
+    latencies = []
+
+    async def drain(communicator):
+        for _ in range(expected):
+            try:
+                text = await communicator.receive_from(timeout=timeout)
+            except asyncio.TimeoutError:
+                return
+            latencies.append(time.time() - json.loads(text)['sent_at'])
+
+    await asyncio.gather(*(drain(c) for c in communicators))
+    for communicator in communicators:
+        await communicator.disconnect()
+    return latencies
+
+
+class Command(BaseCommand):
+    help = "Benchmark group fan-out across several worker processes via the local broker."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--clients', type=int, default=50, help="Consumers per worker process.")
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--rate', type=float, default=20.0, help="group_send calls per second.")
+        parser.add_argument('--timeout', type=float, default=10.0)
+        parser.add_argument('--json', dest='json_path')
+
+    def handle(self, *args, **options):
+        address, _ = _start_broker()
+        ctx = multiprocessing.get_context('spawn')
+        ready = ctx.Queue()
+        results = ctx.Queue()
+        processes = [
+            ctx.Process(target=_worker, args=(
+                address, options['clients'], options['messages'], options['timeout'], ready, results,
+            ))
+            for _ in range(options['workers'])
+        ]
+        for process in processes:
+            process.start()
+        for _ in processes:
+            ready.get(timeout=60)
+
+        started = time.perf_counter()
+        asyncio.run(self._send(address, options['messages'], options['rate']))
+        sent_in = time.perf_counter() - started
+
+        latencies = []
+        for _ in processes:
+            latencies.extend(results.get(timeout=options['timeout'] + 60))
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join()
+
+        expected = options['workers'] * options['clients'] * options['messages']
+        report = {
+            'workers': options['workers'],
+            'clients_per_worker': options['clients'],
+            'messages': options['messages'],
+            'expected_deliveries': expected,
+            'deliveries': len(latencies),
+            'send_seconds': round(sent_in, 3),
+            'deliveries_per_second': round(len(latencies) / elapsed, 1),
+            'latency': latency_summary(latencies),
+        }
+        write_report(self, report, options['json_path'])
+
+    async def _send(self, address, messages, rate):
+        layer = BrokerChannelLayer(address)
+        interval = 1.0 / rate if rate > 0 else 0
+        for seq in range(messages):
+            await layer.group_send(GROUP, {
+                'type': 'bench.message',
+                'text': json.dumps({'seq': seq, 'sent_at': time.time()}),
+            })
+            if interval:
+                await asyncio.sleep(interval)
+        await layer.close()
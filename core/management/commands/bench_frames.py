@@ -0,0 +1,105 @@
+"""
+Bytes on the wire and encode cost per wire format.
+
+Replays a seeded stream of chat frames (a few rooms' worth of usernames
+and short messages, with the occasional typing frame) through each codec
+in core.frames and reports average bytes per frame and encode time per
+frame per recipient. "json_deflate_per_message" is plain JSON compressed
+one frame at a time without shared context, which is roughly what
+permessage-deflate without context takeover gives:
+
+    python manage.py bench_frames --frames 5000 --members 50
+"""
+import random
+import time
+import zlib
+
+from django.core.management.base import BaseCommand
+
+from core import frames
+
+from ._bench import write_report
+
+USERNAMES = ['aarav', 'aditi', 'arjun', 'diya', 'harsh', 'isha', 'kabir', 'meera', 'neha', 'priya']
+WORDS = ('the a to is it you that and of in for on are with be this have i was not what '
+         'meeting tomorrow lunch deploy build broken fixed thanks ok sure later tonight').split()
+
+
+def sample_frames(count, rng):
+    seq = 0
+    out = []
+    for _ in range(count):
+        username = rng.choice(USERNAMES)
+        if rng.random() < 0.2:
+            out.append(frames.dumps({'type': 'typing', 'username': username, 'name': username.title()}))
+            continue
+        seq += 1
+        out.append(frames.dumps({
+            'message': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 20))),
+            'username': username,
+            'name': username.title(),
+            'seq': seq,
+            'timestamp': f'2026-10-18T12:{seq // 60 % 60:02d}:{seq % 60:02d}.{rng.randint(0, 999999):06d}+00:00',
+        }))
+    return out
+
+
+def _size(sent):
+    return len(sent.get('bytes_data') or sent['text_data'].encode())
+
+
+class Command(BaseCommand):
+    help = "Compare websocket wire formats by bytes per frame and encode cost."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--frames', type=int, default=5000)
+        parser.add_argument('--members', type=int, default=50,
+                            help="Sockets each frame is sent to; shared encodings are paid once.")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--json', dest='json_path')
+
+    def handle(self, *args, **options):
+        texts = sample_frames(options['frames'], random.Random(options['seed']))
+        members = options['members']
+        rows = []
+
+        codecs = [('json', frames.TextCodec)] + sorted(frames.CODECS.items())
+        for name, codec_class in codecs:
+            codecs_per_member = [codec_class() for _ in range(members)]
+            total = 0
+            started = time.perf_counter()
+            for text in texts:
+                for codec in codecs_per_member:
+                    sent = codec.encode(text)
+                total += _size(sent)
+            elapsed = time.perf_counter() - started
+            rows.append(self.row(name or 'json', total, elapsed, len(texts), members))
+
+        started = time.perf_counter()
+        total = 0
+        for text in texts:
+            data = text.encode()
+            for _ in range(members):
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                sent = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            total += len(sent)
+        rows.append(self.row('json_deflate_per_message', total, time.perf_counter() - started,
+                             len(texts), members))
+
+        baseline = rows[0]['bytes_per_frame']
+        for row in rows:
+            row['vs_json'] = round(row['bytes_per_frame'] / baseline, 3)
+        report = {
+            'frames': len(texts),
+            'members': members,
+            'msgpack': frames.msgpack is not None,
+            'results': rows,
+        }
+        write_report(self, report, options['json_path'])
+
+    def row(self, name, total, elapsed, count, members):
+        return {
+            'format': name,
+            'bytes_per_frame': round(total / count, 1),
+            'encode_us_per_recipient': round(elapsed / (count * members) * 1e6, 3),
+        }
@@ -0,0 +1,91 @@
+"""
+History page latency against depth, keyset vs. OFFSET pagination.
+
+Fills a dedicated room with --messages rows (reused across runs), then
+times fetching one page at increasing depths:
+
+    python manage.py bench_history --messages 1000000
+"""
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core import history
+from core.models import ChatMessage, Room
+from core.sequences import lease
+
+from ._bench import write_report
+
+ROOM_NAME = 'bench-history'
+CHUNK = 20000
+
+
+class Command(BaseCommand):
+    help = "Benchmark keyset history pagination on a room with many messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--page-size', type=int, default=history.PAGE_SIZE)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--cleanup', action='store_true', help="Delete the benchmark room afterwards.")
+        parser.add_argument('--json', dest='json_path')
+
+    def handle(self, *args, **options):
+        conversation_id = self.prepare(options['messages'])
+        messages = ChatMessage.objects.filter(conversation_id=conversation_id)
+        total = messages.count()
+        depths = sorted({0, 1000, total // 10, total // 2, max(0, total - options['page_size'] - 1)})
+
+        rows = []
+        for depth in depths:
+            cursor = self.cursor_at(messages, depth)
+            keyset = self.time_it(
+                lambda: history.page(conversation_id, before=cursor, limit=options['page_size']),
+                options['repeat'],
+            )
+            offset = self.time_it(
+                lambda: list(messages.order_by('-seq')
+                             .values('id', 'content')[depth:depth + options['page_size']]),
+                options['repeat'],
+            )
+            rows.append({'depth': depth, 'keyset_ms': round(keyset, 3), 'offset_ms': round(offset, 3)})
+
+        write_report(self, {'messages': total, 'page_size': options['page_size'], 'results': rows},
+                     options['json_path'])
+
+        if options['cleanup']:
+            Room.objects.filter(name=ROOM_NAME).delete()
+
+    def prepare(self, count):
+        user, _ = User.objects.get_or_create(username='bench_history')
+        room, _ = Room.objects.get_or_create(name=ROOM_NAME, defaults={'created_by': user})
+        conversation_id = room.conversation.id
+        existing = ChatMessage.objects.filter(conversation_id=conversation_id).count()
+        started = time.perf_counter()
+        while existing < count:
+            size = min(CHUNK, count - existing)
+            with transaction.atomic():
+                first = lease(conversation_id, size) - size + 1
+                ChatMessage.objects.bulk_create(
+                    ChatMessage(conversation_id=conversation_id, seq=first + i, sender=user,
+                                content=f'message {existing + i}')
+                    for i in range(size)
+                )
+            existing += size
+        if time.perf_counter() - started > 1:
+            self.stdout.write(f"Inserted up to {count} messages in {time.perf_counter() - started:.1f}s")
+        return conversation_id
+
+    def cursor_at(self, messages, depth):
+        if depth == 0:
+            return None
+        return str(messages.order_by('-seq').values_list('seq', flat=True)[depth - 1])
+
+    def time_it(self, fn, repeat):
+        fn()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        return (time.perf_counter() - started) / repeat * 1000
@@ -0,0 +1,102 @@
+"""
+Message search indexing throughput and query latency.
+
+Fills a dedicated room with --messages rows of random words (seeded, reused
+across runs), indexes them through the configured search backend and times
+ranked queries for common, rare and prefix terms:
+
+    python manage.py bench_search --messages 1000000
+"""
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core import search
+from core.models import ChatMessage, Room
+from core.sequences import lease
+
+from ._bench import write_report
+
+ROOM_NAME = 'bench-search'
+CHUNK = 20000
+VOCABULARY_SIZE = 20000
+
+
+def vocabulary(rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(VOCABULARY_SIZE)]
+
+
+class Command(BaseCommand):
+    help = "Benchmark message search indexing and query latency."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--cleanup', action='store_true', help="Delete the benchmark room afterwards.")
+        parser.add_argument('--json', dest='json_path')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        words = vocabulary(rng)
+        # Zipf-like skew so some terms are very common and most are rare.
+        weights = [1 / (rank + 1) for rank in range(len(words))]
+        backend = search.get_backend()
+
+        user, _ = User.objects.get_or_create(username='bench_search')
+        room, _ = Room.objects.get_or_create(name=ROOM_NAME, defaults={'created_by': user})
+        conversation_id = room.conversation.id
+        messages = ChatMessage.objects.filter(conversation_id=conversation_id)
+        existing = messages.count()
+        indexed = 0
+        index_seconds = 0.0
+        while existing < options['messages']:
+            size = min(CHUNK, options['messages'] - existing)
+            with transaction.atomic():
+                first = lease(conversation_id, size) - size + 1
+                objs = ChatMessage.objects.bulk_create(
+                    ChatMessage(conversation_id=conversation_id, seq=first + i, sender=user,
+                                content=' '.join(rng.choices(words, weights, k=12)))
+                    for i in range(size)
+                )
+                started = time.perf_counter()
+                backend.index(search.entries_for(objs))
+                index_seconds += time.perf_counter() - started
+            existing += size
+            indexed += size
+
+        queries = {
+            'common': words[0],
+            'mid': words[100],
+            'rare': words[-1],
+            'two_terms': f'{words[1]} {words[2]}',
+            'prefix': words[3][:3],
+        }
+        rows = []
+        for label, query in queries.items():
+            backend.search(query, user)
+            started = time.perf_counter()
+            for _ in range(options['repeat']):
+                results = backend.search(query, user)
+            rows.append({
+                'query': label,
+                'terms': query,
+                'results': len(results),
+                'latency_ms': round((time.perf_counter() - started) / options['repeat'] * 1000, 3),
+            })
+
+        report = {
+            'backend': type(backend).__name__,
+            'messages': messages.count(),
+            'indexed_this_run': indexed,
+            'index_rows_per_second': round(indexed / index_seconds) if index_seconds else None,
+            'queries': rows,
+        }
+        write_report(self, report, options['json_path'])
+
+        if options['cleanup']:
+            room.delete()
@@ -0,0 +1,73 @@
+"""
+Serialization cost of one group broadcast vs. room size.
+
+"per_recipient" is the old path (every member's handler encodes the
+event), "pre_encoded" encodes once at the sender. Both use
+core.frames.dumps, so the speedup is the fan-out saving alone and not a
+change of JSON library:
+
+    python manage.py bench_serialization --sizes 1 10 100 1000
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import frames
+
+from ._bench import write_report
+
+
+def _per_recipient(event, members):
+    for _ in range(members):
+        frames.dumps({
+            'message': event['message'],
+            'username': event['username'],
+            'name': event['name'],
+        })
+
+
+def _pre_encoded(payload, members):
+    event = frames.frame_event(payload)
+    for _ in range(members):
+        event['text']
+
+
+def _time(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark broadcast serialization cost against room size."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+        parser.add_argument('--repeat', type=int, default=200)
+        parser.add_argument('--message-length', type=int, default=120)
+        parser.add_argument('--json', dest='json_path')
+
+    def handle(self, *args, **options):
+        payload = {
+            'message': 'x' * options['message_length'],
+            'username': 'someone',
+            'name': 'Some One',
+        }
+        event = dict(payload, type='chat_message')
+        rows = []
+        for size in options['sizes']:
+            before = _time(lambda: _per_recipient(event, size), options['repeat'])
+            after = _time(lambda: _pre_encoded(payload, size), options['repeat'])
+            rows.append({
+                'room_size': size,
+                'per_recipient_us': round(before, 2),
+                'pre_encoded_us': round(after, 2),
+                'speedup': round(before / after, 1) if after else None,
+            })
+        report = {
+            'encoder': 'orjson' if frames.orjson is not None else 'json',
+            'repeat': options['repeat'],
+            'results': rows,
+        }
+        write_report(self, report, options['json_path'])
@@ -0,0 +1,106 @@
+"""
+User search typeahead latency.
+
+Creates --users accounts with random usernames and names (seeded, reused
+across runs), builds the prefix index and times lookups by prefix length,
+both against the index alone and including the presence lookup the
+/search/ endpoint does:
+
+    python manage.py bench_typeahead --users 100000
+"""
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import UserProfile
+from core.presence import presence
+from core.typeahead import PrefixIndex
+
+from ._bench import latency_summary, write_report
+
+PREFIX = 'tb'
+CHUNK = 5000
+FIRST_NAMES = ['Aarav', 'Aditi', 'Arjun', 'Diya', 'Harsh', 'Isha', 'Kabir', 'Meera', 'Neha',
+               'Priya', 'Rahul', 'Riya', 'Rohan', 'Sara', 'Tara', 'Vikram', 'Zoya']
+
+
+def random_name(rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return ''.join(rng.choice(letters) for _ in range(rng.randint(4, 10)))
+
+
+class Command(BaseCommand):
+    help = "Benchmark the in-memory user search prefix index."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100000)
+        parser.add_argument('--lookups', type=int, default=2000)
+        parser.add_argument('--limit', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--cleanup', action='store_true', help="Delete the benchmark users afterwards.")
+        parser.add_argument('--json', dest='json_path')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        self.prepare(options['users'], rng)
+
+        index = PrefixIndex()
+        started = time.perf_counter()
+        index.build()
+        build_seconds = time.perf_counter() - started
+
+        rows = []
+        for length in (1, 2, 3, 5):
+            prefixes = [random_name(rng)[:length] for _ in range(options['lookups'])]
+            index_only, with_presence = [], []
+            for prefix in prefixes:
+                started = time.perf_counter()
+                users = index.search(prefix, options['limit'])
+                index_only.append(time.perf_counter() - started)
+                presence.online_many([u[0] for u in users])
+                with_presence.append(time.perf_counter() - started)
+            rows.append({
+                'prefix_length': length,
+                'index': latency_summary(index_only),
+                'with_presence': latency_summary(with_presence),
+            })
+
+        started = time.perf_counter()
+        for i in range(options['lookups']):
+            index.update(-1 - i, f'{PREFIX}_new{i}', rng.choice(FIRST_NAMES))
+        update_us = (time.perf_counter() - started) / options['lookups'] * 1e6
+
+        report = {
+            'users': User.objects.count(),
+            'index_keys': len(index._entries),
+            'build_seconds': round(build_seconds, 3),
+            'update_us': round(update_us, 1),
+            'limit': options['limit'],
+            'lookups': rows,
+        }
+        write_report(self, report, options['json_path'])
+
+        if options['cleanup']:
+            User.objects.filter(username__startswith=f'{PREFIX}_').delete()
+
+    def prepare(self, count, rng):
+        existing = User.objects.filter(username__startswith=f'{PREFIX}_').count()
+        started = time.perf_counter()
+        while existing < count:
+            size = min(CHUNK, count - existing)
+            with transaction.atomic():
+                users = User.objects.bulk_create(
+                    User(username=f'{PREFIX}_{random_name(rng)}{existing + i}',
+                         first_name=f'{rng.choice(FIRST_NAMES)} {random_name(rng).title()}')
+                    for i in range(size)
+                )
+                # bulk_create skips post_save, so profiles are added here.
+                UserProfile.objects.bulk_create(
+                    UserProfile(user=user, is_online=rng.random() < 0.1) for user in users
+                )
+            existing += size
+        if time.perf_counter() - started > 1:
+            self.stdout.write(f"Created up to {count} users in {time.perf_counter() - started:.1f}s")
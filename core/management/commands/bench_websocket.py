@@ -0,0 +1,385 @@
+"""
+End-to-end websocket load test of the realtime path.
+
+Drives the full ASGI stack (chatapp.asgi.application: session cookie,
+AuthMiddlewareStack, URLRouter, consumers) with --clients simulated users.
+The users are split between --rooms public rooms (ChatConsumer) and
+private chats between pairs of them (PrivateChatConsumer, --private share
+of the clients). Each run goes through four steps:
+
+  join   connect every socket, at most --concurrency handshakes at once
+  chat   every socket sends --messages messages, one every --interval
+         seconds on average, with a "typing" frame before a --typing share
+         of them
+  drain  wait until every member of every conversation has received
+         every message, or --timeout runs out
+  leave  disconnect every socket
+
+It reports connect latency, end-to-end delivery latency (sent by one
+client, received by each member, the sender included), messages sent and
+delivered per second, and resident memory per open connection:
+
+    python manage.py bench_websocket --clients 2000 --rooms 40 --json ws.json
+
+By default the clients talk to the application in this process through
+channels' WebsocketCommunicator, so memory per connection includes the
+client side as well. With --daphne they connect over real sockets to a
+Daphne server started in a child process, and memory is that process's.
+Rate limits are lifted for the run in both cases.
+"""
+import asyncio
+import functools
+import gc
+import multiprocessing
+import os
+import random
+import socket
+import time
+from collections import Counter
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+from core.frames import dumps, loads
+
+from ._bench import UNLIMITED, latency_summary, rss_bytes, write_report
+
+PREFIX = 'wb'
+
+
+class LocalClient:
+    """A socket to the application in this process."""
+
+    def __init__(self, application, path, cookie):
+        from channels.testing import WebsocketCommunicator
+
+        self.communicator = WebsocketCommunicator(application, path, headers=[(b'cookie', cookie.encode())])
+
+    async def connect(self, timeout):
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        return connected
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self):
+        return await self.communicator.receive_from(timeout=3600)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class SocketClient:
+    """A real websocket to a Daphne server, over autobahn's asyncio client."""
+
+    def __init__(self, port, path, cookie):
+        self.port = port
+        self.path = path
+        self.cookie = cookie
+        self.frames = asyncio.Queue()
+        self.protocol = None
+
+    async def connect(self, timeout):
+        from autobahn.asyncio.websocket import WebSocketClientFactory
+
+        # The factory binds to the running loop, so it is made here.
+        factory = WebSocketClientFactory(f'ws://127.0.0.1:{self.port}{self.path}', headers={'Cookie': self.cookie})
+        factory.protocol = _socket_protocol()
+        factory.client = self
+        loop = asyncio.get_running_loop()
+        self.opened, self.closed = loop.create_future(), loop.create_future()
+        _, self.protocol = await asyncio.wait_for(loop.create_connection(factory, '127.0.0.1', self.port), timeout)
+        return await asyncio.wait_for(self.opened, timeout)
+
+    async def send(self, text):
+        self.protocol.sendMessage(text.encode())
+
+    async def receive(self):
+        return await self.frames.get()
+
+    async def close(self):
+        if not self.closed.done():
+            self.protocol.sendClose(1000)
+            await self.closed
+
+
+@functools.cache
+def _socket_protocol():
+    from autobahn.asyncio.websocket import WebSocketClientProtocol
+
+    class Protocol(WebSocketClientProtocol):
+        def onOpen(self):
+            self.factory.client.opened.set_result(True)
+
+        def onMessage(self, payload, isBinary):
+            self.factory.client.frames.put_nowait(payload.decode())
+
+        def onClose(self, wasClean, code, reason):
+            client = self.factory.client
+            for future in (client.opened, client.closed):
+                if not future.done():
+                    future.set_result(False)
+
+    return Protocol
+
+
+class Socket:
+    def __init__(self, index, group, client):
+        self.index = index
+        self.group = group
+        self.client = client
+        self.connected = False
+        self.reader = None
+
+
+class Command(BaseCommand):
+    help = "Load-test the chat consumers end to end with many simulated websocket clients."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--rooms', type=int, default=20)
+        parser.add_argument('--private', type=float, default=0.2,
+                            help="Share of the clients that chat in private pairs instead of rooms.")
+        parser.add_argument('--messages', type=int, default=5, help="Messages per client.")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Mean seconds between a client's messages; 0 sends them back to back.")
+        parser.add_argument('--typing', type=float, default=0.5,
+                            help="Share of messages preceded by a typing frame.")
+        parser.add_argument('--concurrency', type=int, default=100, help="Handshakes in flight at once.")
+        parser.add_argument('--timeout', type=float, default=60.0)
+        parser.add_argument('--daphne', action='store_true', help="Connect over TCP to a Daphne child process.")
+        parser.add_argument('--port', type=int, default=0, help="Port for --daphne; a free one by default.")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--json', dest='json_path')
+
+    def handle(self, *args, **options):
+        private = int(options['clients'] * options['private']) // 2 * 2
+        if private < options['clients'] and options['rooms'] < 1:
+            raise CommandError("Room clients need at least one room")
+        users = self.prepare_users(options['clients'])
+        paths = self.prepare_rooms(users, options['clients'] - private, options['rooms'])
+        sessions = self.create_sessions(users)
+        cookie = f'{settings.SESSION_COOKIE_NAME}=%s'
+        try:
+            if options['daphne']:
+                report = self.run_daphne(paths, sessions, cookie, options)
+            else:
+                from chatapp.asgi import application
+
+                with override_settings(CHAT_RATE_LIMITS=UNLIMITED):
+                    report = asyncio.run(self.run(
+                        [Socket(i, group, LocalClient(application, path, cookie % sessions[i]))
+                         for i, (path, group) in enumerate(paths)],
+                        'self', options,
+                    ))
+        finally:
+            self.delete_sessions(sessions)
+        report = {'transport': 'daphne' if options['daphne'] else 'in-process', 'room_clients': len(users) - private,
+                  'private_clients': private, 'rooms': options['rooms'], **report}
+        write_report(self, report, options['json_path'])
+
+    def prepare_users(self, count):
+        from django.contrib.auth.models import User
+        from core.models import UserProfile
+
+        existing = set(User.objects.filter(username__startswith=f'{PREFIX}_').values_list('username', flat=True))
+        with transaction.atomic():
+            User.objects.bulk_create(
+                User(username=f'{PREFIX}_{i}', first_name=f'Load {i}')
+                for i in range(count) if f'{PREFIX}_{i}' not in existing
+            )
+            users = User.objects.in_bulk([f'{PREFIX}_{i}' for i in range(count)], field_name='username')
+            # bulk_create skips the signal that gives users a profile.
+            UserProfile.objects.bulk_create((UserProfile(user=user) for user in users.values()), ignore_conflicts=True)
+        return [users[f'{PREFIX}_{i}'] for i in range(count)]
+
+    def prepare_rooms(self, users, room_clients, room_count):
+        """Returns (path, conversation) for each user's socket, in user order."""
+        from core.models import PrivateRoom, Room
+
+        paths = []
+        rooms = [
+            Room.objects.get_or_create(slug=f'{PREFIX}-room-{i}',
+                                       defaults={'name': f'{PREFIX}-room-{i}', 'created_by': users[0]})[0]
+            for i in range(min(room_count, room_clients))
+        ]
+        for i in range(room_clients):
+            slug = rooms[i % len(rooms)].slug
+            paths.append((f'/ws/chat/{slug}/', slug))
+        for first, second in zip(users[room_clients::2], users[room_clients + 1::2]):
+            room = PrivateRoom.objects.filter(user1=first, user2=second).first()
+            if room is None:
+                room = PrivateRoom.objects.create(user1=first, user2=second)
+            paths += [(f'/ws/private/{room.room_slug}/', room.room_slug)] * 2
+        return paths
+
+    def create_sessions(self, users):
+        # Logged-in sessions, so the sockets authenticate through
+        # AuthMiddlewareStack like a browser's do.
+        from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        backend = settings.AUTHENTICATION_BACKENDS[0]
+        keys = []
+        with transaction.atomic():
+            for user in users:
+                session = store()
+                session.update({SESSION_KEY: str(user.pk), BACKEND_SESSION_KEY: backend,
+                                HASH_SESSION_KEY: user.get_session_auth_hash()})
+                session.create()
+                keys.append(session.session_key)
+        return keys
+
+    def delete_sessions(self, keys):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        with transaction.atomic():
+            for key in keys:
+                store(key).delete()
+
+    def run_daphne(self, paths, sessions, cookie, options):
+        port = options['port']
+        if not port:
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                port = probe.getsockname()[1]
+        ctx = multiprocessing.get_context('spawn')
+        ready = ctx.Event()
+        server = ctx.Process(target=_serve, args=(port, ready), daemon=True)
+        server.start()
+        try:
+            if not ready.wait(60):
+                raise CommandError("Daphne did not start")
+            return asyncio.run(self.run(
+                [Socket(i, group, SocketClient(port, path, cookie % sessions[i]))
+                 for i, (path, group) in enumerate(paths)],
+                server.pid, options,
+            ))
+        finally:
+            server.terminate()
+            server.join()
+
+    async def run(self, sockets, pid, options):
+        timeout = options['timeout']
+        rng = random.Random(options['seed'])
+        latencies, connect_latencies = [], []
+        stats = Counter()
+        done = asyncio.Event()
+
+        async def read(sock):
+            while True:
+                data = loads(await sock.client.receive())
+                kind = data.get('type')
+                if kind in ('typing', 'stop_typing'):
+                    stats['typing_frames'] += 1
+                elif kind is None and data.get('message', '').startswith(f'{PREFIX}|'):
+                    now = time.perf_counter()
+                    latencies.append(now - float(data['message'].split('|')[2]))
+                    stats['delivered'] += 1
+                    stats['last_delivery'] = now
+                    if stats['delivered'] == stats['expected']:
+                        done.set()
+                elif data.get('username') == 'System':
+                    stats['system_frames'] += 1
+
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def join(sock):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    sock.connected = await sock.client.connect(timeout)
+                except (asyncio.TimeoutError, OSError):
+                    return
+            if sock.connected:
+                connect_latencies.append(time.perf_counter() - started)
+                sock.reader = asyncio.ensure_future(read(sock))
+
+        gc.collect()
+        rss_before = rss_bytes(pid)
+        started = time.perf_counter()
+        await asyncio.gather(*(join(sock) for sock in sockets))
+        connect_seconds = time.perf_counter() - started
+        connected = [sock for sock in sockets if sock.connected]
+        # Let the join broadcasts settle before taking the memory reading.
+        await asyncio.sleep(1)
+        gc.collect()
+        rss_after = rss_bytes(pid)
+
+        members = Counter(sock.group for sock in connected)
+        stats['expected'] = sum(members[sock.group] for sock in connected) * options['messages']
+
+        async def chat(sock, rng):
+            for _ in range(options['messages']):
+                if rng.random() < options['typing']:
+                    await sock.client.send('{"type":"typing"}')
+                    stats['typing_sent'] += 1
+                if options['interval']:
+                    await asyncio.sleep(rng.expovariate(1 / options['interval']))
+                await sock.client.send(dumps({'message': f'{PREFIX}|{sock.index}|{time.perf_counter()}'}))
+                stats['sent'] += 1
+
+        started = time.perf_counter()
+        if stats['expected']:
+            await asyncio.gather(*(chat(sock, random.Random(rng.random())) for sock in connected))
+            send_seconds = time.perf_counter() - started
+            try:
+                await asyncio.wait_for(done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            send_seconds = 0.0
+        chat_seconds = max(stats['last_delivery'] - started, send_seconds) or 1e-9
+
+        started = time.perf_counter()
+        for sock in connected:
+            sock.reader.cancel()
+        await asyncio.gather(*(sock.client.close() for sock in connected), return_exceptions=True)
+        leave_seconds = time.perf_counter() - started
+        if pid == 'self':
+            from core.persistence import writer
+
+            await writer.flush()
+
+        per_connection = None
+        if connected and rss_before is not None:
+            per_connection = round((rss_after - rss_before) / len(connected) / 1024, 1)
+        return {
+            'clients': len(sockets),
+            'connected': len(connected),
+            'connect_seconds': round(connect_seconds, 3),
+            'connects_per_second': round(len(connected) / connect_seconds, 1),
+            'connect_latency': latency_summary(connect_latencies),
+            'rss_before_mb': rss_before and round(rss_before / 2 ** 20, 1),
+            'rss_connected_mb': rss_after and round(rss_after / 2 ** 20, 1),
+            'memory_per_connection_kb': per_connection,
+            'messages_sent': stats['sent'],
+            'typing_sent': stats['typing_sent'],
+            'deliveries_expected': stats['expected'],
+            'deliveries': stats['delivered'],
+            'deliveries_missing': stats['expected'] - stats['delivered'],
+            'chat_seconds': round(chat_seconds, 3),
+            'messages_per_second': round(stats['sent'] / chat_seconds, 1),
+            'deliveries_per_second': round(stats['delivered'] / chat_seconds, 1),
+            'delivery_latency': latency_summary(latencies),
+            'typing_frames_received': stats['typing_frames'],
+            'system_frames_received': stats['system_frames'],
+            'leave_seconds': round(leave_seconds, 3),
+        }
+
+
+def _serve(port, ready):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatapp.settings')
+    import django
+    django.setup()
+    # Installs Twisted's asyncio reactor, so it comes before anything
+    # else that might import a reactor.
+    from daphne.server import Server
+
+    override_settings(CHAT_RATE_LIMITS=UNLIMITED).enable()
+    from chatapp.asgi import application
+
+    Server(application, endpoints=[f'tcp:port={port}:interface=127.0.0.1'], ready_callable=ready.set,
+           verbosity=0).run()
@@ -0,0 +1,56 @@
+"""
+Render avatar thumbnails for pictures uploaded before they existed, or
+after changing CHAT_AVATAR_SIZES, and report how many bytes an avatar
+costs a page before and after:
+
+    python manage.py build_thumbnails
+"""
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from core.models import UserProfile
+from core.thumbnails import SIZES, render, thumbnail_name
+
+from ._bench import write_report
+
+
+class Command(BaseCommand):
+    help = "Render avatar thumbnails for every profile picture."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', dest='json_path')
+
+    def handle(self, *args, **options):
+        names = sorted(set(UserProfile.objects.exclude(profile_pic='').exclude(profile_pic=None)
+                           .values_list('profile_pic', flat=True)))
+        rendered, missing, failed = 0, 0, 0
+        original_bytes, smallest_bytes = 0, 0
+        started = time.perf_counter()
+        for name in names:
+            if not default_storage.exists(name):
+                missing += 1
+                continue
+            try:
+                render(name)
+            except Exception as e:
+                self.stderr.write(f"{name}: {e}")
+                failed += 1
+                continue
+            rendered += 1
+            original_bytes += default_storage.size(name)
+            smallest_bytes += default_storage.size(thumbnail_name(name, SIZES[0]))
+        elapsed = time.perf_counter() - started
+
+        write_report(self, {
+            'sizes': list(SIZES),
+            'pictures': len(names),
+            'rendered': rendered,
+            'missing': missing,
+            'failed': failed,
+            'seconds': round(elapsed, 3),
+            'original_bytes': original_bytes,
+            f'thumbnail_{SIZES[0]}_bytes': smallest_bytes,
+            'reduction': round(original_bytes / smallest_bytes, 1) if smallest_bytes else None,
+        }, options['json_path'])
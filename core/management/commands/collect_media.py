@@ -0,0 +1,75 @@
+"""
+Bring uploaded files in line with the rows that use them.
+
+Recounts StoredFile from the profiles, optionally moves pictures uploaded
+before content-addressed storage into it (--rehash, which also merges
+the duplicates), and lists files in the upload directory that nothing
+refers to. They are only deleted with --delete:
+
+    python manage.py collect_media --rehash --delete
+"""
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.media import GRACE, remove
+from core.models import StoredFile, UserProfile
+from core.storage import HASHED_NAME
+from core.thumbnails import render, thumbnails
+
+
+class Command(BaseCommand):
+    help = "Recount, deduplicate and garbage-collect uploaded profile pictures."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rehash', action='store_true', help="Move old uploads to content-addressed names.")
+        parser.add_argument('--delete', action='store_true', help="Delete unreferenced files.")
+        parser.add_argument('--grace', type=float, default=GRACE,
+                            help="Keep unreferenced files touched in the last this many seconds.")
+
+    def handle(self, *args, **options):
+        field = UserProfile._meta.get_field('profile_pic')
+        storage = field.storage
+        if options['rehash']:
+            self.rehash(storage)
+        counts = self.recount()
+        orphans = [name for name in self.walk(storage, field.upload_to.rstrip('/')) if name not in counts]
+        removed = 0
+        for name in orphans:
+            self.stdout.write(f"unreferenced: {name}")
+            if options['delete'] and remove(name, storage, grace=options['grace']):
+                removed += 1
+        self.stdout.write(f"{len(counts)} files referenced {sum(counts.values())} times, "
+                          f"{len(orphans)} unreferenced, {removed} deleted")
+
+    def rehash(self, storage):
+        names = (UserProfile.objects.exclude(profile_pic='').exclude(profile_pic=None)
+                 .values_list('profile_pic', flat=True).distinct())
+        for name in list(names):
+            if HASHED_NAME.search(name) or not storage.exists(name):
+                continue
+            with storage.open(name) as f:
+                hashed = storage.save(name, f)
+            # Bypasses the signals; recount() settles the counts afterwards.
+            UserProfile.objects.filter(profile_pic=name).update(profile_pic=hashed)
+            if not thumbnails.rendered(hashed):
+                render(hashed, storage)
+            self.stdout.write(f"{name} -> {hashed}")
+
+    def recount(self):
+        counts = Counter(UserProfile.objects.exclude(profile_pic='').exclude(profile_pic=None)
+                         .values_list('profile_pic', flat=True))
+        with transaction.atomic():
+            StoredFile.objects.all().delete()
+            StoredFile.objects.bulk_create([StoredFile(name=name, references=n) for name, n in counts.items()],
+                                           batch_size=1000)
+        return counts
+
+    def walk(self, storage, directory):
+        directories, files = storage.listdir(directory)
+        for name in files:
+            if not name.startswith('.'):
+                yield f'{directory}/{name}'
+        for sub in directories:
+            yield from self.walk(storage, f'{directory}/{sub}')
@@ -0,0 +1,47 @@
+"""
+Export a room's or a private chat's history to a file, in the same
+streaming way as the /export/ views:
+
+    python manage.py export_chat --room general --format csv -o general.csv
+    python manage.py export_chat --private <room slug> > chat.jsonl
+"""
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import export
+from core.models import Conversation
+
+
+class Command(BaseCommand):
+    help = "Stream a conversation's messages to a JSON Lines or CSV file."
+
+    def add_arguments(self, parser):
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument('--room', help="Room slug.")
+        target.add_argument('--private', help="Private room slug.")
+        parser.add_argument('--format', choices=sorted(export.FORMATS), default='jsonl')
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE)
+        parser.add_argument('-o', '--output', help="File to write; defaults to stdout.")
+
+    def handle(self, *args, **options):
+        if options['room']:
+            lookup = {'room__slug': options['room']}
+        else:
+            lookup = {'private_room__room_slug': options['private']}
+        conversation_id = Conversation.objects.filter(**lookup).values_list('id', flat=True).first()
+        if conversation_id is None:
+            raise CommandError("No such conversation")
+
+        started = time.perf_counter()
+        out = open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] else sys.stdout
+        written = 0
+        try:
+            for chunk in export.stream(conversation_id, options['format'], options['chunk_size']):
+                out.write(chunk)
+                written += len(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        self.stderr.write(f"Wrote {written} characters in {time.perf_counter() - started:.1f}s")
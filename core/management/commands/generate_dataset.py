@@ -0,0 +1,283 @@
+"""
+Generate a production-sized dataset for local benchmarks.
+
+Creates --users accounts with profiles, --rooms rooms, --private-rooms
+private chats and --messages messages spread over them. Everything comes
+from --seed, so runs with the same options produce the same rows. Traffic
+is skewed the way real chat is: a few busy rooms and chatty members, and
+a long tail of quiet ones.
+
+    python manage.py generate_dataset --users 10000 --rooms 200 \\
+        --private-rooms 20000 --messages 10000000
+
+Rows are written in transactions of --chunk rows with signals bypassed;
+what they would do (profiles, conversations, sequence counters) is done
+here in bulk. Messages skip the ORM: bulk_create spends several times
+longer building model instances than the database spends storing them,
+so they go in as executemany batches of tuples. They are only added to
+the search index with --search-index.
+
+Usernames and room names start with --prefix; --flush removes an earlier
+dataset with the same prefix first. When --flush leaves the message table
+empty, the load also runs with foreign key checks off and ChatMessage's
+Meta indexes dropped, rebuilding them at the end; a database with other
+messages in it keeps both.
+
+Known limitation: this is not the hundreds of thousands of rows a second
+a bulk loader could reach. On one vCPU with SQLite it writes about 60-75k
+messages a second into an empty table and about 45k next to existing
+messages; building the rows in Python takes most of that time, on the
+same core as SQLite.
+"""
+import itertools
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+
+from core import search
+from core.models import ChatMessage, Conversation, PrivateRoom, Room, UserProfile
+
+from ._bench import write_report
+
+# Fixed, so runs compare.
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+VOCABULARY_SIZE = 5000
+TEXTS = 50000   # distinct message bodies to draw from
+FIRST_NAMES = ['Aarav', 'Aditi', 'Arjun', 'Diya', 'Harsh', 'Isha', 'Kabir', 'Meera', 'Neha',
+               'Priya', 'Rahul', 'Riya', 'Rohan', 'Sara', 'Tara', 'Vikram', 'Zoya']
+
+
+def zipf_cum_weights(count, rng):
+    """Cumulative weights 1/rank over `count` items in a random order."""
+    ranks = list(range(1, count + 1))
+    rng.shuffle(ranks)
+    total, cum = 0.0, []
+    for rank in ranks:
+        total += 1 / rank
+        cum.append(total)
+    return cum
+
+
+class Command(BaseCommand):
+    help = "Generate users, rooms, private chats and messages for benchmarking."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--rooms', type=int, default=50)
+        parser.add_argument('--private-rooms', type=int, default=2000)
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--private-share', type=float, default=0.3,
+                            help="Fraction of messages sent in private chats.")
+        parser.add_argument('--days', type=float, default=90, help="Time span the messages are spread over.")
+        parser.add_argument('--chunk', type=int, default=50000, help="Rows per transaction.")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--prefix', default='gen')
+        parser.add_argument('--flush', action='store_true', help="Delete an earlier dataset with this prefix.")
+        parser.add_argument('--search-index', action='store_true', help="Also index the messages for search.")
+        parser.add_argument('--json', dest='json_path')
+
+    def handle(self, *args, **options):
+        prefix, chunk = options['prefix'], options['chunk']
+        if options['users'] < 2:
+            raise CommandError("Need at least two users")
+        if options['private_rooms'] > options['users'] * (options['users'] - 1) // 2:
+            raise CommandError("More private rooms than pairs of users")
+        if options['messages'] and not options['rooms'] + options['private_rooms']:
+            raise CommandError("Messages need a room or a private room to go to")
+        if User.objects.filter(username__startswith=f'{prefix}_').exists():
+            if not options['flush']:
+                raise CommandError(f"A dataset with prefix {prefix!r} exists; pass --flush to replace it")
+            self.flush(prefix)
+
+        rng = random.Random(options['seed'])
+        timings = {}
+        started = time.perf_counter()
+        users = self.create_users(options['users'], prefix, chunk, rng)
+        timings['users_seconds'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        rooms = self.create_rooms(options['rooms'], users, prefix, chunk, rng)
+        private = self.create_private_rooms(options['private_rooms'], users, prefix, chunk, rng)
+        timings['rooms_seconds'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        bulk_load = self.create_messages(options, rooms, private, rng)
+        timings['messages_seconds'] = time.perf_counter() - started
+
+        rows = 2 * (len(users) + len(rooms) + len(private)) + options['messages']
+        total = sum(timings.values())
+        write_report(self, {
+            'seed': options['seed'],
+            'users': len(users),
+            'rooms': options['rooms'],
+            'private_rooms': options['private_rooms'],
+            'messages': options['messages'],
+            'search_index': options['search_index'],
+            'bulk_load': bulk_load,
+            **{name: round(seconds, 2) for name, seconds in timings.items()},
+            'messages_per_second': round(options['messages'] / timings['messages_seconds']),
+            'rows_per_second': round(rows / total),
+        }, options['json_path'])
+
+    def flush(self, prefix):
+        users = User.objects.filter(username__startswith=f'{prefix}_')
+        conversations = Conversation.objects.filter(Q(room__created_by__in=users) | Q(private_room__user1__in=users))
+        with transaction.atomic():
+            # No signals on ChatMessage, so this is a single DELETE.
+            ChatMessage.objects.filter(conversation__in=conversations).delete()
+            users.delete()
+
+    def create_users(self, count, prefix, chunk, rng):
+        # One hash for everyone: hashing is deliberately slow. The password
+        # is "password".
+        password = make_password('password', salt='generated')
+        for start in range(0, count, chunk):
+            with transaction.atomic():
+                User.objects.bulk_create(
+                    User(username=f'{prefix}_{i}', first_name=rng.choice(FIRST_NAMES), password=password,
+                         date_joined=START)
+                    for i in range(start, min(start + chunk, count))
+                )
+        users = list(User.objects.filter(username__startswith=f'{prefix}_').order_by('id')
+                     .values_list('id', 'username'))
+        for start in range(0, len(users), chunk):
+            with transaction.atomic():
+                UserProfile.objects.bulk_create(UserProfile(user_id=pk) for pk, _ in users[start:start + chunk])
+        return users
+
+    def create_rooms(self, count, users, prefix, chunk, rng):
+        """Creates the rooms; returns {conversation id: member ids}."""
+        names = [f'{prefix}-room-{i}' for i in range(count)]
+        with transaction.atomic():
+            Room.objects.bulk_create(
+                (Room(name=name, slug=name, created_by_id=rng.choice(users)[0]) for name in names),
+                batch_size=chunk,
+            )
+            dataset = Room.objects.filter(name__startswith=f'{prefix}-room-')
+            dataset.update(created_at=START)
+            room_ids = dataset.order_by('id').values_list('id', flat=True)
+            Conversation.objects.bulk_create(
+                (Conversation(kind=Conversation.ROOM, room_id=pk) for pk in room_ids), batch_size=chunk,
+            )
+        ids = [pk for pk, _ in users]
+        members = {}
+        for conversation_id in Conversation.objects.filter(room__in=dataset).order_by('id').values_list('id', flat=True):
+            members[conversation_id] = rng.sample(ids, rng.randint(2, min(len(ids), 200)))
+        return members
+
+    def create_private_rooms(self, count, users, prefix, chunk, rng):
+        """Creates the private chats; returns {conversation id: (user1, user2)}."""
+        pairs = set()
+        while len(pairs) < count:
+            a, b = rng.sample(users, 2)
+            pairs.add((a, b) if a[0] < b[0] else (b, a))
+        pairs = sorted(pairs)
+        slugs = ['_'.join(sorted([a[1], b[1]])) for a, b in pairs]
+        for start in range(0, len(pairs), chunk):
+            with transaction.atomic():
+                PrivateRoom.objects.bulk_create(
+                    PrivateRoom(user1_id=a[0], user2_id=b[0], room_slug=slug)
+                    for (a, b), slug in zip(pairs[start:start + chunk], slugs[start:start + chunk])
+                )
+        # Both members belong to the dataset, so its rooms are all the ones
+        # with a user1 from it.
+        dataset = PrivateRoom.objects.filter(user1__username__startswith=f'{prefix}_')
+        rooms = list(dataset.order_by('id').values_list('id', 'user1_id', 'user2_id'))
+        for start in range(0, len(rooms), chunk):
+            with transaction.atomic():
+                Conversation.objects.bulk_create(
+                    Conversation(kind=Conversation.PRIVATE, private_room_id=pk) for pk, _, _ in rooms[start:start + chunk]
+                )
+        participants = {pk: (user1, user2) for pk, user1, user2 in rooms}
+        return {
+            conversation_id: participants[private_room_id]
+            for conversation_id, private_room_id in Conversation.objects.filter(
+                private_room__in=dataset).order_by('id').values_list('id', 'private_room_id')
+        }
+
+    def create_messages(self, options, rooms, private, rng):
+        total, chunk = options['messages'], options['chunk']
+        words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 9)))
+                 for _ in range(VOCABULARY_SIZE)]
+        word_weights = zipf_cum_weights(len(words), rng)
+        texts = [' '.join(rng.choices(words, cum_weights=word_weights, k=int(rng.expovariate(1 / 8)) + 1))
+                 for _ in range(TEXTS)]
+
+        senders = {**rooms, **private}
+        kinds = {**dict.fromkeys(rooms, Conversation.ROOM), **dict.fromkeys(private, Conversation.PRIVATE)}
+        share = options['private_share'] if private else 0.0
+        if not rooms:
+            share = 1.0
+        conversations, cum_weights = [], []
+        for ids, weight in ((sorted(rooms), 1 - share), (sorted(private), share)):
+            if not ids or not weight:
+                continue
+            cum = zipf_cum_weights(len(ids), rng)
+            base = cum_weights[-1] if cum_weights else 0.0
+            conversations += ids
+            cum_weights += [base + c / cum[-1] * weight for c in cum]
+
+        table = connection.ops.quote_name(ChatMessage._meta.db_table)
+        sql = (f'INSERT INTO {table} (conversation_id, seq, sender_id, content, timestamp) '
+               f'VALUES (%s, %s, %s, %s, %s)')
+        # What adapt_datetimefield_value() makes of a naive UTC datetime,
+        # without its per-row checks: a string on SQLite.
+        adapt = str if connection.vendor == 'sqlite' else connection.ops.adapt_datetimefield_value
+        step = timedelta(days=options['days']) / max(total, 1)
+        # Naive UTC, the form the ORM stores them in.
+        stamp = START.replace(tzinfo=None)
+        seqs = {pk: itertools.count(1) for pk in conversations}
+        counts = Counter()
+        backend = search.get_backend() if options['search_index'] else None
+        last_id = ChatMessage.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        random_ = rng.random
+
+        # Only rows this command writes can be left unchecked.
+        bulk_load = options['flush'] and not last_id
+        if bulk_load:
+            with connection.schema_editor() as editor:
+                for index in ChatMessage._meta.indexes:
+                    editor.remove_index(ChatMessage, index)
+            connection.disable_constraint_checking()
+        try:
+            for start in range(0, total, chunk):
+                rows = []
+                picks = rng.choices(conversations, cum_weights=cum_weights, k=min(chunk, total - start))
+                counts.update(picks)
+                for conversation_id in picks:
+                    # Skewed towards the first members: a few do most of the talking.
+                    members = senders[conversation_id]
+                    stamp += step
+                    rows.append((conversation_id, next(seqs[conversation_id]),
+                                 members[int(len(members) * random_() ** 2)],
+                                 texts[int(TEXTS * random_())], adapt(stamp)))
+                with transaction.atomic(), connection.cursor() as cursor:
+                    cursor.executemany(sql, rows)
+                    if backend is not None:
+                        saved = list(ChatMessage.objects.filter(id__gt=last_id).order_by('id')
+                                     .values_list('id', 'conversation_id', 'content'))
+                        backend.index([(kinds[c], pk, c, content) for pk, c, content in saved])
+                        last_id = saved[-1][0]
+                if (start // chunk + 1) % 20 == 0:
+                    self.stdout.write(f"{start + len(rows)} messages")
+        finally:
+            if bulk_load:
+                connection.enable_constraint_checking()
+                started = time.perf_counter()
+                with connection.schema_editor() as editor:
+                    for index in ChatMessage._meta.indexes:
+                        editor.add_index(ChatMessage, index)
+                self.stdout.write(f"Rebuilt message indexes in {time.perf_counter() - started:.1f}s")
+
+        Conversation.objects.bulk_update(
+            [Conversation(id=pk, last_seq=count) for pk, count in counts.items()],
+            ['last_seq'], batch_size=500,
+        )
+        return bulk_load
@@ -0,0 +1,27 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.broker import serve
+
+
+class Command(BaseCommand):
+    help = "Run the local pure-Python channel layer broker (CHAT_CHANNEL_LAYER=local)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('address', nargs='?', default=settings.CHAT_BROKER_ADDRESS)
+
+    def handle(self, *args, **options):
+        host, port = options['address'].rsplit(':', 1)
+
+        async def main():
+            server = await serve(host, int(port))
+            self.stdout.write(f"Broker listening on {host}:{port}")
+            async with server:
+                await server.serve_forever()
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
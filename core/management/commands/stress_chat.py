@@ -0,0 +1,236 @@
+"""
+Stress test: hundreds of simulated chatters on one SQLite file.
+
+Starts --workers processes, each standing in for a Daphne worker with its
+own rooms, and connects --chatters websocket clients spread over --rooms
+rooms between them. For --duration seconds each chatter sends a message
+every --interval seconds on average, asks for a page of history now and
+then and acks what it has read. Meanwhile --request-threads threads stand
+in for HTTP requests and write to the same database from their own
+connections. Reports delivery and history latency, how many messages
+reached the database and how many writes failed with "database is
+locked":
+
+    CHAT_SQLITE_MODE=production python manage.py stress_chat --chatters 300
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, close_old_connections, connection
+from django.utils import timezone
+
+from ._bench import latency_summary, write_report
+
+PREFIX = 'st'
+# Seconds a worker may take beyond --duration to connect and flush.
+GRACE = 300
+
+
+class Command(BaseCommand):
+    help = "Stress the consumers and the database with many concurrent chatters."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chatters', type=int, default=300)
+        parser.add_argument('--rooms', type=int, default=12)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--duration', type=float, default=30.0)
+        parser.add_argument('--interval', type=float, default=5.0, help="Mean seconds between messages per chatter.")
+        parser.add_argument('--request-threads', type=int, default=4)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--json', dest='json_path')
+
+    def handle(self, *args, **options):
+        from core.models import ChatMessage
+
+        if options['rooms'] < options['workers']:
+            raise CommandError("Every worker needs a room of its own: pass --rooms >= --workers")
+        users, rooms = self.prepare(options['chatters'], options['rooms'])
+        stored_before = ChatMessage.objects.filter(conversation__room__in=rooms).count()
+
+        stop = threading.Event()
+        request_stats = {'writes': 0, 'locked': 0}
+        threads = [threading.Thread(target=self.request_writes, args=(users, stop, request_stats, i))
+                   for i in range(options['request_threads'])]
+        ctx = multiprocessing.get_context('spawn')
+        results = ctx.Queue()
+        workers = options['workers']
+        processes = [
+            ctx.Process(target=_worker, args=(
+                [user.pk for user in users[w::workers]], [room.pk for room in rooms[w::workers]], options, results,
+            ))
+            for w in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for process in processes:
+                process.start()
+            stats = _collect(processes, results, options['duration'] + GRACE)
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        report = {
+            'sqlite_mode': settings.CHAT_SQLITE_MODE,
+            'journal_mode': self.journal_mode(),
+            'workers': workers,
+            'chatters': len(users),
+            'rooms': len(rooms),
+            'duration_seconds': options['duration'],
+            'messages_sent': sum(s['sent'] for s in stats),
+            'messages_stored': ChatMessage.objects.filter(conversation__room__in=rooms).count() - stored_before,
+            'writer_failed_rows': sum(s['failed'] for s in stats),
+            'delivery_latency': latency_summary([x for s in stats for x in s['delivery']]),
+            'history_latency': latency_summary([x for s in stats for x in s['history']]),
+            'db_write_avg_ms': [round(s['db_write']['avg_ms'], 1) if s['db_write'] else None for s in stats],
+            'request_writes': request_stats['writes'],
+            'request_writes_locked': request_stats['locked'],
+        }
+        write_report(self, report, options['json_path'])
+
+    def prepare(self, chatters, room_count):
+        from django.contrib.auth.models import User
+        from core.models import Room
+
+        users = []
+        for i in range(chatters):
+            user, _ = User.objects.get_or_create(username=f'{PREFIX}_{i}', defaults={'first_name': f'Chatter {i}'})
+            users.append(user)
+        rooms = []
+        for i in range(room_count):
+            room, _ = Room.objects.get_or_create(
+                slug=f'{PREFIX}-room-{i}', defaults={'name': f'{PREFIX}-room-{i}', 'created_by': users[0]},
+            )
+            rooms.append(room)
+        return users, rooms
+
+    def journal_mode(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            return cursor.fetchone()[0]
+
+    def request_writes(self, users, stop, stats, seed):
+        # What page views do next to the sockets: short write transactions
+        # on their own connections.
+        from core.models import UserProfile
+
+        rng = random.Random(seed)
+        try:
+            while not stop.is_set():
+                try:
+                    UserProfile.objects.filter(user=rng.choice(users)).update(bio=f'Seen {timezone.now():%H:%M:%S}')
+                    stats['writes'] += 1
+                except OperationalError as e:
+                    if 'locked' not in str(e):
+                        raise
+                    stats['locked'] += 1
+                time.sleep(0.01)
+        finally:
+            close_old_connections()
+
+
+def _collect(processes, results, timeout):
+    """One report per worker; fails as soon as a worker dies without one."""
+    stats = []
+    deadline = time.monotonic() + timeout
+    while len(stats) < len(processes):
+        try:
+            stats.append(results.get(timeout=1))
+            continue
+        except queue.Empty:
+            pass
+        for process in processes:
+            if process.exitcode not in (None, 0):
+                raise CommandError(f"Worker {process.pid} exited with code {process.exitcode}")
+        if time.monotonic() > deadline:
+            raise CommandError(f"No report from {len(processes) - len(stats)} worker(s) after {timeout:.0f}s")
+    return stats
+
+
+def _worker(user_ids, room_ids, options, results):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatapp.settings')
+    import django
+    django.setup()
+    from django.contrib.auth.models import User
+    from core.models import Room
+
+    users = list(User.objects.filter(pk__in=user_ids))
+    rooms = list(Room.objects.filter(pk__in=room_ids))
+    results.put(asyncio.run(_chat(users, rooms, options)))
+
+
+async def _chat(users, rooms, options):
+    from channels.testing import WebsocketCommunicator
+    from core import metrics
+    from core.consumers import ChatConsumer
+    from core.persistence import writer
+    from core.receipts import receipts
+
+    rng = random.Random(options['seed'])
+    application = ChatConsumer.as_asgi()
+    delivery, history = [], []
+    sent = 0
+    deadline = time.time() + options['duration']
+
+    async def chatter(index, user, room):
+        nonlocal sent
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{room.slug}/')
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'room_name': room.slug}}
+        connected, _ = await communicator.connect(timeout=30)
+        if not connected:
+            return
+        history_sent = None
+        last_seq = 0
+
+        async def read():
+            nonlocal history_sent, last_seq
+            while True:
+                data = json.loads(await communicator.receive_from(timeout=3600))
+                if data.get('type') == 'history' and history_sent is not None:
+                    history.append(time.time() - history_sent)
+                    history_sent = None
+                elif data.get('message', '').startswith(f'{PREFIX}|'):
+                    delivery.append(time.time() - float(data['message'].split('|')[1]))
+                    last_seq = max(last_seq, data.get('seq') or 0)
+
+        reader = asyncio.ensure_future(read())
+        chatter_rng = random.Random(rng.random())
+        while time.time() < deadline:
+            await asyncio.sleep(chatter_rng.expovariate(1 / options['interval']))
+            await communicator.send_json_to({'message': f'{PREFIX}|{time.time()}|{index}'})
+            sent += 1
+            roll = chatter_rng.random()
+            if roll < 0.05 and history_sent is None:
+                history_sent = time.time()
+                await communicator.send_json_to({'type': 'history', 'before': str(max(last_seq - 20, 1))})
+            elif roll < 0.3 and last_seq:
+                await communicator.send_json_to({'type': 'read', 'seq': last_seq})
+        await asyncio.sleep(1)
+        reader.cancel()
+        await communicator.disconnect()
+
+    await asyncio.gather(*(chatter(i, user, rooms[i % len(rooms)]) for i, user in enumerate(users)))
+    await writer.flush()
+    await receipts.flush()
+    return {
+        'sent': sent,
+        'delivery': delivery,
+        'history': history,
+        'failed': metrics.counters['persistence.failed'],
+        'db_write': metrics.snapshot()['timings'].get('db.write'),
+    }
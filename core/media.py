@@ -0,0 +1,60 @@
+# core/media.py
+# Reference counts for uploaded files. With content-addressed storage
+# (core/storage.py) several profiles can point at one file, so a file may
+# only go once the last of them has moved on. The UserProfile signals call
+# retain() when a row starts referring to a file and release() when it
+# stops (a new picture, a deleted profile or account); at zero the file
+# and its thumbnails are deleted once the transaction commits.
+#
+# An upload that reuses a file bumps its mtime before its row is saved, so
+# files touched in the last CHAT_MEDIA_GC_GRACE seconds are never deleted
+# here; `manage.py collect_media` recounts from the rows and sweeps those
+# up later, along with anything uploaded before the counts existed.
+import os
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from . import metrics
+from .models import StoredFile
+from .thumbnails import SIZES, thumbnail_name
+
+GRACE = getattr(settings, 'CHAT_MEDIA_GC_GRACE', 60)
+
+
+def retain(name):
+    if StoredFile.objects.filter(name=name).update(references=F('references') + 1):
+        return
+    try:
+        with transaction.atomic():
+            StoredFile.objects.create(name=name, references=1)
+    except IntegrityError:
+        # Created by someone else in the meantime.
+        StoredFile.objects.filter(name=name).update(references=F('references') + 1)
+
+
+def release(name, storage):
+    with transaction.atomic():
+        StoredFile.objects.filter(name=name, references__gt=0).update(references=F('references') - 1)
+        orphaned, _ = StoredFile.objects.filter(name=name, references=0).delete()
+    if orphaned:
+        transaction.on_commit(lambda: remove(name, storage))
+
+
+def remove(name, storage, grace=GRACE):
+    """Delete an unreferenced file and its thumbnails; returns whether it did."""
+    if StoredFile.objects.filter(name=name).exists():
+        return False
+    try:
+        age = time.time() - os.path.getmtime(storage.path(name))
+    except FileNotFoundError:
+        return False
+    if age < grace:
+        return False
+    storage.delete(name)
+    for size in SIZES:
+        storage.delete(thumbnail_name(name, size))
+    metrics.incr('storage.removed')
+    return True
@@ -0,0 +1,43 @@
+# core/metrics.py
+# In-process counters, gauges and timings for the realtime path.
+# Everything here is per worker process; the staff-only /metrics/ view
+# dumps the current snapshot as JSON.
+import threading
+from collections import Counter
+
+_lock = threading.Lock()
+counters = Counter()
+gauges = {}
+timings = {}
+
+
+def incr(name, amount=1):
+    with _lock:
+        counters[name] += amount
+
+
+def set_gauge(name, value):
+    gauges[name] = value
+
+
+def observe(name, seconds):
+    ms = seconds * 1000
+    with _lock:
+        stat = timings.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'last_ms': 0.0})
+        stat['count'] += 1
+        stat['total_ms'] += ms
+        stat['last_ms'] = ms
+        if ms > stat['max_ms']:
+            stat['max_ms'] = ms
+
+
+def snapshot():
+    with _lock:
+        result = {
+            'counters': dict(counters),
+            'gauges': dict(gauges),
+            'timings': {},
+        }
+        for name, stat in timings.items():
+            result['timings'][name] = dict(stat, avg_ms=stat['total_ms'] / stat['count'])
+    return result
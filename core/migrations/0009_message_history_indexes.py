@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 02:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_chatmessage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='message_room_ts_id'),
+        ),
+        migrations.AddIndex(
+            model_name='privatechatmessage',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='private_msg_room_ts_id'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# FTS5 index for message search (core.search.SQLiteFTSBackend). Only
+# created on SQLite; other databases use the configured search backend.
+
+from django.db import migrations
+
+
+def create_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS core_message_fts USING fts5("
+        "content, kind UNINDEXED, room_id UNINDEXED, message_id UNINDEXED)"
+    )
+    schema_editor.execute(
+        "INSERT INTO core_message_fts (content, kind, room_id, message_id) "
+        "SELECT content, 'room', room_id, id FROM core_message"
+    )
+    schema_editor.execute(
+        "INSERT INTO core_message_fts (content, kind, room_id, message_id) "
+        "SELECT content, 'private', room_id, id FROM core_privatechatmessage"
+    )
+
+
+def drop_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS core_message_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0009_message_history_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_index, drop_fts_index),
+    ]
@@ -0,0 +1,78 @@
+# Copies Message and PrivateChatMessage rows into the ChatMessage store.
+#
+# Runs outside a single transaction: each chunk of CHUNK source ids is
+# copied and committed on its own, so the database is never write-locked
+# for more than one chunk at a time. Sequence numbers follow the old ids,
+# i.e. insertion order, per conversation. A run that failed part-way is
+# simply re-run: the copied rows are cleared first.
+
+from django.db import migrations, transaction
+
+CHUNK = 10000
+
+
+def create_conversations(apps):
+    Room = apps.get_model("core", "Room")
+    PrivateRoom = apps.get_model("core", "PrivateRoom")
+    Conversation = apps.get_model("core", "Conversation")
+    Conversation.objects.bulk_create(
+        [Conversation(kind="room", room_id=pk)
+         for pk in Room.objects.filter(conversation__isnull=True).values_list("id", flat=True)],
+        batch_size=CHUNK,
+    )
+    Conversation.objects.bulk_create(
+        [Conversation(kind="private", private_room_id=pk)
+         for pk in PrivateRoom.objects.filter(conversation__isnull=True).values_list("id", flat=True)],
+        batch_size=CHUNK,
+    )
+
+
+def copy_table(connection, source, room_column, sender_column, chunk=CHUNK):
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT MIN(id), MAX(id) FROM {qn(source)}")
+        low, high = cursor.fetchone()
+    if low is None:
+        return
+    for start in range(low - 1, high, chunk):
+        bounds = [start, start + chunk]
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO core_chatmessage (conversation_id, seq, sender_id, content, timestamp) "
+                "SELECT c.id, c.last_seq + ROW_NUMBER() OVER (PARTITION BY c.id ORDER BY m.id), "
+                f"m.{sender_column}, m.content, m.timestamp "
+                f"FROM {qn(source)} m JOIN core_conversation c ON c.{room_column} = m.room_id "
+                "WHERE m.id > %s AND m.id <= %s",
+                bounds,
+            )
+            cursor.execute(
+                "UPDATE core_conversation SET last_seq = ("
+                "SELECT MAX(seq) FROM core_chatmessage WHERE conversation_id = core_conversation.id) "
+                f"WHERE {room_column} IN (SELECT room_id FROM {qn(source)} WHERE id > %s AND id <= %s)",
+                bounds,
+            )
+
+
+def move_messages(apps, schema_editor):
+    ChatMessage = apps.get_model("core", "ChatMessage")
+    Conversation = apps.get_model("core", "Conversation")
+    connection = schema_editor.connection
+    with transaction.atomic(using=connection.alias):
+        ChatMessage.objects.all().delete()
+        Conversation.objects.update(last_seq=0)
+        create_conversations(apps)
+    copy_table(connection, "core_message", "room_id", "user_id")
+    copy_table(connection, "core_privatechatmessage", "private_room_id", "sender_id")
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ("core", "0011_conversation_chatmessage"),
+    ]
+
+    operations = [
+        migrations.RunPython(move_messages, migrations.RunPython.noop),
+    ]
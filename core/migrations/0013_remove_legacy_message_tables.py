@@ -0,0 +1,67 @@
+# Re-keys the FTS5 search index by conversation and ChatMessage id, then
+# drops the old per-kind message tables now that 0012 has copied them.
+#
+# Like 0012 this runs outside a single transaction: the index is filled
+# CHUNK message ids at a time, each chunk committed on its own, so the
+# write lock is never held for more than one chunk. Messages saved after
+# the rebuild started are indexed by the writer as usual. Re-running
+# starts again from an empty index.
+
+from django.db import migrations, transaction
+
+CHUNK = 10000
+
+
+def rebuild_fts_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite":
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS core_message_fts")
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE core_message_fts USING fts5("
+        "content, kind UNINDEXED, conversation_id UNINDEXED, message_id UNINDEXED)"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MIN(id), MAX(id) FROM core_chatmessage")
+        low, high = cursor.fetchone()
+    if low is None:
+        return
+    for start in range(low - 1, high, CHUNK):
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO core_message_fts (content, kind, conversation_id, message_id) "
+                "SELECT m.content, c.kind, m.conversation_id, m.id "
+                "FROM core_chatmessage m JOIN core_conversation c ON c.id = m.conversation_id "
+                "WHERE m.id > %s AND m.id <= %s",
+                [start, start + CHUNK],
+            )
+
+
+def restore_fts_index(apps, schema_editor):
+    # The old tables come back empty, and so does their index.
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS core_message_fts")
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE core_message_fts USING fts5("
+        "content, kind UNINDEXED, room_id UNINDEXED, message_id UNINDEXED)"
+    )
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ("core", "0012_move_messages_to_chatmessage"),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_fts_index, restore_fts_index),
+        migrations.DeleteModel(
+            name="Message",
+        ),
+        migrations.DeleteModel(
+            name="PrivateChatMessage",
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.4 on 2026-10-18 03:53
+#
+# Starts the reference counts from the pictures profiles point at today.
+# Existing files keep their names; `manage.py collect_media --rehash` moves
+# them into the content-addressed layout.
+
+from collections import Counter
+
+import core.storage
+from django.db import migrations, models
+
+
+def count_references(apps, schema_editor):
+    UserProfile = apps.get_model("core", "UserProfile")
+    StoredFile = apps.get_model("core", "StoredFile")
+    counts = Counter(UserProfile.objects.exclude(profile_pic="").exclude(profile_pic=None)
+                     .values_list("profile_pic", flat=True))
+    StoredFile.objects.bulk_create([StoredFile(name=name, references=n) for name, n in counts.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_readstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('references', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='profile_pic',
+            field=models.ImageField(blank=True, null=True, storage=core.storage.HashedStorage(), upload_to='profiles/'),
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.4 on 2026-10-18 04:02
+#
+# Drops the single-column indexes on ChatMessage.conversation and .sender:
+# the (conversation, seq) constraint and the (sender, timestamp) index
+# serve the same lookups, and every message insert had to update both.
+#
+# AlterField would make SQLite copy the whole message table, twice, so
+# the database side is just the two DROP INDEX statements.
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+INDEXES = [
+    ("core_chatmessage_conversation_id_ff473a3e", "conversation_id"),
+    ("core_chatmessage_sender_id_c9992722", "sender_id"),
+]
+
+
+def drop_indexes(apps, schema_editor):
+    qn = schema_editor.quote_name
+    for name, _ in INDEXES:
+        schema_editor.execute(schema_editor.sql_delete_index % {"table": qn("core_chatmessage"), "name": qn(name)})
+
+
+def create_indexes(apps, schema_editor):
+    qn = schema_editor.quote_name
+    for name, column in INDEXES:
+        schema_editor.execute(f"CREATE INDEX {qn(name)} ON {qn('core_chatmessage')} ({qn(column)})")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_storedfile'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='chatmessage',
+                    name='conversation',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='core.conversation'),
+                ),
+                migrations.AlterField(
+                    model_name='chatmessage',
+                    name='sender',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(drop_indexes, create_indexes),
+            ],
+        ),
+    ]
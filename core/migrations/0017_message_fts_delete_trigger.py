@@ -0,0 +1,68 @@
+# Keeps the FTS5 search index in step with deletions. The index used to be
+# append-only, so deleted messages (and every message of a deleted room)
+# stayed in it and took up search candidates.
+#
+# Index rows are re-keyed so their rowid is the ChatMessage id, and a
+# trigger deletes the index row with its message. It is a trigger rather
+# than a post_delete receiver because deleting a room removes its messages
+# with one DELETE and no signals.
+#
+# The index is rebuilt from the messages that still exist, CHUNK ids at a
+# time with each chunk committed on its own, like 0013. A migration that
+# makes SQLite remake core_chatmessage drops the trigger with the old
+# table, and has to create it again.
+
+from django.db import migrations, transaction
+
+CHUNK = 10000
+
+CREATE_TRIGGER = (
+    "CREATE TRIGGER IF NOT EXISTS core_message_fts_delete AFTER DELETE ON core_chatmessage "
+    "BEGIN DELETE FROM core_message_fts WHERE rowid = old.id; END"
+)
+
+
+def rekey_fts_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite":
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS core_message_fts")
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE core_message_fts USING fts5("
+        "content, kind UNINDEXED, conversation_id UNINDEXED, message_id UNINDEXED)"
+    )
+    schema_editor.execute(CREATE_TRIGGER)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MIN(id), MAX(id) FROM core_chatmessage")
+        low, high = cursor.fetchone()
+    if low is None:
+        return
+    for start in range(low - 1, high, CHUNK):
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO core_message_fts (rowid, content, kind, conversation_id, message_id) "
+                "SELECT m.id, m.content, c.kind, m.conversation_id, m.id "
+                "FROM core_chatmessage m JOIN core_conversation c ON c.id = m.conversation_id "
+                "WHERE m.id > %s AND m.id <= %s",
+                [start, start + CHUNK],
+            )
+
+
+def drop_trigger(apps, schema_editor):
+    # Index rows keyed by message id work for the older code as they are.
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute("DROP TRIGGER IF EXISTS core_message_fts_delete")
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ("core", "0016_drop_redundant_message_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(rekey_fts_index, drop_trigger),
+    ]
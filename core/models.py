@@ -2,6 +2,8 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.utils.text import slugify
 
+from .storage import HashedStorage
+
 class Room(models.Model):
     name = models.CharField(max_length=255, unique=True)
     slug = models.SlugField(unique=True, blank=True)
@@ -15,15 +17,6 @@ class Room(models.Model):
     def __str__(self):
         return self.name
 
-class Message(models.Model):
-    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='messages')
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
-
-    def __str__(self):
-        return f'{self.user.username} in {self.room.name}: {self.content}'
-
 class PrivateRoom(models.Model):
     user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='user1_rooms')
     user2 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='user2_rooms')
@@ -41,14 +34,57 @@ class PrivateRoom(models.Model):
     def __str__(self):
         return f"{self.user1.username} - {self.user2.username}"
 
-class PrivateChatMessage(models.Model):
-    room = models.ForeignKey(PrivateRoom, related_name='messages', on_delete=models.CASCADE)
-    sender = models.ForeignKey(User, on_delete=models.CASCADE)
+class Conversation(models.Model):
+    """A room or a private chat; the partition key of the message store."""
+    ROOM = 'room'
+    PRIVATE = 'private'
+    KIND_CHOICES = [(ROOM, 'Room'), (PRIVATE, 'Private')]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    room = models.OneToOneField(Room, null=True, blank=True, on_delete=models.CASCADE, related_name='conversation')
+    private_room = models.OneToOneField(PrivateRoom, null=True, blank=True, on_delete=models.CASCADE,
+                                        related_name='conversation')
+    # Highest sequence number handed out so far (see core/sequences.py).
+    last_seq = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.room or self.private_room)
+
+class ChatMessage(models.Model):
+    # No single-column FK indexes: the (conversation, seq) constraint and
+    # the (sender, timestamp) index below already start with these columns.
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages',
+                                     db_index=False)
+    seq = models.BigIntegerField()
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        ordering = ['timestamp']
+        constraints = [
+            # Also the index every history page and resume reads along.
+            models.UniqueConstraint(fields=['conversation', 'seq'], name='chatmessage_conversation_seq'),
+        ]
+        indexes = [
+            models.Index(fields=['sender', 'timestamp'], name='chatmessage_sender_ts'),
+        ]
+
+    def __str__(self):
+        return f'{self.sender.username}: {self.content[:20]}'
+
+class ReadState(models.Model):
+    """How far a user has read a conversation; written in batches by core/receipts.py."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='read_states')
+    last_read_seq = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'conversation'], name='readstate_user_conversation'),
+        ]
+
+    def __str__(self):
+        return f'{self.user.username} read {self.conversation} up to {self.last_read_seq}'
 
 
 class UserProfile(models.Model):
@@ -56,19 +92,16 @@ class UserProfile(models.Model):
     is_online = models.BooleanField(default=False)
     # Extra fields
     bio = models.TextField(blank=True)
-    profile_pic = models.ImageField(upload_to='profiles/', blank=True, null=True)
+    profile_pic = models.ImageField(upload_to='profiles/', storage=HashedStorage(), blank=True, null=True)
 
     def __str__(self):
         return f"{self.user.username} - {'Online' if self.is_online else 'Offline'}"
-    
-from django.db import models
-from django.contrib.auth.models import User
 
-class ChatMessage(models.Model):
-    sender = models.ForeignKey(User, on_delete=models.CASCADE)
-    room_name = models.CharField(max_length=255)  # can be private or public
-    message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+
+class StoredFile(models.Model):
+    """How many rows refer to an uploaded file; see core/media.py."""
+    name = models.CharField(max_length=255, unique=True)
+    references = models.PositiveIntegerField(default=0)
 
     def __str__(self):
-        return f'{self.sender.username}: {self.message[:20]}'
+        return f'{self.name} ({self.references})'
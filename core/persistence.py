@@ -0,0 +1,196 @@
+# core/persistence.py
+# Write-behind persistence for chat messages. Consumers broadcast first and
+# then hand the message to the writer, which flushes queued rows to the DB
+# with bulk_create in batches instead of one INSERT per frame, on the
+# database writer thread (core/db.py).
+#
+# A batch that fails with OperationalError (SQLite's "database is locked",
+# mostly) goes back to the front of the queue and is retried with
+# exponential backoff, up to CHAT_PERSIST_RETRIES times. Its messages have
+# already been broadcast with their sequence numbers, so only errors that
+# retrying cannot fix drop them.
+import asyncio
+import atexit
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import OperationalError, transaction
+from django.dispatch import Signal
+
+from . import metrics
+from .db import database
+
+logger = logging.getLogger(__name__)
+
+# Sent after each bulk insert with sender=model and objs=the saved rows;
+# bulk_create does not send post_save. The search index listens to this.
+messages_persisted = Signal()
+
+
+class MessageWriter:
+    def __init__(self, batch_size=100, max_delay=0.25, max_pending=5000, retries=5, retry_delay=0.1):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._pending = deque()
+        self._loop = None
+        self._task = None
+        self._has_items = None
+        self._batch_ready = None
+        self._flush_lock = None
+
+    def _bind_loop(self):
+        # asyncio primitives belong to one event loop; rebuild them if we are
+        # now running on a different one (e.g. async_to_sync in tests).
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._has_items = asyncio.Event()
+            self._batch_ready = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def put(self, model, **fields):
+        self._bind_loop()
+        # Back-pressure: a producer that outruns the DB waits for a flush
+        # instead of growing the queue without bound.
+        while len(self._pending) >= self.max_pending:
+            metrics.incr('persistence.backpressure')
+            await self.flush()
+        self._pending.append(model(**fields))
+        metrics.incr('persistence.enqueued')
+        metrics.set_gauge('persistence.queue_depth', len(self._pending))
+        self._has_items.set()
+        if len(self._pending) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def _run(self):
+        while True:
+            await self._has_items.wait()
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._has_items.clear()
+            self._batch_ready.clear()
+            await self.flush()
+            if self._pending:
+                self._has_items.set()
+
+    async def flush(self):
+        self._bind_loop()
+        async with self._flush_lock:
+            attempt = 0
+            while self._pending:
+                batch = self._take_batch()
+                try:
+                    await database.write(self._write_batch, batch)
+                except OperationalError as e:
+                    delay = self._retry(batch, attempt, e)
+                    attempt = 0 if delay is None else attempt + 1
+                    if delay:
+                        await asyncio.sleep(delay)
+                    continue
+                attempt = 0
+
+    def has_pending(self, conversation_id):
+        return any(getattr(obj, 'conversation_id', None) == conversation_id for obj in list(self._pending))
+
+    def flush_sync(self):
+        # Used at interpreter exit when there is no event loop left to run
+        # the background task on.
+        attempt = 0
+        while self._pending:
+            batch = self._take_batch()
+            try:
+                self._write_batch(batch)
+            except OperationalError as e:
+                delay = self._retry(batch, attempt, e)
+                attempt = 0 if delay is None else attempt + 1
+                if delay:
+                    time.sleep(delay)
+                continue
+            attempt = 0
+
+    def _take_batch(self):
+        size = min(self.batch_size, len(self._pending))
+        batch = [self._pending.popleft() for _ in range(size)]
+        metrics.set_gauge('persistence.queue_depth', len(self._pending))
+        return batch
+
+    def _retry(self, batch, attempt, error):
+        """Requeue a batch that failed with OperationalError; returns the backoff, or None if it was dropped."""
+        if attempt >= self.retries:
+            logger.error("Failed to persist %d chat messages after %d retries", len(batch), attempt, exc_info=error)
+            metrics.incr('persistence.failed', len(batch))
+            return None
+        logger.warning("Retrying %d chat messages: %s", len(batch), error)
+        self._pending.extendleft(reversed(batch))
+        metrics.incr('persistence.retried', len(batch))
+        metrics.set_gauge('persistence.queue_depth', len(self._pending))
+        return self.retry_delay * 2 ** attempt
+
+    def _write_batch(self, batch):
+        started = time.perf_counter()
+        try:
+            self._write(batch)
+        except OperationalError:
+            # Probably transient; flush() retries the batch.
+            raise
+        except Exception:
+            logger.exception("Failed to persist %d chat messages", len(batch))
+            metrics.incr('persistence.failed', len(batch))
+            return
+        metrics.observe('persistence.flush', time.perf_counter() - started)
+        metrics.incr('persistence.flushed', len(batch))
+
+    def _write(self, batch):
+        # Rows arrive with their foreign keys already resolved by the
+        # consumers, so a flush is one INSERT per model plus one SELECT per
+        # foreign key to drop rows whose room or sender was deleted while
+        # they waited: one such row would fail the whole INSERT.
+        # All models go in one transaction, so a retried batch is never
+        # half written.
+        by_model = {}
+        for obj in batch:
+            by_model.setdefault(type(obj), []).append(obj)
+        written = []
+        with transaction.atomic():
+            for model, objs in by_model.items():
+                objs = self._resolvable(model, objs)
+                if objs:
+                    model.objects.bulk_create(objs)
+                    written.append((model, objs))
+        for model, objs in written:
+            for receiver, result in messages_persisted.send_robust(sender=model, objs=objs):
+                if isinstance(result, Exception):
+                    logger.error("messages_persisted receiver %r failed", receiver, exc_info=result)
+
+    def _resolvable(self, model, objs):
+        for field in model._meta.concrete_fields:
+            if not field.many_to_one:
+                continue
+            ids = {getattr(obj, field.attname) for obj in objs}
+            found = set(field.related_model._base_manager.filter(pk__in=ids).values_list('pk', flat=True))
+            if len(found) < len(ids):
+                kept = [obj for obj in objs if getattr(obj, field.attname) in found]
+                metrics.incr('persistence.unresolved', len(objs) - len(kept))
+                objs = kept
+        return objs
+
+
+writer = MessageWriter(
+    batch_size=getattr(settings, 'CHAT_PERSIST_BATCH_SIZE', 100),
+    max_delay=getattr(settings, 'CHAT_PERSIST_MAX_DELAY', 0.25),
+    max_pending=getattr(settings, 'CHAT_PERSIST_MAX_PENDING', 5000),
+    retries=getattr(settings, 'CHAT_PERSIST_RETRIES', 5),
+    retry_delay=getattr(settings, 'CHAT_PERSIST_RETRY_DELAY', 0.1),
+)
+
+atexit.register(writer.flush_sync)
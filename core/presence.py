@@ -0,0 +1,249 @@
+# core/presence.py
+# In-memory presence. Every open chat socket is registered here; a user is
+# online while they have at least one live socket (so several tabs work),
+# and UserProfile.is_online is written in batches instead of on every
+# connect and disconnect.
+#
+# Counts are per worker process. With several workers each one re-asserts
+# its online users every CHAT_PRESENCE_REFRESH seconds, so a user who
+# disconnected from one worker but is still connected to another is
+# corrected in the DB within one refresh period.
+#
+# Online/offline transitions are also pushed to every socket subscribed to
+# the "presence" group, coalesced into at most one frame per tick per
+# worker, so a mass reconnect after a deploy costs clients a few frames
+# rather than one per user.
+#
+# A worker only knows its own sockets, so a user whose last socket here
+# closed may still be connected elsewhere. Before announcing them offline
+# the worker asks the others over the "presence_workers" group; any that
+# still holds a socket for them answers, and the offline frame is dropped.
+# Offline frames therefore go out one tick later than online ones.
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from . import metrics
+from .db import database
+from .frames import frame_event
+from .models import UserProfile
+
+logger = logging.getLogger(__name__)
+
+GROUP = 'presence'
+WORKERS_GROUP = 'presence_workers'
+
+
+class PresenceRegistry:
+    def __init__(self, ttl=60, flush_interval=2.0, refresh=30, tick=1.0):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.refresh = refresh
+        self.tick = tick
+        self.sockets = {}     # channel_name -> (user_id, last_seen)
+        self.users = {}       # user_id -> set of channel_names
+        self.usernames = {}   # user_id -> username, for presence frames
+        self._changes = {}    # user_id -> is_online, waiting to be persisted
+        self._deltas = {}     # user_id -> online state at the start of the tick
+        self._leaving = {}    # user_id -> username, offline here, waiting for other workers
+        self._held = set()    # user ids other workers still have sockets for
+        self._channel = None  # this worker's channel in WORKERS_GROUP
+        self._last_refresh = time.monotonic()
+        self._loop = None
+        self._task = None
+        self._listener = None
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._task = None
+            self._listener = None
+            self._channel = None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        if self._listener is None or self._listener.done():
+            self._listener = loop.create_task(self._listen())
+
+    def connect(self, user_id, channel_name, username):
+        self._bind_loop()
+        self.sockets[channel_name] = (user_id, time.monotonic())
+        self.usernames[user_id] = username
+        channels = self.users.setdefault(user_id, set())
+        channels.add(channel_name)
+        if len(channels) == 1:
+            self._deltas.setdefault(user_id, False)
+            self._changes[user_id] = True
+
+    def disconnect(self, channel_name):
+        entry = self.sockets.pop(channel_name, None)
+        if entry is None:
+            return
+        user_id = entry[0]
+        channels = self.users.get(user_id)
+        channels.discard(channel_name)
+        if not channels:
+            del self.users[user_id]
+            self._deltas.setdefault(user_id, True)
+            self._changes[user_id] = False
+
+    def heartbeat(self, channel_name, user_id, username):
+        entry = self.sockets.get(channel_name)
+        if entry is not None:
+            self.sockets[channel_name] = (entry[0], time.monotonic())
+            return
+        # Expired while still open (a throttled background tab, say): the
+        # socket counts again from its next frame.
+        metrics.incr('presence.reregistered')
+        self.connect(user_id, channel_name, username)
+
+    def is_online(self, user_id):
+        return user_id in self.users
+
+    def online_many(self, user_ids, persisted=None):
+        """
+        Map each user id to its online state. Sockets on this worker and
+        not-yet-flushed changes win over the persisted flag, which callers
+        that already joined UserProfile can pass in to save a query.
+        """
+        user_ids = list(user_ids)
+        if persisted is None:
+            persisted = dict(UserProfile.objects.filter(user_id__in=user_ids).values_list('user_id', 'is_online'))
+        result = {}
+        for user_id in user_ids:
+            if user_id in self.users:
+                result[user_id] = True
+            elif user_id in self._changes:
+                result[user_id] = self._changes[user_id]
+            else:
+                result[user_id] = bool(persisted.get(user_id))
+        return result
+
+    def expire(self):
+        # Sockets that stopped sending heartbeats without a disconnect
+        # (killed tabs, lost workers' peers) stop counting after the TTL.
+        cutoff = time.monotonic() - self.ttl
+        stale = [name for name, (_, seen) in self.sockets.items() if seen < cutoff]
+        for channel_name in stale:
+            self.disconnect(channel_name)
+        if stale:
+            metrics.incr('presence.expired', len(stale))
+
+    async def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self._push()
+            except Exception:
+                logger.exception("Failed to push presence changes")
+            if time.monotonic() - last_flush < self.flush_interval:
+                continue
+            last_flush = time.monotonic()
+            self.expire()
+            if last_flush - self._last_refresh >= self.refresh:
+                self._last_refresh = last_flush
+                for user_id in self.users:
+                    self._changes.setdefault(user_id, True)
+                if self._channel is not None:
+                    # Layers expire group membership eventually.
+                    await get_channel_layer().group_add(WORKERS_GROUP, self._channel)
+            if self._changes:
+                changes, self._changes = self._changes, {}
+                try:
+                    await database.write(self._persist, changes)
+                except Exception:
+                    logger.exception("Failed to persist presence for %d users", len(changes))
+
+    async def _listen(self):
+        layer = get_channel_layer()
+        self._channel = await layer.new_channel()
+        await layer.group_add(WORKERS_GROUP, self._channel)
+        while True:
+            message = await layer.receive(self._channel)
+            if message['type'] == 'presence.gone':
+                held = [user_id for user_id in message['users'] if user_id in self.users]
+                if held and message['reply_to'] != self._channel:
+                    for user_id in held:
+                        # The asking worker is about to persist them offline.
+                        self._changes[user_id] = True
+                    try:
+                        await layer.send(message['reply_to'], {'type': 'presence.held', 'users': held})
+                    except Exception:
+                        logger.exception("Failed to answer a presence check")
+            elif message['type'] == 'presence.held':
+                self._held.update(message['users'])
+
+    async def _push(self):
+        layer = get_channel_layer()
+        deltas, self._deltas = self._deltas, {}
+        # Users who left here last tick, unless another worker answered
+        # that it still has them or they came back.
+        leaving, self._leaving = self._leaving, {}
+        held, self._held = self._held, set()
+        offline = [username for user_id, username in leaving.items()
+                   if user_id not in held and user_id not in self.users]
+        if held:
+            metrics.incr('presence.held', len(held))
+        online, gone = [], {}
+        for user_id, was_online in deltas.items():
+            is_online = user_id in self.users
+            username = self.usernames[user_id] if is_online else self.usernames.pop(user_id, None)
+            # A user who connected and left again within the tick (or the
+            # reverse) has not changed state and is not announced.
+            if is_online == was_online or username is None:
+                continue
+            if is_online:
+                online.append(username)
+            else:
+                gone[user_id] = username
+        if gone:
+            if self._channel is None:
+                offline += gone.values()
+            else:
+                self._leaving = gone
+                await layer.group_send(WORKERS_GROUP, {
+                    'type': 'presence.gone', 'users': list(gone), 'reply_to': self._channel,
+                })
+        if not online and not offline:
+            return
+        metrics.incr('presence.frames')
+        metrics.incr('presence.deltas', len(online) + len(offline))
+        await layer.group_send(GROUP, frame_event({
+            'type': 'presence',
+            'online': online,
+            'offline': offline,
+        }))
+
+    def _persist(self, changes):
+        started = time.perf_counter()
+        with transaction.atomic():
+            # Users deleted since they were seen are skipped: one such row
+            # would fail the whole upsert.
+            existing = set(User.objects.filter(pk__in=changes).values_list('pk', flat=True))
+            if len(existing) < len(changes):
+                metrics.incr('presence.unresolved', len(changes) - len(existing))
+            # One upsert per batch; also creates profiles for users missing one.
+            UserProfile.objects.bulk_create(
+                [UserProfile(user_id=user_id, is_online=online) for user_id, online in changes.items()
+                 if user_id in existing],
+                update_conflicts=True,
+                unique_fields=['user'],
+                update_fields=['is_online'],
+            )
+        metrics.observe('presence.flush', time.perf_counter() - started)
+        metrics.set_gauge('presence.online_users', len(self.users))
+        metrics.set_gauge('presence.sockets', len(self.sockets))
+
+
+presence = PresenceRegistry(
+    ttl=getattr(settings, 'CHAT_PRESENCE_TTL', 60),
+    flush_interval=getattr(settings, 'CHAT_PRESENCE_FLUSH_INTERVAL', 2.0),
+    refresh=getattr(settings, 'CHAT_PRESENCE_REFRESH', 30),
+    tick=getattr(settings, 'CHAT_PRESENCE_TICK', 1.0),
+)
@@ -0,0 +1,135 @@
+# core/ratelimit.py
+# Token buckets for per-connection and per-user limits. Pure in-memory
+# arithmetic, so a check never touches the database or the channel layer.
+#
+# Limits are configured per message type in CHAT_RATE_LIMITS. Each entry
+# has a per-connection rate/burst, an optional per-user rate/burst shared
+# by all of that user's sockets on this worker, and the policy for frames
+# over the limit:
+#   drop        ignore the frame
+#   delay       hold it until tokens are available, up to
+#               CHAT_RATE_MAX_DELAY seconds, and drop it beyond that
+#   disconnect  close the socket
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+ALLOW = 'allow'
+DROP = 'drop'
+DELAY = 'delay'
+DISCONNECT = 'disconnect'
+
+DEFAULT_LIMITS = {
+    'chat': {'rate': 5, 'burst': 10, 'user_rate': 10, 'user_burst': 20, 'policy': DELAY},
+    'typing': {'rate': 5, 'burst': 10, 'policy': DROP},
+    'stop_typing': {'rate': 5, 'burst': 10, 'policy': DROP},
+    'history': {'rate': 2, 'burst': 5, 'user_rate': 5, 'user_burst': 10, 'policy': DELAY},
+    'read': {'rate': 5, 'burst': 10, 'policy': DROP},
+    'heartbeat': {'rate': 1, 'burst': 5, 'policy': DROP},
+    # Frames that are not valid JSON.
+    'default': {'rate': 2, 'burst': 5, 'policy': DISCONNECT},
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate        # tokens added per second
+        self.capacity = burst   # bucket size
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def consume(self, amount=1):
+        if self.refill() >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def wait_time(self, amount=1):
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+
+class UserBuckets:
+    """Buckets shared by every socket of a user on this worker."""
+
+    def __init__(self):
+        self._users = {}   # user_id -> [open sockets, {msg_type: TokenBucket}]
+
+    def acquire(self, user_id):
+        entry = self._users.setdefault(user_id, [0, {}])
+        entry[0] += 1
+        return entry[1]
+
+    def release(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is None:
+            return
+        entry[0] -= 1
+        if entry[0] <= 0:
+            del self._users[user_id]
+
+
+user_buckets = UserBuckets()
+
+
+class RateLimiter:
+    """The limits one socket is subject to."""
+
+    def __init__(self, user_id, limits=None, max_delay=None):
+        self.user_id = user_id
+        self.limits = limits or getattr(settings, 'CHAT_RATE_LIMITS', DEFAULT_LIMITS)
+        self.max_delay = max_delay if max_delay is not None else getattr(settings, 'CHAT_RATE_MAX_DELAY', 2.0)
+        self._connection = {}
+        self._user = user_buckets.acquire(user_id)
+
+    def close(self):
+        user_buckets.release(self.user_id)
+
+    def _buckets(self, kind, limit):
+        buckets = [self._bucket(self._connection, kind, limit['rate'], limit['burst'])]
+        if 'user_rate' in limit:
+            buckets.append(self._bucket(self._user, kind, limit['user_rate'], limit['user_burst']))
+        return buckets
+
+    def _bucket(self, buckets, kind, rate, burst):
+        bucket = buckets.get(kind)
+        if bucket is None:
+            bucket = buckets[kind] = TokenBucket(rate, burst)
+        return bucket
+
+    def check(self, msg_type):
+        """
+        (verdict, delay) for one frame: (ALLOW, seconds to hold it first),
+        (DROP, 0) or (DISCONNECT, 0). Checked as frames arrive, so frames
+        held back put the buckets into debt and a sustained flood runs past
+        max_delay and is dropped instead of queueing without bound.
+        """
+        kind = msg_type if msg_type in self.limits else 'default'
+        limit = self.limits[kind]
+        buckets = self._buckets(kind, limit)
+        if all([bucket.refill() >= 1 for bucket in buckets]):
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return ALLOW, 0.0
+
+        policy = limit['policy']
+        if policy == DELAY:
+            wait = max(bucket.wait_time() for bucket in buckets)
+            if wait <= self.max_delay:
+                for bucket in buckets:
+                    bucket.tokens -= 1
+                metrics.incr(f'ratelimit.{kind}.delayed')
+                return ALLOW, wait
+            policy = DROP
+        if policy == DISCONNECT:
+            metrics.incr(f'ratelimit.{kind}.disconnected')
+            return DISCONNECT, 0.0
+        metrics.incr(f'ratelimit.{kind}.dropped')
+        return DROP, 0.0
@@ -0,0 +1,148 @@
+# core/receipts.py
+# Read state. Clients ack cumulatively ("read up to seq X"); acks are kept
+# in memory, only the highest per (user, conversation) survives, and they
+# are written in batches every CHAT_READ_FLUSH_INTERVAL seconds. A user
+# scrolling through a busy room costs one row update per batch rather than
+# one per message. The same batch is pushed to the conversation's group as
+# one "receipts" frame.
+#
+# Unread counts are derived from ReadState and the message store, for all
+# of a user's conversations in one query.
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import BigIntegerField, Case, F, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from . import metrics
+from .db import database
+from .frames import frame_event
+from .models import ChatMessage, Conversation, ReadState
+
+logger = logging.getLogger(__name__)
+
+# Badges show "99+" past this; counting stops there.
+UNREAD_CAP = 100
+# Acks per upsert; keeps the UPDATE's OR/CASE lists within SQLite's limits.
+BATCH_SIZE = 200
+
+
+class SubqueryCount(Subquery):
+    # COUNT(*) over a (limited) subquery; Django has no direct spelling.
+    template = '(SELECT COUNT(*) FROM (%(subquery)s) _count)'
+    output_field = IntegerField()
+
+
+class ReadTracker:
+    def __init__(self, flush_interval=2.0):
+        self.flush_interval = flush_interval
+        self._acks = {}       # (user_id, conversation_id) -> highest seq acked
+        self._receipts = {}   # conversation_id -> (group, {username: seq})
+        self._loop = None
+        self._task = None
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._task = None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    def ack(self, user_id, username, conversation_id, seq, group):
+        self._bind_loop()
+        metrics.incr('receipts.acks')
+        key = (user_id, conversation_id)
+        if seq <= self._acks.get(key, 0):
+            return
+        self._acks[key] = seq
+        self._receipts.setdefault(conversation_id, (group, {}))[1][username] = seq
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        receipts, self._receipts = self._receipts, {}
+        for conversation_id, (group, seqs) in receipts.items():
+            try:
+                await get_channel_layer().group_send(group, frame_event({'type': 'receipts', 'read': seqs}))
+            except Exception:
+                logger.exception("Failed to push read receipts for conversation %s", conversation_id)
+        if not self._acks:
+            return
+        acks, self._acks = self._acks, {}
+        try:
+            await database.write(self._persist, acks)
+        except Exception:
+            logger.exception("Failed to persist %d read acks", len(acks))
+
+    def _persist(self, acks):
+        started = time.perf_counter()
+        with transaction.atomic():
+            self._upsert(self._resolvable(acks))
+        metrics.observe('receipts.flush', time.perf_counter() - started)
+        metrics.incr('receipts.flushed', len(acks))
+
+    def _resolvable(self, acks):
+        # Acks for users or conversations deleted since are dropped: one
+        # such row would fail the whole upsert.
+        users = set(User.objects.filter(pk__in={user_id for user_id, _ in acks}).values_list('pk', flat=True))
+        conversations = set(Conversation.objects.filter(
+            pk__in={conversation_id for _, conversation_id in acks},
+        ).values_list('pk', flat=True))
+        items = [(key, seq) for key, seq in acks.items() if key[0] in users and key[1] in conversations]
+        if len(items) < len(acks):
+            metrics.incr('receipts.unresolved', len(acks) - len(items))
+        return items
+
+    def _upsert(self, items):
+        for start in range(0, len(items), BATCH_SIZE):
+            batch = items[start:start + BATCH_SIZE]
+            ReadState.objects.bulk_create(
+                [ReadState(user_id=user_id, conversation_id=conversation_id, last_read_seq=seq)
+                 for (user_id, conversation_id), seq in batch],
+                ignore_conflicts=True,
+            )
+            # Rows that already existed only ever move forward, so a stale
+            # tab or another worker acking an older seq cannot rewind them.
+            whens = [When(user_id=user_id, conversation_id=conversation_id, then=Value(seq))
+                     for (user_id, conversation_id), seq in batch]
+            matches = Q()
+            for (user_id, conversation_id), _ in batch:
+                matches |= Q(user_id=user_id, conversation_id=conversation_id)
+            ReadState.objects.filter(matches).update(
+                last_read_seq=Greatest(F('last_read_seq'), Case(*whens, default=F('last_read_seq'),
+                                                                output_field=BigIntegerField())),
+            )
+
+
+def unread_counts(user):
+    """
+    Unread messages per conversation the user can see, capped at
+    UNREAD_CAP, as a list of dicts with the conversation's room or private
+    chat participants. One query.
+    """
+    read_seq = Coalesce(
+        Subquery(ReadState.objects.filter(user=user, conversation=OuterRef('pk')).values('last_read_seq')[:1]),
+        0,
+    )
+    unread = ChatMessage.objects.filter(
+        conversation=OuterRef('pk'), seq__gt=OuterRef('read_seq'),
+    ).exclude(sender=user).values('pk')[:UNREAD_CAP]
+    return list(
+        Conversation.objects.filter(
+            Q(kind=Conversation.ROOM) | Q(private_room__user1=user) | Q(private_room__user2=user),
+        ).annotate(read_seq=read_seq, unread=SubqueryCount(unread)).values(
+            'id', 'room_id', 'private_room__user1_id', 'private_room__user2_id', 'unread',
+        )
+    )
+
+
+receipts = ReadTracker(flush_interval=getattr(settings, 'CHAT_READ_FLUSH_INTERVAL', 2.0))
@@ -0,0 +1,194 @@
+# core/recent.py
+# Per-conversation ring buffers of the most recent message frames. They
+# serve two readers: sockets that reconnect with ?since=<seq> and get what
+# they missed, and the latest history page (home view, history endpoint,
+# websocket history requests), so opening a hot room skips the DB.
+#
+# Buffers are filled from the chat.frame events a conversation's group
+# delivers to this process, which includes messages sent through other
+# workers, and on a read miss from the DB. Each buffer knows the seq from
+# which it is complete. With a channel layer shared between processes a
+# buffer only stays complete while a local socket is in the group, so it
+# is dropped when the last one leaves; with the in-memory layer every
+# message passes through this process and idle buffers are kept.
+#
+# Buffers are evicted least recently used first once there are more than
+# CHAT_RECENT_MAX_ROOMS of them or their frames exceed CHAT_RECENT_MAX_BYTES.
+import sys
+import threading
+from collections import OrderedDict, deque
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+
+from . import metrics
+
+
+class RoomBuffer:
+    def __init__(self, size):
+        self.entries = deque(maxlen=size)   # (seq, encoded frame), ascending seq
+        self.floor = None                   # every message after this seq is in entries
+        self.bytes = 0
+
+    def add(self, seq, text):
+        entries = self.entries
+        if self.floor is None:
+            self.floor = seq - 1
+        elif seq <= self.floor:
+            return
+        if entries and seq <= entries[-1][0]:
+            # Every local member of the group hands us the same frame, so
+            # the newest entry is the usual duplicate. Anything else is a
+            # frame that overtook a lower seq sent through another worker.
+            if seq == entries[-1][0] or any(s == seq for s, _ in entries):
+                return
+            self._append(seq, text)
+            self.entries = deque(sorted(self.entries), maxlen=entries.maxlen)
+            return
+        self._append(seq, text)
+
+    def fill(self, items, floor):
+        """
+        Merge frames read from the DB: every message after `floor` up to the
+        last item. Ignored if it would leave a hole before what we hold.
+        """
+        if not items or (self.floor is not None and items[-1][0] < self.floor):
+            return
+        merged = dict(self.entries)
+        merged.update(items)
+        self.floor = floor if self.floor is None else min(self.floor, floor)
+        self.entries = deque(maxlen=self.entries.maxlen)
+        self.bytes = 0
+        for seq in sorted(merged):
+            self._append(seq, merged[seq])
+
+    def _append(self, seq, text):
+        if len(self.entries) == self.entries.maxlen:
+            evicted_seq, evicted = self.entries.popleft()
+            self.floor = evicted_seq
+            self.bytes -= sys.getsizeof(evicted)
+        self.entries.append((seq, text))
+        self.bytes += sys.getsizeof(text)
+
+    def after(self, seq):
+        """Frames of every message after seq, or None if the buffer can't tell."""
+        if self.floor is None or seq < self.floor:
+            return None
+        return [text for s, text in self.entries if s > seq]
+
+    def page(self, before, limit):
+        """
+        The newest `limit` frames before seq `before` (None for the latest)
+        and the next history cursor, or None if the buffer can't tell.
+        """
+        if self.floor is None:
+            return None
+        items = [(s, text) for s, text in self.entries if before is None or s < before]
+        if len(items) < limit and self.floor > 0:
+            return None
+        items = items[-limit:]
+        if items:
+            more = self.floor > 0 or items[0][0] > self.entries[0][0]
+            cursor = str(items[0][0]) if more else None
+        else:
+            cursor = None
+        return {'frames': [text for _, text in items], 'next': cursor}
+
+
+class RecentMessages:
+    def __init__(self, size=200, max_rooms=1000, max_bytes=64 * 1024 * 1024):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self._buffers = OrderedDict()   # conversation_id -> RoomBuffer, LRU first
+        self._subscribers = {}          # conversation_id -> local sockets in the group
+        self._bytes = 0
+        self._lock = threading.Lock()   # the home view reads from request threads
+        self._retain_idle = None
+
+    def retain_idle(self):
+        if self._retain_idle is None:
+            self._retain_idle = isinstance(get_channel_layer(), InMemoryChannelLayer)
+        return self._retain_idle
+
+    def subscribe(self, conversation_id):
+        with self._lock:
+            self._subscribers[conversation_id] = self._subscribers.get(conversation_id, 0) + 1
+
+    def unsubscribe(self, conversation_id):
+        with self._lock:
+            count = self._subscribers.get(conversation_id, 0) - 1
+            if count > 0:
+                self._subscribers[conversation_id] = count
+                return
+            self._subscribers.pop(conversation_id, None)
+            if not self.retain_idle():
+                self._drop(conversation_id)
+
+    def add(self, conversation_id, seq, text):
+        with self._lock:
+            buffer = self._buffers.get(conversation_id)
+            if buffer is None:
+                if conversation_id not in self._subscribers:
+                    return
+                buffer = self._buffers[conversation_id] = RoomBuffer(self.size)
+            self._update(conversation_id, buffer, buffer.add, seq, text)
+
+    def fill(self, conversation_id, items, floor):
+        with self._lock:
+            if conversation_id not in self._subscribers and not self.retain_idle():
+                return
+            buffer = self._buffers.get(conversation_id)
+            if buffer is None:
+                buffer = self._buffers[conversation_id] = RoomBuffer(self.size)
+            self._update(conversation_id, buffer, buffer.fill, items, floor)
+
+    def after(self, conversation_id, seq):
+        return self._read(conversation_id, 'after', seq)
+
+    def page(self, conversation_id, before=None, limit=50):
+        return self._read(conversation_id, 'page', before, limit)
+
+    def invalidate(self, conversation_id):
+        with self._lock:
+            self._drop(conversation_id)
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+            self._bytes = 0
+
+    def _read(self, conversation_id, method, *args):
+        with self._lock:
+            buffer = self._buffers.get(conversation_id)
+            result = None if buffer is None else getattr(buffer, method)(*args)
+            if result is None:
+                metrics.incr('recent.misses')
+            else:
+                metrics.incr('recent.hits')
+                self._buffers.move_to_end(conversation_id)
+            return result
+
+    def _update(self, conversation_id, buffer, method, *args):
+        before = buffer.bytes
+        method(*args)
+        self._bytes += buffer.bytes - before
+        self._buffers.move_to_end(conversation_id)
+        while self._buffers and (len(self._buffers) > self.max_rooms or self._bytes > self.max_bytes):
+            evicted_id = next(iter(self._buffers))
+            self._drop(evicted_id)
+            metrics.incr('recent.evictions')
+        metrics.set_gauge('recent.rooms', len(self._buffers))
+        metrics.set_gauge('recent.bytes', self._bytes)
+
+    def _drop(self, conversation_id):
+        buffer = self._buffers.pop(conversation_id, None)
+        if buffer is not None:
+            self._bytes -= buffer.bytes
+
+
+recent = RecentMessages(
+    size=getattr(settings, 'CHAT_RECENT_MESSAGES', 200),
+    max_rooms=getattr(settings, 'CHAT_RECENT_MAX_ROOMS', 1000),
+    max_bytes=getattr(settings, 'CHAT_RECENT_MAX_BYTES', 64 * 1024 * 1024),
+)
@@ -4,4 +4,5 @@ from . import consumers
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<room_name>[^/]+)/$', consumers.ChatConsumer.as_asgi()),
     re_path(r'ws/private/(?P<room_slug>[\w_]+)/$', consumers.PrivateChatConsumer.as_asgi()),
+    re_path(r'ws/presence/$', consumers.PresenceConsumer.as_asgi()),
 ]
@@ -0,0 +1,136 @@
+# core/search.py
+# Message search across rooms and private chats. The backend is pluggable
+# through CHAT_SEARCH_BACKEND; on SQLite the default keeps an FTS5 inverted
+# index that the write-behind writer updates as it persists messages. Its
+# rowids are message ids, and a trigger (migration 0017) removes a
+# message's row when the message or its room is deleted.
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from .models import ChatMessage, Conversation
+
+ROOM = Conversation.ROOM
+PRIVATE = Conversation.PRIVATE
+PAGE_SIZE = 20
+FTS_TABLE = 'core_message_fts'
+
+
+def visible_private_conversations(user):
+    return Conversation.objects.filter(
+        Q(private_room__user1=user) | Q(private_room__user2=user),
+    ).values_list('id', flat=True)
+
+
+def entries_for(objs):
+    """Index entries (kind, message id, conversation id, content) for saved messages."""
+    objs = [obj for obj in objs if obj.pk is not None]
+    kinds = dict(Conversation.objects.filter(
+        id__in={obj.conversation_id for obj in objs},
+    ).values_list('id', 'kind'))
+    return [(kinds[obj.conversation_id], obj.pk, obj.conversation_id, obj.content)
+            for obj in objs if obj.conversation_id in kinds]
+
+
+def with_rooms(queryset):
+    return queryset.select_related('sender', 'conversation__room', 'conversation__private_room')
+
+
+class DatabaseSearchBackend:
+    """Fallback for databases without a text index: substring scan, newest first."""
+
+    def index(self, entries):
+        pass
+
+    def search(self, query, user, limit=PAGE_SIZE, offset=0):
+        messages = with_rooms(ChatMessage.objects.filter(
+            Q(conversation__kind=ROOM) | Q(conversation__in=visible_private_conversations(user)),
+            content__icontains=query,
+        ))
+        return [serialize(m) for m in messages.order_by('-timestamp', '-id')[offset:offset + limit]]
+
+
+class SQLiteFTSBackend:
+    """
+    FTS5 index ranked with bm25; the table is created by migration 0017.
+
+    Ranking every match of a very common term costs seconds at 1M+ rows, so
+    only the newest CHAT_SEARCH_MAX_CANDIDATES matches the user may see are
+    ranked. Finding that window is a walk down the term's doclist, which is
+    cheap.
+    """
+
+    def __init__(self):
+        self.max_candidates = getattr(settings, 'CHAT_SEARCH_MAX_CANDIDATES', 2000)
+
+    def index(self, entries):
+        if not entries:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT OR REPLACE INTO {FTS_TABLE} (kind, rowid, message_id, conversation_id, content) '
+                f'VALUES (%s, %s, %s, %s, %s)',
+                [(kind, pk, pk, conversation_id, content) for kind, pk, conversation_id, content in entries],
+            )
+
+    def search(self, query, user, limit=PAGE_SIZE, offset=0):
+        match = fts_query(query)
+        if not match:
+            return []
+        private_ids = list(visible_private_conversations(user))
+        placeholders = ', '.join(['%s'] * len(private_ids)) or 'NULL'
+        visible = f"(kind = 'room' OR conversation_id IN ({placeholders}))"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND {visible} '
+                f'ORDER BY rowid DESC LIMIT 1 OFFSET %s',
+                [match, *private_ids, self.max_candidates - 1],
+            )
+            row = cursor.fetchone()
+            floor = row[0] if row else 0
+            cursor.execute(
+                f"SELECT message_id FROM {FTS_TABLE} "
+                f"WHERE {FTS_TABLE} MATCH %s AND rowid >= %s AND {visible} "
+                f"ORDER BY rank LIMIT %s OFFSET %s",
+                [match, floor, *private_ids, limit, offset],
+            )
+            ranked = [pk for pk, in cursor.fetchall()]
+
+        messages = with_rooms(ChatMessage.objects).in_bulk(ranked)
+        # A message deleted since the query ran is skipped.
+        return [serialize(messages[pk]) for pk in ranked if pk in messages]
+
+
+def fts_query(query):
+    # Quote every term so user input can't produce FTS syntax errors; the
+    # last term matches as a prefix for search-as-you-type.
+    terms = [term.replace('"', '""') for term in query.split()]
+    if not terms:
+        return ''
+    return ' '.join(f'"{term}"' for term in terms) + '*'
+
+
+def serialize(message):
+    conversation = message.conversation
+    return {
+        'kind': conversation.kind,
+        'id': message.id,
+        'seq': message.seq,
+        'room': conversation.room.slug if conversation.room else conversation.private_room.room_slug,
+        'message': message.content,
+        'username': message.sender.username,
+        'name': message.sender.first_name or message.sender.username,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    path = getattr(settings, 'CHAT_SEARCH_BACKEND', None)
+    if path is None:
+        path = ('core.search.SQLiteFTSBackend' if connection.vendor == 'sqlite'
+                else 'core.search.DatabaseSearchBackend')
+    return import_string(path)()
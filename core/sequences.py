@@ -0,0 +1,149 @@
+# core/sequences.py
+# Per-conversation message sequence numbers. The consumers number a
+# message before broadcasting it, so numbering cannot wait for the
+# write-behind flush.
+#
+# With the in-memory channel layer one process serves every room. It
+# leases blocks of CHAT_SEQ_BLOCK_SIZE numbers at a time by bumping
+# Conversation.last_seq and hands them out from memory: one UPDATE per
+# block, not per message. Unused numbers of a block are lost on restart,
+# so there can be gaps.
+#
+# With a shared layer several workers number messages in the same room,
+# and the clients, the replay buffer and read acks all take a lower seq
+# for one already seen, so numbers must increase across workers. They
+# come from a counter next to the layer instead (the broker's, or Redis
+# for channels_redis): one round trip per message, and no database write.
+# A counter starts from the highest number the database knows of. If the
+# broker or Redis loses it, it restarts from there, so only messages
+# numbered in the last flush interval before the loss can be reused.
+# Other layers fall back to leasing one number at a time.
+import asyncio
+from collections import deque
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from . import metrics
+from .db import database
+from .models import ChatMessage, Conversation
+
+MEMORY_LAYER = 'channels.layers.InMemoryChannelLayer'
+BROKER_LAYER = 'core.broker.BrokerChannelLayer'
+
+# INCR that never goes below ARGV[1] + 1; see Broker.handle_client.
+REDIS_INCR = """
+local value = math.max(tonumber(redis.call('GET', KEYS[1]) or '0'), tonumber(ARGV[1])) + 1
+redis.call('SET', KEYS[1], value)
+return value
+"""
+
+
+def high_water():
+    # last_seq, unless numbers were handed out by a shared counter since.
+    stored = ChatMessage.objects.filter(conversation_id=OuterRef('pk')).order_by('-seq').values('seq')[:1]
+    return Greatest(F('last_seq'), Coalesce(Subquery(stored), 0))
+
+
+def lease(conversation_id, count):
+    """Reserve `count` numbers; returns the last one of the block."""
+    with transaction.atomic():
+        Conversation.objects.filter(pk=conversation_id).update(last_seq=high_water() + count)
+        last = Conversation.objects.values_list('last_seq', flat=True).get(pk=conversation_id)
+    metrics.incr('sequences.leases')
+    return last
+
+
+def floor(conversation_id):
+    """The highest number the database knows was handed out."""
+    return (Conversation.objects.filter(pk=conversation_id).annotate(top=high_water())
+            .values_list('top', flat=True).first() or 0)
+
+
+class SequenceAllocator:
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self._blocks = {}   # conversation_id -> deque of [next, last] ranges
+
+    async def next(self, conversation_id):
+        blocks = self._blocks.setdefault(conversation_id, deque())
+        while not blocks:
+            # Coroutines that miss at the same time each lease a block;
+            # both blocks are kept and used in order.
+            last = await database.write(lease, conversation_id, self.block_size)
+            blocks.append([last - self.block_size + 1, last])
+        block = blocks[0]
+        seq = block[0]
+        if seq == block[1]:
+            blocks.popleft()
+        else:
+            block[0] += 1
+        return seq
+
+    def forget(self, conversation_id):
+        self._blocks.pop(conversation_id, None)
+
+
+class SharedSequenceAllocator:
+    """Numbers from `counter(key, floor)`, an atomic increment shared by every worker."""
+
+    def __init__(self, counter):
+        self.counter = counter
+        self._floors = {}   # conversation_id -> floor last read from the database
+
+    async def next(self, conversation_id):
+        key = f'chat:seq:{conversation_id}'
+        known = self._floors.get(conversation_id)
+        stale = known is not None
+        if not stale:
+            known = self._floors[conversation_id] = await database.run(floor, conversation_id)
+        seq = await self.counter(key, known)
+        if seq == known + 1 and stale:
+            # The counter started over from our floor, which may be older
+            # than what other workers have stored since.
+            fresh = self._floors[conversation_id] = await database.run(floor, conversation_id)
+            if fresh >= seq:
+                metrics.incr('sequences.reseeded')
+                seq = await self.counter(key, fresh)
+        metrics.incr('sequences.shared')
+        return seq
+
+    def forget(self, conversation_id):
+        self._floors.pop(conversation_id, None)
+
+
+class RedisCounter:
+    def __init__(self, url):
+        self.url = url
+        self._loop = None
+        self._script = None
+
+    async def __call__(self, key, floor):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # redis-py comes with channels_redis.
+            from redis.asyncio import Redis
+            self._loop = loop
+            self._script = Redis.from_url(self.url).register_script(REDIS_INCR)
+        return int(await self._script(keys=[key], args=[floor]))
+
+
+def layer_counter(key, floor):
+    return get_channel_layer().incr(key, floor)
+
+
+def make_allocator():
+    backend = settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND', '')
+    if backend == MEMORY_LAYER:
+        return SequenceAllocator(block_size=getattr(settings, 'CHAT_SEQ_BLOCK_SIZE', 100))
+    if backend == BROKER_LAYER:
+        return SharedSequenceAllocator(layer_counter)
+    if backend.startswith('channels_redis.'):
+        return SharedSequenceAllocator(RedisCounter(getattr(settings, 'REDIS_URL', 'redis://127.0.0.1:6379/0')))
+    return SequenceAllocator(block_size=1)
+
+
+sequences = make_allocator()
@@ -1,7 +1,11 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_init, post_save
 from django.contrib.auth.models import User
 from django.dispatch import receiver
-from .models import UserProfile
+from .media import release, retain
+from .models import Conversation, PrivateRoom, Room, UserProfile
+from .persistence import messages_persisted
+from .search import entries_for, get_backend
+from .typeahead import index as typeahead_index
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -10,4 +14,57 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
-    instance.userprofile.save()
\ No newline at end of file
+    # Accounts created before this signal was connected may have no profile.
+    if hasattr(instance, 'userprofile'):
+        instance.userprofile.save()
+
+@receiver(post_init, sender=UserProfile)
+def remember_profile_pic(sender, instance, **kwargs):
+    # The stored name, read without building a FieldFile. None when the
+    # field was deferred; such saves are left to collect_media.
+    if 'profile_pic' in instance.__dict__:
+        value = instance.__dict__['profile_pic']
+        instance._stored_pic = getattr(value, 'name', value) or ''
+    else:
+        instance._stored_pic = None
+
+@receiver(post_save, sender=UserProfile)
+def count_profile_pic_references(sender, instance, **kwargs):
+    old, new = instance._stored_pic, instance.profile_pic.name or ''
+    if old is None or old == new:
+        return
+    if new:
+        retain(new)
+    if old:
+        release(old, instance.profile_pic.storage)
+    instance._stored_pic = new
+
+@receiver(post_delete, sender=UserProfile)
+def release_profile_pic(sender, instance, **kwargs):
+    if instance._stored_pic:
+        release(instance._stored_pic, instance.profile_pic.storage)
+
+@receiver(post_save, sender=User)
+def update_typeahead(sender, instance, **kwargs):
+    if instance.is_active:
+        typeahead_index.update(instance.id, instance.username, instance.first_name)
+    else:
+        typeahead_index.remove(instance.id)
+
+@receiver(post_delete, sender=User)
+def remove_from_typeahead(sender, instance, **kwargs):
+    typeahead_index.remove(instance.id)
+
+@receiver(post_save, sender=Room)
+def create_room_conversation(sender, instance, created, **kwargs):
+    if created:
+        Conversation.objects.create(kind=Conversation.ROOM, room=instance)
+
+@receiver(post_save, sender=PrivateRoom)
+def create_private_conversation(sender, instance, created, **kwargs):
+    if created:
+        Conversation.objects.create(kind=Conversation.PRIVATE, private_room=instance)
+
+@receiver(messages_persisted)
+def index_messages(sender, objs, **kwargs):
+    get_backend().index(entries_for(objs))
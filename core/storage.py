@@ -0,0 +1,73 @@
+# core/storage.py
+# Content-addressed storage for uploads. An upload is hashed while it is
+# streamed to a temporary file next to its destination, then stored once
+# under its SHA-256:
+#
+#     profiles/3f/3fa2...9c.jpg
+#
+# Uploading the same bytes again reuses that file instead of writing a copy
+# under a new collision-avoiding name. Reference counting and removal of
+# files nothing refers to any more live in core/media.py. A name never
+# changes content, so these URLs (and the thumbnails rendered from them)
+# can be cached for good: CACHE_CONTROL.
+#
+# Django only serves /media/ with DEBUG on (core.views.serve_media, which
+# adds the header). In production the front server serves MEDIA_ROOT and
+# has to send it, e.g. for nginx:
+#
+#     location ~ "^/media/(.*/)?[0-9a-f]{2}/[0-9a-f]{64}\.\w+$" {
+#         root /srv/chatapp;
+#         add_header Cache-Control "public, max-age=31536000, immutable";
+#     }
+#
+# A remote storage backend would set it on the object at upload instead.
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+from . import metrics
+
+HASHED_NAME = re.compile(r'(^|/)[0-9a-f]{2}/[0-9a-f]{64}\.\w+$')
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+@deconstructible(path='core.storage.HashedStorage')
+class HashedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # The name is only known once the content has been read; see _save().
+        return name
+
+    def _save(self, name, content):
+        directory = posixpath.dirname(name)
+        extension = posixpath.splitext(name)[1].lower()
+        os.makedirs(self.path(directory), exist_ok=True)
+        digest = hashlib.sha256()
+        fd, temp = tempfile.mkstemp(dir=self.path(directory), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    f.write(chunk)
+            hexdigest = digest.hexdigest()
+            name = posixpath.join(directory, hexdigest[:2], hexdigest + extension)
+            target = self.path(name)
+            if os.path.exists(target):
+                # A fresh mtime keeps the file from being collected while
+                # the row that reuses it is still being saved.
+                os.utime(target)
+                metrics.incr('storage.deduplicated')
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.chmod(temp, self.file_permissions_mode if self.file_permissions_mode is not None else 0o644)
+                os.replace(temp, target)
+                temp = None
+                metrics.incr('storage.stored')
+        finally:
+            if temp is not None:
+                os.unlink(temp)
+        return name
@@ -0,0 +1,15 @@
+# core/templatetags/avatars.py
+from django import template
+
+from ..thumbnails import thumbnails
+
+register = template.Library()
+
+
+@register.simple_tag
+def avatar_url(profile_pic, size):
+    """{% avatar_url profile.profile_pic 80 %}: a thumbnail at least `size` pixels wide."""
+    name = getattr(profile_pic, 'name', profile_pic)
+    if not name:
+        return ''
+    return thumbnails.url(name, size)
@@ -1,3 +1,845 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import sys
+import tempfile
+import zlib
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import OperationalError, connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import Resolver404, resolve
+from PIL import Image
+
+from . import export, frames, search, sequences, typeahead
+from .broker import BrokerChannelLayer, serve
+from .consumers import ChatConsumer, RateLimitedConsumer
+from .db import DatabaseBusy, DatabaseLimiter
+from .models import ChatMessage, Conversation, PrivateRoom, ReadState, Room, StoredFile, UserProfile
+from .persistence import MessageWriter
+from .presence import GROUP as PRESENCE_GROUP, PresenceRegistry
+from .ratelimit import ALLOW, DISCONNECT, DROP, RateLimiter
+from .receipts import ReadTracker, unread_counts
+from .recent import RecentMessages, RoomBuffer, recent
+from .storage import CACHE_CONTROL
+from .thumbnails import SIZES, ThumbnailPool, thumbnail_name
+from .typing_indicator import TypingIndicator
+from .views import serve_media
+
+
+class BrokerChannelLayerTests(SimpleTestCase):
+    async def test_group_send_reaches_every_worker(self):
+        server = await serve('127.0.0.1', 0)
+        address = '127.0.0.1:%d' % server.sockets[0].getsockname()[1]
+        # Each layer instance stands in for a separate worker process.
+        workers = [BrokerChannelLayer(address) for _ in range(3)]
+        try:
+            channels = []
+            for layer in workers:
+                channel = await layer.new_channel()
+                await layer.group_add('lobby', channel)
+                channels.append(channel)
+
+            await workers[0].group_send('lobby', {'type': 'chat.message', 'text': 'hi'})
+
+            for layer, channel in zip(workers, channels):
+                message = await asyncio.wait_for(layer.receive(channel), 2)
+                self.assertEqual(message, {'type': 'chat.message', 'text': 'hi'})
+        finally:
+            for layer in workers:
+                await layer.close()
+            server.close()
+            await server.wait_closed()
+
+    async def test_discarded_channel_stops_receiving(self):
+        server = await serve('127.0.0.1', 0)
+        address = '127.0.0.1:%d' % server.sockets[0].getsockname()[1]
+        sender, receiver = BrokerChannelLayer(address), BrokerChannelLayer(address)
+        try:
+            channel = await receiver.new_channel()
+            await receiver.group_add('lobby', channel)
+            await receiver.group_discard('lobby', channel)
+            await sender.group_send('lobby', {'type': 'chat.message'})
+            await sender.send(channel, {'type': 'direct'})
+
+            message = await asyncio.wait_for(receiver.receive(channel), 2)
+            self.assertEqual(message['type'], 'direct')
+        finally:
+            await sender.close()
+            await receiver.close()
+            server.close()
+            await server.wait_closed()
+
+
+class RoomBufferTests(SimpleTestCase):
+    def test_replays_only_what_it_has_seen(self):
+        buffer = RoomBuffer(size=3)
+        self.assertIsNone(buffer.after(0))
+        for seq in (5, 6, 6, 7):
+            buffer.add(seq, f'm{seq}')
+        self.assertEqual(buffer.after(5), ['m6', 'm7'])
+        self.assertIsNone(buffer.after(3))
+
+    def test_eviction_moves_the_floor(self):
+        buffer = RoomBuffer(size=2)
+        for seq in (1, 2, 4, 3):
+            buffer.add(seq, f'm{seq}')
+        self.assertEqual(buffer.after(2), ['m3', 'm4'])
+        self.assertIsNone(buffer.after(1))
+
+
+
+class RecentMessagesTests(SimpleTestCase):
+    def make(self, **kwargs):
+        cache = RecentMessages(size=10, **kwargs)
+        for conversation_id in (1, 2, 3):
+            cache.subscribe(conversation_id)
+        return cache
+
+    def test_least_recently_used_room_is_evicted(self):
+        cache = self.make(max_rooms=2)
+        cache.add(1, 1, 'a')
+        cache.add(2, 1, 'b')
+        self.assertEqual(cache.after(1, 0), ['a'])
+        cache.add(3, 1, 'c')
+        self.assertIsNone(cache.after(2, 0))
+        self.assertEqual(cache.after(1, 0), ['a'])
+        self.assertEqual(cache.after(3, 0), ['c'])
+
+    def test_byte_cap_evicts_the_oldest_rooms(self):
+        text = 'x' * 100
+        cache = self.make(max_bytes=sys.getsizeof(text) * 2)
+        for conversation_id in (1, 2, 3):
+            cache.add(conversation_id, 1, text)
+        self.assertEqual(list(cache._buffers), [2, 3])
+        self.assertEqual(cache._bytes, sum(buffer.bytes for buffer in cache._buffers.values()))
+
+    def test_invalidate_forgets_the_room(self):
+        cache = self.make()
+        cache.add(1, 1, 'a')
+        cache.invalidate(1)
+        self.assertIsNone(cache.after(1, 0))
+        self.assertEqual(cache._bytes, 0)
+
+
+class DatabaseLimiterTests(SimpleTestCase):
+    def test_sheds_callers_once_the_wait_runs_out(self):
+        limiter = DatabaseLimiter(concurrency=1, timeout=0.05)
+
+        async def run():
+            async with limiter.slot():
+                with self.assertRaises(DatabaseBusy):
+                    async with limiter.slot():
+                        pass
+            async with limiter.slot():
+                return limiter.in_flight
+
+        self.assertEqual(asyncio.run(run()), 1)
+
+    def test_slot_recycles_stale_connections_first(self):
+        limiter = DatabaseLimiter()
+
+        async def run():
+            with mock.patch('core.db.aclose_old_connections') as close:
+                async with limiter.slot():
+                    return close.await_count
+
+        self.assertEqual(asyncio.run(run()), 1)
+
+
+class RecordingWriter(MessageWriter):
+    """Collects the batches it would have written."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+
+    def _write_batch(self, batch):
+        self.batches.append([row['n'] for row in batch])
+
+
+class FlakyWriter(RecordingWriter):
+    """Fails its first `failures` writes the way a locked SQLite file does."""
+
+    def __init__(self, failures, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    def _write_batch(self, batch):
+        if self.failures:
+            self.failures -= 1
+            raise OperationalError('database is locked')
+        super()._write_batch(batch)
+
+
+class MessageWriterTests(SimpleTestCase):
+    def test_full_batch_is_written_at_once_and_the_rest_at_exit(self):
+        writer = RecordingWriter(batch_size=3, max_delay=60)
+
+        async def run():
+            for n in range(3):
+                await writer.put(dict, n=n)
+            await asyncio.sleep(0.1)
+            await writer.put(dict, n=3)
+            return list(writer.batches)
+
+        self.assertEqual(asyncio.run(run()), [[0, 1, 2]])
+        # What runs at exit for rows the loop never got to.
+        writer.flush_sync()
+        self.assertEqual(writer.batches, [[0, 1, 2], [3]])
+
+    def test_partial_batch_is_written_after_the_delay(self):
+        writer = RecordingWriter(batch_size=100, max_delay=0.05)
+
+        async def run():
+            await writer.put(dict, n=1)
+            self.assertEqual(writer.batches, [])
+            await asyncio.sleep(0.3)
+            return writer.batches
+
+        self.assertEqual(asyncio.run(run()), [[1]])
+
+    def test_full_queue_makes_the_producer_flush(self):
+        writer = RecordingWriter(batch_size=100, max_delay=60, max_pending=2)
+
+        async def run():
+            for n in range(3):
+                await writer.put(dict, n=n)
+            return writer.batches, len(writer._pending)
+
+        self.assertEqual(asyncio.run(run()), ([[0, 1]], 1))
+
+    def test_locked_database_retries_the_batch_in_order(self):
+        writer = FlakyWriter(2, batch_size=2, max_delay=60, retry_delay=0.01)
+
+        async def run():
+            for n in range(3):
+                await writer.put(dict, n=n)
+            await writer.flush()
+            return writer.batches
+
+        with self.assertLogs('core.persistence', 'WARNING'):
+            self.assertEqual(asyncio.run(run()), [[0, 1], [2]])
+
+    def test_batch_is_dropped_after_the_last_retry(self):
+        writer = FlakyWriter(3, batch_size=2, max_delay=60, retries=2, retry_delay=0)
+
+        async def run():
+            for n in range(3):
+                await writer.put(dict, n=n)
+            await writer.flush()
+            return writer.batches
+
+        with self.assertLogs('core.persistence', 'ERROR'):
+            self.assertEqual(asyncio.run(run()), [[2]])
+
+
+class MessageWriterRowTests(TestCase):
+    def test_rows_for_a_deleted_room_do_not_sink_the_batch(self):
+        user = User.objects.create_user('writer')
+        kept, gone = (Room.objects.create(name=name, created_by=user) for name in ('room1', 'room2'))
+        batch = [
+            ChatMessage(conversation_id=kept.conversation.id, seq=1, sender_id=user.id, content='keep me'),
+            ChatMessage(conversation_id=gone.conversation.id, seq=1, sender_id=user.id, content='room gone'),
+        ]
+        gone.delete()
+        MessageWriter()._write_batch(batch)
+        self.assertEqual(list(ChatMessage.objects.values_list('content', flat=True)), ['keep me'])
+
+
+class PresencePersistenceTests(TestCase):
+    def test_a_deleted_user_does_not_sink_the_batch(self):
+        stays, leaves = User.objects.create_user('stays'), User.objects.create_user('leaves')
+        changes = {stays.id: True, leaves.id: True}
+        leaves.delete()
+        PresenceRegistry()._persist(changes)
+        self.assertTrue(UserProfile.objects.get(user=stays).is_online)
+
+
+class PresenceRegistryTests(SimpleTestCase):
+    def test_heartbeat_brings_back_an_expired_socket(self):
+        registry = PresenceRegistry(ttl=0)
+
+        async def run():
+            registry.connect(1, 'tab', 'sleepy')
+            registry.expire()
+            self.assertFalse(registry.is_online(1))
+            registry.heartbeat('tab', 1, 'sleepy')
+            return registry.is_online(1)
+
+        self.assertTrue(asyncio.run(run()))
+
+    def test_offline_waits_for_the_other_workers(self):
+        # Two registries on one layer stand in for two worker processes.
+        first, second = (PresenceRegistry(tick=0.02, flush_interval=3600) for _ in range(2))
+
+        async def offline_frames(layer, channel):
+            names = []
+            while True:
+                try:
+                    event = await asyncio.wait_for(layer.receive(channel), 0.3)
+                except asyncio.TimeoutError:
+                    return names
+                names += frames.loads(event['text'])['offline']
+
+        async def run():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add(PRESENCE_GROUP, channel)
+            first.connect(1, 'tab-on-first', 'both')
+            second.connect(1, 'tab-on-second', 'both')
+            await offline_frames(layer, channel)
+            second.disconnect('tab-on-second')
+            still_connected = await offline_frames(layer, channel)
+            first.disconnect('tab-on-first')
+            return still_connected, await offline_frames(layer, channel)
+
+        self.assertEqual(asyncio.run(run()), ([], ['both']))
+
+
+class FrameCodecTests(SimpleTestCase):
+    def test_deflate_stream_inflates_frame_by_frame(self):
+        codec = frames.negotiate(['chat.unknown', 'chat.deflate'])
+        inflater = zlib.decompressobj(-frames.DEFLATE_WBITS)
+        for text in ('{"message":"hi"}', '{"message":"hi"}', '{"type":"typing"}'):
+            self.assertEqual(inflater.decompress(codec.encode(text)['bytes_data']), text.encode() + b'\n')
+
+    def test_text_mode_rejects_binary_frames(self):
+        codec = frames.negotiate([])
+        self.assertIsNone(codec.subprotocol)
+        self.assertEqual(codec.decode('{"type":"read"}', None), {'type': 'read'})
+        with self.assertRaises(ValueError):
+            codec.decode(None, b'\x81')
+
+
+class RateLimiterTests(SimpleTestCase):
+    limits = {
+        'chat': {'rate': 0.001, 'burst': 2, 'user_rate': 0.001, 'user_burst': 3, 'policy': DROP},
+        'default': {'rate': 0.001, 'burst': 1, 'policy': DISCONNECT},
+    }
+
+    def test_user_limit_spans_connections(self):
+        first, second = RateLimiter(1, self.limits), RateLimiter(1, self.limits)
+        try:
+            verdicts = [limiter.check('chat')[0] for limiter in (first, first, second, second)]
+            self.assertEqual(verdicts, [ALLOW, ALLOW, ALLOW, DROP])
+            self.assertEqual(first.check('default')[0], ALLOW)
+            self.assertEqual(first.check('default')[0], DISCONNECT)
+        finally:
+            first.close()
+            second.close()
+
+
+class DelayedFrameTests(SimpleTestCase):
+    def test_closing_the_socket_cancels_every_delayed_frame(self):
+        handled = []
+
+        class Consumer(RateLimitedConsumer):
+            async def handle_frame(self, data, msg_type):
+                handled.append(data['message'])
+
+        async def run():
+            consumer = Consumer()
+            consumer.limiter = RateLimiter(1, {'chat': {'rate': 20, 'burst': 1, 'policy': 'delay'}}, max_delay=1)
+            for n in range(4):
+                await consumer.receive(text_data=frames.dumps({'message': n}))
+            consumer.stop_limiting()
+            await asyncio.sleep(0.3)
+
+        asyncio.run(run())
+        self.assertEqual(handled, [0])
+
+
+class ChatFrameTests(SimpleTestCase):
+    def setUp(self):
+        self.consumer = ChatConsumer()
+        self.consumer.scope = {'user': User(id=1, username='prober')}
+        self.consumer.user_id = 1
+        self.consumer.conversation_id = 1
+        self.consumer.channel_name = 'probe'
+        self.sent = []
+
+        async def send_frame(text):
+            self.sent.append(frames.loads(text))
+
+        self.consumer.send_frame = send_frame
+        patcher = mock.patch('core.consumers.presence')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_malformed_history_limit_is_answered_with_an_error(self):
+        asyncio.run(self.consumer.handle_frame({'type': 'history', 'limit': [1]}, 'history'))
+        self.assertEqual([frame['type'] for frame in self.sent], ['error'])
+
+    def test_non_text_messages_are_ignored(self):
+        with mock.patch.object(self.consumer, 'send_chat_message') as send:
+            for message in (5, ['hi'], {'text': 'hi'}, '  '):
+                asyncio.run(self.consumer.handle_frame({'message': message}, 'chat'))
+        send.assert_not_called()
+
+    def test_unhashable_frame_type_counts_as_chat(self):
+        self.consumer.limiter = RateLimiter(self.consumer.user_id)
+        self.addCleanup(self.consumer.stop_limiting)
+        with mock.patch.object(self.consumer, 'send_chat_message') as send:
+            asyncio.run(self.consumer.receive(text_data=frames.dumps({'type': [1], 'message': 'hi'})))
+        send.assert_called_once_with('hi')
+
+
+    def replay(self, since):
+        self.consumer.scope['query_string'] = f'since={since}'.encode()
+        missed = {'messages': [{'seq': 4, 'message': 'from db'}], 'complete': True}
+        with mock.patch('core.consumers.history.aafter', mock.AsyncMock(return_value=missed)) as aafter, \
+                mock.patch('core.consumers.writer', flush=mock.AsyncMock()), \
+                mock.patch('core.consumers.database'):
+            asyncio.run(self.consumer.send_replay())
+        return aafter
+
+    def test_replay_comes_from_the_buffer(self):
+        recent.subscribe(1)
+        self.addCleanup(recent.unsubscribe, 1)
+        self.addCleanup(recent.invalidate, 1)
+        for seq in (3, 4):
+            recent.add(1, seq, frames.dumps({'seq': seq, 'message': 'from buffer'}))
+        aafter = self.replay(since=3)
+        aafter.assert_not_called()
+        self.assertEqual(self.sent[0]['messages'], [{'seq': 4, 'message': 'from buffer'}])
+
+    def test_replay_falls_back_to_the_database_on_a_buffer_miss(self):
+        recent.invalidate(1)
+        aafter = self.replay(since=3)
+        aafter.assert_called_once_with(1, 3)
+        self.assertEqual(self.sent, [{'type': 'replay', 'complete': True,
+                                      'messages': [{'seq': 4, 'message': 'from db'}]}])
+
+
+class TypingIndicatorTests(SimpleTestCase):
+    def setUp(self):
+        self.user = User(username='typist', first_name='Typist')
+        self.sent = []
+
+    def indicator(self, debounce=60, expiry=60):
+        async def broadcast(event):
+            self.sent.append(event['type'])
+
+        with override_settings(CHAT_TYPING_DEBOUNCE=debounce, CHAT_TYPING_EXPIRY=expiry):
+            return TypingIndicator(broadcast)
+
+    def test_keystrokes_are_coalesced_per_debounce_window(self):
+        typing = self.indicator(debounce=0.05)
+
+        async def run():
+            for _ in range(3):
+                await typing.started(self.user)
+            self.assertEqual(self.sent, ['typing'])
+            await asyncio.sleep(0.1)
+            await typing.started(self.user)
+            await typing.stopped()
+            await typing.stopped()
+            await typing.close()
+
+        asyncio.run(run())
+        self.assertEqual(self.sent, ['typing', 'typing', 'stop_typing'])
+
+    def test_a_sent_message_suppresses_the_stop_frame(self):
+        typing = self.indicator()
+
+        async def run():
+            await typing.started(self.user)
+            typing.reset()
+            await typing.stopped()
+            self.assertEqual(self.sent, ['typing'])
+            # The next keystroke starts a new burst right away.
+            await typing.started(self.user)
+            await typing.close()
+
+        asyncio.run(run())
+        self.assertEqual(self.sent, ['typing', 'typing', 'stop_typing'])
+
+    def test_an_idle_typist_is_stopped_after_the_expiry(self):
+        typing = self.indicator(expiry=0.05)
+
+        async def run():
+            await typing.started(self.user)
+            await asyncio.sleep(0.2)
+            return typing.active, typing._watcher
+
+        self.assertEqual(asyncio.run(run()), (False, None))
+        self.assertEqual(self.sent, ['typing', 'stop_typing'])
+
+    def test_close_stops_an_active_indicator_once(self):
+        typing = self.indicator()
+
+        async def run():
+            await typing.close()
+            await typing.started(self.user)
+            watcher = typing._watcher
+            await typing.close()
+            await typing.close()
+            await asyncio.sleep(0)
+            return watcher.cancelled()
+
+        self.assertTrue(asyncio.run(run()))
+        self.assertEqual(self.sent, ['typing', 'stop_typing'])
+
+
+class ThumbnailTests(SimpleTestCase):
+    def test_avatars_fall_back_to_the_original_until_rendered(self):
+        with tempfile.TemporaryDirectory() as root:
+            storage = FileSystemStorage(location=root, base_url='/media/')
+            upload = io.BytesIO()
+            Image.new('RGB', (1200, 800), 'teal').save(upload, 'JPEG')
+            name = storage.save('profiles/big.jpg', ContentFile(upload.getvalue()))
+            pool = ThumbnailPool(workers=1, storage=storage)
+
+            self.assertEqual(pool.url(name, 20), '/media/profiles/big.jpg')
+            pool.submit(name).result()
+            self.assertEqual(pool.url(name, 20), f'/media/thumbs/{SIZES[0]}/profiles/big.webp')
+            for size in SIZES:
+                with Image.open(storage.path(thumbnail_name(name, size))) as image:
+                    self.assertEqual(image.size, (size, size))
+
+    def test_missing_thumbnails_are_not_looked_up_on_every_render(self):
+        with tempfile.TemporaryDirectory() as root:
+            storage = FileSystemStorage(location=root, base_url='/media/')
+            name = storage.save('profiles/small.jpg', ContentFile(b'not rendered'))
+            pool = ThumbnailPool(workers=1, storage=storage, recheck=3600)
+            with mock.patch.object(storage, 'exists', wraps=storage.exists) as exists:
+                for _ in range(5):
+                    self.assertEqual(pool.url(name, 40), '/media/profiles/small.jpg')
+                self.assertEqual(exists.call_count, 1)
+
+                target = thumbnail_name(name, 40)
+                storage.save(target, ContentFile(b'rendered elsewhere'))
+                pool._missing[target] -= 3600
+                exists.reset_mock()
+                for _ in range(5):
+                    self.assertEqual(pool.url(name, 40), f'/media/{target}')
+                self.assertEqual(exists.call_count, 1)
+
+
+class HashedStorageTests(TestCase):
+    def test_identical_uploads_share_one_file_until_the_last_account_goes(self):
+        with tempfile.TemporaryDirectory() as root, override_settings(MEDIA_ROOT=root):
+            first, second = (User.objects.create_user(f'pic{i}') for i in range(2))
+            for user in (first, second):
+                user.userprofile.profile_pic.save('me.jpg', ContentFile(b'same bytes'))
+            name = first.userprofile.profile_pic.name
+            self.assertEqual(second.userprofile.profile_pic.name, name)
+            self.assertRegex(name, r'^profiles/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+            self.assertEqual(StoredFile.objects.get(name=name).references, 2)
+
+            first.delete()
+            self.assertEqual(StoredFile.objects.get(name=name).references, 1)
+            path = os.path.join(root, name)
+            os.utime(path, (0, 0))   # older than the grace period
+            with self.captureOnCommitCallbacks(execute=True):
+                second.delete()
+            self.assertFalse(StoredFile.objects.filter(name=name).exists())
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+    def test_uploads_are_served_by_django_only_in_debug(self):
+        name = 'profiles/ab/' + 'ab' * 32 + '.jpg'
+        with self.assertRaises(Resolver404):
+            resolve('/media/' + name)
+        with tempfile.TemporaryDirectory() as root, override_settings(MEDIA_ROOT=root):
+            FileSystemStorage(location=root).save(name, ContentFile(b'bytes'))
+            response = serve_media(RequestFactory().get('/media/' + name), name)
+            self.assertEqual(response['Cache-Control'], CACHE_CONTROL)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('exporter', first_name='Ex')
+        room = Room.objects.create(name='archive', created_by=self.user)
+        self.conversation_id = room.conversation.id
+        ChatMessage.objects.bulk_create(
+            ChatMessage(conversation=room.conversation, seq=seq, sender=self.user, content=f'line {seq}, "quoted"')
+            for seq in range(1, 8)
+        )
+
+    def test_batches_cover_the_history_in_order(self):
+        chunks = list(export.stream(self.conversation_id, 'jsonl', size=3))
+        self.assertEqual(len(chunks), 3)
+        seqs = [frames.loads(line)['seq'] for line in ''.join(chunks).splitlines()]
+        self.assertEqual(seqs, list(range(1, 8)))
+
+    def test_csv_download(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/export/room/archive/', {'format': 'csv'})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'seq,timestamp,username,name,message')
+        self.assertEqual(len(lines), 8)
+        self.assertTrue(lines[7].endswith(',exporter,Ex,"line 7, ""quoted"""'))
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = (User.objects.create_user(name) for name in ('alice', 'bob', 'carol'))
+        self.room = Room.objects.create(name='lobby', created_by=self.alice)
+        private = PrivateRoom.objects.create(user1=self.alice, user2=self.bob)
+        # Through the writer, which indexes what it persists.
+        MessageWriter()._write_batch([
+            ChatMessage(conversation_id=self.room.conversation.id, seq=1, sender=self.alice, content='public pelican'),
+            ChatMessage(conversation_id=private.conversation.id, seq=1, sender=self.bob, content='secret pelican'),
+        ])
+
+    def search(self, user, query='pelican'):
+        self.client.force_login(user)
+        response = self.client.get('/search/messages/', {'q': query})
+        return sorted(hit['message'] for hit in response.json()['results'])
+
+    def test_private_hits_only_reach_participants(self):
+        self.assertEqual(self.search(self.bob), ['public pelican', 'secret pelican'])
+        self.assertEqual(self.search(self.carol), ['public pelican'])
+
+    def test_deleted_rooms_and_messages_do_not_surface(self):
+        ChatMessage.objects.filter(content='secret pelican').delete()
+        self.assertEqual(self.search(self.bob), ['public pelican'])
+        self.room.delete()
+        self.assertEqual(self.search(self.bob), [])
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {search.FTS_TABLE}')
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_newer_private_matches_do_not_crowd_out_visible_ones(self):
+        private = PrivateRoom.objects.get(user1=self.alice)
+        MessageWriter()._write_batch([
+            ChatMessage(conversation_id=private.conversation.id, seq=seq, sender=self.alice, content='pelican again')
+            for seq in range(2, 5)
+        ])
+        with mock.patch.object(search.get_backend(), 'max_candidates', 2):
+            self.assertEqual(self.search(self.carol), ['public pelican'])
+
+    def test_user_search_needs_a_login(self):
+        response = self.client.get('/search/', {'q': 'ali'})
+        self.assertEqual(response.status_code, 302)
+
+
+class SequenceTests(TransactionTestCase):
+    def test_workers_on_a_shared_layer_number_messages_in_one_order(self):
+        user = User.objects.create_user('numbered')
+        room = Room.objects.create(name='busy', created_by=user)
+        conversation_id = room.conversation.id
+        ChatMessage.objects.create(conversation_id=conversation_id, seq=7, sender=user, content='stored')
+
+        async def run():
+            server = await serve('127.0.0.1', 0)
+            address = '127.0.0.1:%d' % server.sockets[0].getsockname()[1]
+            # One layer and allocator per worker process.
+            layers = [BrokerChannelLayer(address) for _ in range(2)]
+            first, second = (sequences.SharedSequenceAllocator(layer.incr) for layer in layers)
+            try:
+                numbers = [await allocator.next(conversation_id) for allocator in (first, second, first, second)]
+                # The broker restarts and forgets its counters.
+                server.broker.counters.clear()
+                await sync_to_async(ChatMessage.objects.filter(seq=7).update)(seq=11)
+                numbers.append(await first.next(conversation_id))
+                return numbers
+            finally:
+                for layer in layers:
+                    await layer.close()
+                server.close()
+                await server.wait_closed()
+
+        self.assertEqual(asyncio.run(run()), [8, 9, 10, 11, 12])
+        self.assertEqual(Conversation.objects.get(pk=conversation_id).last_seq, 0)
+
+    def test_leases_continue_after_numbers_from_a_shared_counter(self):
+        user = User.objects.create_user('switched')
+        room = Room.objects.create(name='switched', created_by=user)
+        ChatMessage.objects.create(conversation=room.conversation, seq=40, sender=user, content='shared')
+        self.assertEqual(sequences.lease(room.conversation.id, 10), 50)
+
+
+class ReadStateTests(TestCase):
+    def setUp(self):
+        self.reader, self.writer = User.objects.create_user('reader'), User.objects.create_user('talker')
+        self.room = Room.objects.create(name='news', created_by=self.writer)
+        self.private = PrivateRoom.objects.create(user1=self.reader, user2=self.writer)
+        for conversation, count in ((self.room.conversation, 5), (self.private.conversation, 3)):
+            ChatMessage.objects.bulk_create(
+                ChatMessage(conversation=conversation, seq=seq, sender=self.writer, content='news')
+                for seq in range(1, count + 1)
+            )
+        ChatMessage.objects.create(conversation=self.room.conversation, seq=6, sender=self.reader, content='mine')
+
+    def test_unread_counts_in_one_query(self):
+        ReadState.objects.create(user=self.reader, conversation=self.room.conversation, last_read_seq=2)
+        with self.assertNumQueries(1):
+            rows = unread_counts(self.reader)
+        self.assertEqual({row['id']: row['unread'] for row in rows},
+                         {self.room.conversation.id: 3, self.private.conversation.id: 3})
+
+    def test_older_ack_does_not_move_the_read_position_back(self):
+        key = (self.reader.id, self.room.conversation.id)
+        tracker = ReadTracker()
+        for seq in (4, 2):
+            tracker._persist({key: seq})
+        state = ReadState.objects.get(user=self.reader, conversation=self.room.conversation)
+        self.assertEqual(state.last_read_seq, 4)
+        tracker._persist({key: 5})
+        state.refresh_from_db()
+        self.assertEqual(state.last_read_seq, 5)
+
+    def test_acks_for_deleted_conversations_and_users_are_dropped(self):
+        gone = User.objects.create_user('gone')
+        acks = {
+            (self.reader.id, self.room.conversation.id): 3,
+            (self.reader.id, self.private.conversation.id): 2,
+            (gone.id, self.room.conversation.id): 1,
+        }
+        self.private.delete()
+        gone.delete()
+        ReadTracker()._persist(acks)
+        self.assertEqual(list(ReadState.objects.values_list('user', 'conversation', 'last_read_seq')),
+                         [(self.reader.id, self.room.conversation.id, 3)])
+
+
+class PrefixIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = typeahead.PrefixIndex()
+        self.index.build([(1, 'zed', 'Anna Maria'), (2, 'anna', 'Bob'), (3, 'annabel', ''), (4, 'bob', '')])
+
+    def ids(self, prefix, limit=typeahead.LIMIT):
+        return [user_id for user_id, _, _ in self.index.search(prefix, limit)]
+
+    def test_matches_come_in_key_order_once_each(self):
+        # "anna" < "anna maria" < "annabel"; user 1 matches two keys.
+        self.assertEqual(self.ids('ANN'), [1, 2, 3])
+        self.assertEqual(self.ids('maria'), [1])
+        self.assertEqual(self.ids('  '), [])
+
+    def test_limit_stops_the_scan(self):
+        self.assertEqual(self.ids('ann', limit=2), [1, 2])
+
+
+class TypeaheadSyncTests(TestCase):
+    def ids(self, prefix):
+        return [user_id for user_id, _, _ in typeahead.index.search(prefix)]
+
+    def test_saves_and_deletes_keep_the_index_current(self):
+        typeahead.index.build()
+        user = User.objects.create_user('newcomer', first_name='Quentin')
+        self.assertEqual(self.ids('newc'), [user.id])
+        self.assertEqual(self.ids('quen'), [user.id])
+
+        user.username = 'renamed'
+        user.save()
+        self.assertEqual(self.ids('newc'), [])
+        self.assertEqual(self.ids('renam'), [user.id])
+
+        user.is_active = False
+        user.save()
+        self.assertEqual(self.ids('renam'), [])
+
+        user.is_active = True
+        user.save()
+        user.delete()
+        self.assertEqual(self.ids('quen'), [])
+
+
+class HistoryViewTests(TestCase):
+    def setUp(self):
+        recent.clear()
+        self.addCleanup(recent.clear)
+        self.alice, self.bob, self.carol = (User.objects.create_user(name) for name in ('ann', 'ben', 'cat'))
+        self.room = Room.objects.create(name='town', created_by=self.alice)
+        self.private = PrivateRoom.objects.create(user1=self.alice, user2=self.bob)
+        for conversation, count in ((self.room.conversation, 5), (self.private.conversation, 2)):
+            ChatMessage.objects.bulk_create(
+                ChatMessage(conversation=conversation, seq=seq, sender=self.alice, content=f'm{seq}')
+                for seq in range(1, count + 1)
+            )
+
+    def get(self, url, user=None, **params):
+        self.client.force_login(user or self.alice)
+        return self.client.get(url, params)
+
+    def test_cursor_pages_walk_back_to_the_first_message(self):
+        pages, before = [], None
+        while True:
+            params = {'limit': 2} if before is None else {'limit': 2, 'before': before}
+            data = self.get('/history/room/town/', **params).json()
+            pages.append([message['seq'] for message in data['messages']])
+            before = data['next']
+            if before is None:
+                break
+        self.assertEqual(pages, [[4, 5], [2, 3], [1]])
+
+    def test_malformed_cursor_or_limit_is_a_bad_request(self):
+        for params in ({'before': 'abc'}, {'before': '0'}, {'limit': 'ten'}):
+            response = self.get('/history/room/town/', **params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', response.json())
+
+    def test_private_history_is_only_for_participants(self):
+        url = f'/history/private/{self.private.room_slug}/'
+        self.assertEqual(self.get(url, self.carol).status_code, 404)
+        data = self.get(url, self.bob).json()
+        self.assertEqual([message['message'] for message in data['messages']], ['m1', 'm2'])
+
+
+
+class DeleteRoomTests(TestCase):
+    def test_deleting_a_room_drops_its_recent_messages(self):
+        owner = User.objects.create_user('owner')
+        room = Room.objects.create(name='gone', created_by=owner)
+        conversation_id = room.conversation.id
+        recent.subscribe(conversation_id)
+        self.addCleanup(recent.unsubscribe, conversation_id)
+        recent.add(conversation_id, 1, 'hello')
+        self.client.force_login(owner)
+        self.client.post(f'/delete-room/{room.id}/')
+        self.assertFalse(Room.objects.filter(pk=room.pk).exists())
+        self.assertIsNone(recent.after(conversation_id, 0))
+    """Page query counts must not grow with the number of users or rooms."""
+
+    def setUp(self):
+        # Cached history pages would make later requests cheaper than the
+        # first; counts are compared with a cold cache.
+        recent.clear()
+        self.admin = User.objects.create_superuser('admin', password='x', first_name='Admin')
+        self.client.force_login(self.admin)
+
+    def add_data(self, count):
+        start = User.objects.count()
+        for i in range(start, start + count):
+            user = User.objects.create(username=f'user{i}')
+            UserProfile.objects.get_or_create(user=user)
+            room = Room.objects.create(name=f'room {i}', created_by=user)
+            ChatMessage.objects.create(conversation=room.conversation, seq=1, sender=user, content='hello')
+
+    def count_queries(self, url, data=None):
+        recent.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def assert_constant_queries(self, url, data=None):
+        self.add_data(2)
+        small = self.count_queries(url, data)
+        self.add_data(20)
+        self.assertEqual(self.count_queries(url, data), small)
+
+    def test_home(self):
+        self.assert_constant_queries('/')
+
+    def test_home_with_selected_room(self):
+        Room.objects.create(name='lobby', created_by=self.admin)
+        self.assert_constant_queries('/', {'room': 'lobby'})
+
+    def test_search_users(self):
+        typeahead.index.build()
+        self.assert_constant_queries('/search/', {'q': 'user'})
+
+    def test_admin_dashboard(self):
+        self.assert_constant_queries('/admin-dashboard/')
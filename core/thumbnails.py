@@ -0,0 +1,137 @@
+# core/thumbnails.py
+# Avatar thumbnails. Uploads are stored as they come, often several
+# megabytes, and pages show them at 20-80px. After an upload a small
+# worker pool renders square WebP thumbnails in each of CHAT_AVATAR_SIZES
+# next to the media files:
+#
+#     media/thumbs/<size>/<upload name without extension>.webp
+#
+# Uploads are stored under their content hash (core/storage.py), so a
+# thumbnail URL only ever refers to one image. Templates link to them
+# with {% avatar_url %}, which falls back to the original until the
+# thumbnail exists; /avatars/<user id>/<size>/ redirects to the current
+# one for code that only has the id.
+#
+# Whether a thumbnail exists is remembered per worker, so rendering a page
+# does not stat the media storage for every avatar on it. A missing one is
+# looked up again at most every CHAT_THUMBNAIL_RECHECK seconds, in case
+# another worker or build_thumbnails rendered it.
+import io
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SIZES = tuple(sorted(getattr(settings, 'CHAT_AVATAR_SIZES', (40, 80, 160))))
+QUALITY = 80
+
+
+def closest_size(size):
+    """The smallest rendered size at least `size` pixels wide."""
+    for candidate in SIZES:
+        if candidate >= size:
+            return candidate
+    return SIZES[-1]
+
+
+def thumbnail_name(name, size):
+    return f'thumbs/{size}/{os.path.splitext(name)[0]}.webp'
+
+
+def render(name, storage=default_storage):
+    """Write every thumbnail size for the upload `name`; returns bytes written."""
+    started = time.perf_counter()
+    with storage.open(name) as f:
+        image = Image.open(f)
+        # JPEGs can be decoded at a fraction of their size, which is most
+        # of the work for a large photo.
+        image.draft('RGB', (SIZES[-1] * 2, SIZES[-1] * 2))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    written = 0
+    for size in reversed(SIZES):
+        # Each size is cut from the previous one, not from the original.
+        image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, 'WEBP', quality=QUALITY, method=4)
+        target = thumbnail_name(name, size)
+        if storage.exists(target):
+            storage.delete(target)
+        storage.save(target, ContentFile(buffer.getvalue()))
+        written += buffer.tell()
+    metrics.observe('thumbnails.render', time.perf_counter() - started)
+    metrics.incr('thumbnails.rendered')
+    return written
+
+
+class ThumbnailPool:
+    def __init__(self, workers=2, storage=default_storage, recheck=60):
+        self.workers = workers
+        self.storage = storage
+        self.recheck = recheck
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = {}   # upload name -> future
+        self._ready = set()  # thumbnail names known to exist
+        self._missing = {}   # thumbnail name -> when it was last found missing
+
+    def submit(self, name):
+        """Render the thumbnails for `name` in the background."""
+        with self._lock:
+            if name in self._pending:
+                return self._pending[name]
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='thumbnails')
+            future = self._pending[name] = self._executor.submit(self._render, name)
+        metrics.set_gauge('thumbnails.pending', len(self._pending))
+        return future
+
+    def rendered(self, name):
+        return all(self.storage.exists(thumbnail_name(name, size)) for size in SIZES)
+
+    def _render(self, name):
+        try:
+            render(name, self.storage)
+            with self._lock:
+                for size in SIZES:
+                    target = thumbnail_name(name, size)
+                    self._ready.add(target)
+                    self._missing.pop(target, None)
+        except Exception:
+            logger.exception("Failed to render thumbnails for %s", name)
+            metrics.incr('thumbnails.failed')
+        finally:
+            with self._lock:
+                self._pending.pop(name, None)
+
+    def url(self, name, size):
+        """URL of the `size` thumbnail of `name`, or of the original until it exists."""
+        target = thumbnail_name(name, closest_size(size))
+        if target in self._ready:
+            return self.storage.url(target)
+        now = time.monotonic()
+        if name in self._pending or now - self._missing.get(target, now - self.recheck) < self.recheck:
+            return self.storage.url(name)
+        if not self.storage.exists(target):
+            self._missing[target] = now
+            return self.storage.url(name)
+        with self._lock:
+            self._ready.add(target)
+            self._missing.pop(target, None)
+        return self.storage.url(target)
+
+
+thumbnails = ThumbnailPool(
+    workers=getattr(settings, 'CHAT_THUMBNAIL_WORKERS', 2),
+    recheck=getattr(settings, 'CHAT_THUMBNAIL_RECHECK', 60),
+)
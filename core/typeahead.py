@@ -0,0 +1,119 @@
+# core/typeahead.py
+# In-memory prefix index of usernames and first names for the user search
+# typeahead. Keys live in one sorted list, so a lookup is a bisect plus a
+# scan over the matches only. Built lazily on first use and kept current
+# by the User signals in core/signals.py.
+#
+# Signals only reach the process that saved the user, so with several
+# workers the index is also rebuilt once it is older than
+# CHAT_TYPEAHEAD_MAX_AGE seconds. A rebuild takes over a second at 100k
+# users, so it runs on a background thread while lookups use the old index.
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+
+LIMIT = 10
+MAX_LIMIT = 50
+
+
+def keys_for(username, first_name):
+    keys = {username.lower()}
+    if first_name:
+        keys.add(first_name.lower())
+        keys.update(part for part in first_name.lower().split())
+    return keys
+
+
+class PrefixIndex:
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._entries = []   # sorted (key, user_id)
+        self._users = {}     # user_id -> (username, first_name, keys)
+        self._lock = threading.Lock()
+        self._built = False
+        self._built_at = 0.0
+        self._rebuilding = False
+
+    def build(self, rows=None):
+        if rows is None:
+            rows = User.objects.filter(is_active=True).values_list('id', 'username', 'first_name')
+        users = {}
+        entries = []
+        for user_id, username, first_name in rows:
+            keys = keys_for(username, first_name)
+            users[user_id] = (username, first_name, keys)
+            entries.extend((key, user_id) for key in keys)
+        entries.sort()
+        with self._lock:
+            self._users = users
+            self._entries = entries
+            self._built = True
+            self._built_at = time.monotonic()
+
+    def ensure_built(self):
+        if not self._built:
+            self.build()
+        elif time.monotonic() - self._built_at > self.max_age and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild, daemon=True).start()
+
+    def _rebuild(self):
+        try:
+            self.build()
+        finally:
+            self._rebuilding = False
+            connection.close()
+
+    def update(self, user_id, username, first_name):
+        if not self._built:
+            return
+        with self._lock:
+            self._remove(user_id)
+            keys = keys_for(username, first_name)
+            self._users[user_id] = (username, first_name, keys)
+            for key in keys:
+                insort(self._entries, (key, user_id))
+
+    def remove(self, user_id):
+        if not self._built:
+            return
+        with self._lock:
+            self._remove(user_id)
+
+    def _remove(self, user_id):
+        old = self._users.pop(user_id, None)
+        if old is None:
+            return
+        for key in old[2]:
+            i = bisect_left(self._entries, (key, user_id))
+            if i < len(self._entries) and self._entries[i] == (key, user_id):
+                del self._entries[i]
+
+    def search(self, prefix, limit=LIMIT):
+        """Up to `limit` (user_id, username, first_name) whose username or name starts with prefix."""
+        self.ensure_built()
+        prefix = prefix.lower().strip()
+        if not prefix:
+            return []
+        results = []
+        seen = set()
+        with self._lock:
+            entries = self._entries
+            i = bisect_left(entries, (prefix,))
+            while i < len(entries) and len(results) < limit:
+                key, user_id = entries[i]
+                if not key.startswith(prefix):
+                    break
+                if user_id not in seen:
+                    seen.add(user_id)
+                    username, first_name, _ = self._users[user_id]
+                    results.append((user_id, username, first_name))
+                i += 1
+        return results
+
+
+index = PrefixIndex(max_age=getattr(settings, 'CHAT_TYPEAHEAD_MAX_AGE', 300))
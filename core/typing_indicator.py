@@ -0,0 +1,80 @@
+# core/typing_indicator.py
+# Server-side coalescing of typing indicators. Clients send a "typing" frame
+# per keystroke; only state changes (and one refresh per debounce window
+# for members who joined mid-burst) are broadcast to the room. Frame rates
+# are limited by the consumer's RateLimiter (core/ratelimit.py).
+import asyncio
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+
+class TypingIndicator:
+    def __init__(self, broadcast):
+        self.broadcast = broadcast
+        self.debounce = getattr(settings, 'CHAT_TYPING_DEBOUNCE', 2.0)
+        self.expiry = getattr(settings, 'CHAT_TYPING_EXPIRY', 5.0)
+        self.active = False
+        self.user = None
+        self.last_forwarded = 0.0
+        self.deadline = 0.0
+        self._watcher = None
+
+    async def started(self, user):
+        now = time.monotonic()
+        self.deadline = now + self.expiry
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.ensure_future(self._expire_when_idle())
+        if self.active and now - self.last_forwarded < self.debounce:
+            metrics.incr('typing.suppressed')
+            return
+        self.active = True
+        self.user = user
+        self.last_forwarded = now
+        metrics.incr('typing.forwarded')
+        await self.broadcast({
+            'type': 'typing',
+            'username': user.username,
+            'name': user.first_name or user.username,
+        })
+
+    async def stopped(self):
+        if not self.active:
+            metrics.incr('typing.suppressed')
+            return
+        await self._stop()
+
+    def reset(self):
+        # A chat message clears the indicator on every client already, so
+        # no stop_typing frame is needed.
+        self.active = False
+        self._cancel_watcher()
+
+    async def close(self):
+        self._cancel_watcher()
+        if self.active:
+            await self._stop()
+
+    async def _stop(self):
+        self.active = False
+        self._cancel_watcher()
+        metrics.incr('typing.forwarded')
+        await self.broadcast({'type': 'stop_typing', 'username': self.user.username})
+
+    async def _expire_when_idle(self):
+        while True:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        self._watcher = None
+        if self.active:
+            metrics.incr('typing.expired')
+            await self._stop()
+
+    def _cancel_watcher(self):
+        if self._watcher is not None and self._watcher is not asyncio.current_task():
+            self._watcher.cancel()
+        self._watcher = None
@@ -13,9 +13,16 @@ urlpatterns = [
     path('delete-account/', views.delete_account, name='delete_account'),
     path('profile/', views.profile, name='profile'),
     path('update-profile-pic/', views.update_profile_pic, name='update_profile_pic'),
+    path('avatars/<int:user_id>/<int:size>/', views.avatar, name='avatar'),
     path('admin-dashboard/', views.admin_dashboard, name='admin_dashboard'),
+    path('metrics/', views.chat_metrics, name='chat_metrics'),
     # path('create_room_ajax/', views.create_room_ajax, name='create_room_ajax'),
     path('search/', views.search_users, name='search_users'),
+    path('search/messages/', views.search_messages, name='search_messages'),
+    path('history/room/<slug:slug>/', views.room_history, name='room_history'),
+    path('history/private/<str:room_slug>/', views.private_history, name='private_history'),
+    path('export/room/<slug:slug>/', views.room_export, name='room_export'),
+    path('export/private/<str:room_slug>/', views.private_export, name='private_export'),
     path('about/', views.about, name='about'),
 ]
 
@@ -7,19 +7,34 @@ from django.contrib import messages
 from django.db.models import Q
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.safestring import mark_safe
 from django.utils.text import slugify
+from django.views.static import serve
+from django.conf import settings
 from .forms import SearchForm, ProfilePicForm
 import json
 
-from .models import Room, Message, PrivateRoom, UserProfile, ChatMessage
+from .models import Room, PrivateRoom, UserProfile, ChatMessage, Conversation
+from . import export, history, metrics, search, typeahead
+from .presence import presence
+from .receipts import UNREAD_CAP, unread_counts
+from .recent import recent
+from .sequences import sequences
+from .storage import CACHE_CONTROL, HASHED_NAME
+from .thumbnails import thumbnails
+
+# Same escapes as the json_script filter, for JSON that is already encoded.
+JSON_SCRIPT_ESCAPES = {ord('<'): '\\u003C', ord('>'): '\\u003E', ord('&'): '\\u0026'}
 
 
 @staff_member_required
 def admin_dashboard(request):
     users = User.objects.all()
-    rooms = Room.objects.all()
-    messages = Message.objects.order_by('-timestamp')[:50]
+    rooms = Room.objects.select_related('created_by')
+    messages = (ChatMessage.objects.filter(conversation__kind=Conversation.ROOM)
+                .select_related('sender', 'conversation__room').order_by('-timestamp')[:50])
     return render(request, 'admin_dashboard.html', {
         'users': users,
         'rooms': rooms,
@@ -27,6 +42,11 @@ def admin_dashboard(request):
     })
 
 
+@staff_member_required
+def chat_metrics(request):
+    return JsonResponse(metrics.snapshot())
+
+
 @login_required
 def create_room_ajax(request):
     if request.method == 'POST':
@@ -44,7 +64,10 @@ def delete_room(request, room_id):
     next_url = request.GET.get('next') or 'home'
     room = get_object_or_404(Room, id=room_id)
     if request.method == 'POST':
+        conversation_id = Conversation.objects.filter(room=room).values_list('id', flat=True).first()
         room.delete()
+        recent.invalidate(conversation_id)
+        sequences.forget(conversation_id)
         messages.success(request, 'Room deleted successfully.')
     return redirect(next_url)
 
@@ -52,7 +75,8 @@ def delete_room(request, room_id):
 @login_required
 def profile(request):
     rooms = Room.objects.filter(created_by=request.user)
-    messages = ChatMessage.objects.filter(sender=request.user).order_by('-timestamp')[:20]
+    messages = (ChatMessage.objects.filter(sender=request.user, conversation__kind=Conversation.ROOM)
+                .select_related('conversation__room').order_by('-timestamp')[:20])
     return render(request, 'profile.html', {'rooms': rooms, 'messages': messages})
 
 @login_required
@@ -61,7 +85,10 @@ def update_profile_pic(request):
     if request.method == 'POST':
         form = ProfilePicForm(request.POST, request.FILES, instance=profile)
         if form.is_valid():
-            form.save()
+            profile = form.save()
+            # A picture someone has uploaded before has its thumbnails already.
+            if profile.profile_pic and not thumbnails.rendered(profile.profile_pic.name):
+                thumbnails.submit(profile.profile_pic.name)
             messages.success(request, "Profile picture updated successfully.")
             return redirect('profile')  # Or anywhere you want to go after upload
     else:
@@ -69,18 +96,57 @@ def update_profile_pic(request):
     
     return render(request, 'update_profile_pic.html', {'form': form})
 
+
+def serve_media(request, path):
+    # Development only; see core/storage.py for production.
+    response = serve(request, path, document_root=settings.MEDIA_ROOT)
+    if HASHED_NAME.search(path):
+        response['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+@login_required
+def avatar(request, user_id, size):
+    name = UserProfile.objects.filter(user_id=user_id).values_list('profile_pic', flat=True).first()
+    if not name:
+        raise Http404
+    response = redirect(thumbnails.url(name, size))
+    # The target changes when the user uploads a new picture.
+    response['Cache-Control'] = 'private, max-age=300'
+    return response
+
 @login_required
 def home(request):
     storage = messages.get_messages(request)
     list(storage)
 
-    rooms = Room.objects.all()
-    users = User.objects.exclude(id=request.user.id)
+    rooms = list(Room.objects.all())
+    users = list(User.objects.exclude(id=request.user.id).values(
+        'id', 'username', 'first_name', 'userprofile__is_online', 'userprofile__profile_pic'))
+    online = presence.online_many(
+        [u['id'] for u in users],
+        persisted={u['id']: u['userprofile__is_online'] for u in users},
+    )
+    unread_rooms, unread_users = {}, {}
+    for row in unread_counts(request.user):
+        if row['room_id'] is not None:
+            unread_rooms[row['room_id']] = row['unread']
+        else:
+            other = row['private_room__user2_id'] if row['private_room__user1_id'] == request.user.id \
+                else row['private_room__user1_id']
+            unread_users[other] = row['unread']
+    for user in users:
+        user['online'] = online[user['id']]
+        user['unread'] = unread_users.get(user['id'], 0)
+    for room in rooms:
+        room.unread = unread_rooms.get(room.id, 0)
 
     selected_room = None
     selected_user = None
     private_room = None
-    chat_messages = []
+
+    conversation_id = None
+    initial_history = None
 
     room_name = request.GET.get("room")
     user_name = request.GET.get("chat")
@@ -88,8 +154,8 @@ def home(request):
 
     if room_name:
         try:
-            selected_room = Room.objects.get(slug=room_name)
-            chat_messages = ChatMessage.objects.filter(room_name=selected_room.slug).order_by('timestamp')[:50]
+            selected_room = Room.objects.select_related('conversation').get(slug=room_name)
+            conversation_id = selected_room.conversation.id
         except Room.DoesNotExist:
             messages.error(request, 'Selected room does not exist')
 
@@ -97,22 +163,79 @@ def home(request):
         try:
             selected_user = User.objects.get(username=user_name)
             private_room = get_or_create_private_chat(request.user, selected_user)
-            chat_messages = ChatMessage.objects.filter(room_name=private_room.room_slug).order_by('timestamp')[:50]
-            selected_user_status = get_user_status(selected_user.username)
+            conversation_id = Conversation.objects.values_list('id', flat=True).get(private_room=private_room)
+            selected_user_status = get_user_status(selected_user.id)
         except User.DoesNotExist:
             messages.error(request, 'Selected user does not exist')
 
+    if conversation_id is not None:
+        # The latest page goes into the page itself, usually straight from
+        # the recent-message cache, so the chat box fills without waiting
+        # for the socket.
+        initial_history = mark_safe(history.encode_page(history.cached_page(conversation_id))
+                                    .translate(JSON_SCRIPT_ESCAPES))
+
     return render(request, 'home.html', {
         'rooms': rooms,
         'users': users,
         'selected_room': selected_room,
         'selected_user': selected_user,
         'private_room': private_room,
-        'messages': chat_messages,
         'error_message': messages.get_messages(request),
-        'selected_user_status': selected_user_status
+        'selected_user_status': selected_user_status,
+        'initial_history': initial_history,
+        'unread_cap': UNREAD_CAP,
     })
 
+@login_required
+def room_history(request, slug):
+    conversation = get_object_or_404(Conversation, room__slug=slug)
+    return history_response(request, conversation.id)
+
+
+@login_required
+def private_history(request, room_slug):
+    conversations = Conversation.objects.filter(
+        Q(private_room__user1=request.user) | Q(private_room__user2=request.user))
+    conversation = get_object_or_404(conversations, private_room__room_slug=room_slug)
+    return history_response(request, conversation.id)
+
+
+@login_required
+def room_export(request, slug):
+    conversation = get_object_or_404(Conversation, room__slug=slug)
+    return export_response(request, conversation.id, slug)
+
+
+@login_required
+def private_export(request, room_slug):
+    conversations = Conversation.objects.filter(
+        Q(private_room__user1=request.user) | Q(private_room__user2=request.user))
+    conversation = get_object_or_404(conversations, private_room__room_slug=room_slug)
+    return export_response(request, conversation.id, room_slug)
+
+
+def export_response(request, conversation_id, name):
+    fmt = request.GET.get('format', 'jsonl')
+    if fmt not in export.FORMATS:
+        return JsonResponse({'error': 'Unknown export format'}, status=400)
+    if isinstance(request, ASGIRequest):
+        content = export.astream(conversation_id, fmt)
+    else:
+        content = export.stream(conversation_id, fmt)
+    response = StreamingHttpResponse(content, content_type=export.FORMATS[fmt][0])
+    response['Content-Disposition'] = f'attachment; filename="{slugify(name)}.{fmt}"'
+    return response
+
+
+def history_response(request, conversation_id):
+    try:
+        limit = int(request.GET.get('limit', history.PAGE_SIZE))
+        page = history.cached_page(conversation_id, before=request.GET.get('before'), limit=limit)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return HttpResponse(history.encode_page(page), content_type='application/json')
+
 def get_or_create_private_chat(user1, user2):
     user1, user2 = sorted([user1, user2], key=lambda u: u.id)
     room, created = PrivateRoom.objects.get_or_create(user1=user1, user2=user2)
@@ -160,9 +283,6 @@ def login_view(request):
         user = authenticate(request, username=username, password=password)
         if user:
             login(request, user)
-            profile, _ = UserProfile.objects.get_or_create(user=user)
-            profile.is_online = True
-            profile.save()
             return redirect(request.POST.get('next') or 'home')
         else:
             messages.error(request, "Invalid username or password.")
@@ -170,10 +290,6 @@ def login_view(request):
 
 
 def logout_view(request):
-    if request.user.is_authenticated:
-        profile, _ = UserProfile.objects.get_or_create(user=request.user)
-        profile.is_online = False
-        profile.save()
     logout(request)
     return redirect('login')
 
@@ -193,30 +309,41 @@ def create_room_ajax(request):
     return JsonResponse({"success": False, "error": "Invalid request"})
 
 
-def get_user_status(username):
-    try:
-        profile = UserProfile.objects.get(user__username=username)
-        return profile.is_online
-    except UserProfile.DoesNotExist:
-        return False
+def get_user_status(user_id):
+    return presence.online_many([user_id])[user_id]
 
 
+@login_required
 def search_users(request):
     query = request.GET.get('q', '')
-    users = User.objects.filter(username__icontains=query)
+    try:
+        limit = min(max(1, int(request.GET.get('limit', typeahead.LIMIT))), typeahead.MAX_LIMIT)
+    except ValueError:
+        limit = typeahead.LIMIT
+    users = typeahead.index.search(query, limit)
+    online = presence.online_many([u[0] for u in users])
     result = []
-    for user in users:
-        try:
-            profile = UserProfile.objects.get(user=user)
-            is_online = profile.is_online
-        except UserProfile.DoesNotExist:
-            is_online = False
+    for user_id, username, first_name in users:
         result.append({
-            'username': user.username,
-            'online': is_online
+            'username': username,
+            'name': first_name or username,
+            'online': online[user_id]
         })
     return JsonResponse({'results': result})
 
+@login_required
+def search_messages(request):
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        page = 1
+    if not query:
+        return JsonResponse({'results': [], 'page': page})
+    offset = (page - 1) * search.PAGE_SIZE
+    results = search.get_backend().search(query, request.user, limit=search.PAGE_SIZE, offset=offset)
+    return JsonResponse({'results': results, 'page': page})
+
 def about(request):
     return render(request, 'about.html')
 